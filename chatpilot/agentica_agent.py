@@ -3,7 +3,12 @@
 @author:XuMing(xuming624@qq.com)
 @description: 
 """
-from typing import Optional
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Optional, Callable, Hashable
 
 from agentica import PythonAgent, AzureOpenAIChat, OpenAIChat, Agent, MoonshotChat, DeepSeekChat
 from agentica.tools.search_serper_tool import SearchSerperTool
@@ -13,6 +18,8 @@ from chatpilot.config import (
     ENABLE_SEARCH_TOOL,
     ENABLE_URL_CRAWLER_TOOL,
     ENABLE_RUN_PYTHON_CODE_TOOL,
+    AGENT_POOL_MAX_SIZE,
+    AGENT_POOL_TTL,
 )
 
 
@@ -112,11 +119,22 @@ class AgenticaAgent:
         runs the given input string through the ChatAgent and returns the result.
 
         :param input_str: The input string to process.
-        :return: An asynchronous generator of events.
+        :return: A generator of events.
         """
 
         return self.model.run(input_str, stream=True)
 
+    async def astream_run(self, input_str: str):
+        """
+        runs the given input string through the ChatAgent asynchronously, streaming the result.
+
+        :param input_str: The input string to process.
+        :return: An asynchronous generator of events.
+        """
+        events = await self.model.arun(input_str, stream=True)
+        async for event in events:
+            yield event
+
     def run(self, input_str: str):
         """
         runs the given input string through the ChatAgent and returns the result.
@@ -125,3 +143,87 @@ class AgenticaAgent:
         :return: The result of the processing.
         """
         return self.model.run(input_str, stream=False)
+
+    def reset(self):
+        """Clears the chat memory, so the agent can be reused for a new conversation."""
+        self.model.memory.clear()
+
+
+class AgentPool:
+    """LRU pool of warm agents, keyed by conversation, with idle TTL and max size bound."""
+
+    def __init__(self, max_size: int = AGENT_POOL_MAX_SIZE, ttl: float = AGENT_POOL_TTL):
+        """
+        :param max_size: Max number of agents kept in the pool, the least recently used is evicted first.
+        :param ttl: Seconds an agent may stay idle before it is evicted, <= 0 means never expire.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._agents = OrderedDict()  # key -> (agent, last_used)
+        self._lock = threading.Lock()
+        # key -> lock of the requests using its agent, dropped when no request holds or waits for it
+        self._agent_locks = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._agents)
+
+    def __repr__(self):
+        return f"AgentPool(size={len(self)}, max_size={self.max_size}, ttl={self.ttl})"
+
+    def _evict_expired(self, now: float):
+        if self.ttl <= 0:
+            return
+        # Items are kept in last-used order, so expired agents are always at the front
+        while self._agents:
+            key, (_, last_used) = next(iter(self._agents.items()))
+            if now - last_used < self.ttl:
+                break
+            self._agents.pop(key)
+
+    def get(self, key: Hashable, factory: Callable[[], AgenticaAgent]) -> AgenticaAgent:
+        """
+        Returns the agent for the key, building it with factory on a miss.
+
+        :param key: The conversation key, such as (user_id, chat_id, model_name, system_prompt_hash).
+        :param factory: Callable that builds a new agent.
+        :return: The pooled agent.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._evict_expired(now)
+            item = self._agents.get(key)
+            if item is not None:
+                self._agents[key] = (item[0], now)
+                self._agents.move_to_end(key)
+                return item[0]
+
+        # Build outside the lock, agent construction can be slow
+        agent = factory()
+        with self._lock:
+            item = self._agents.get(key)
+            if item is not None:
+                # Another request built the same agent meanwhile, keep the first one
+                agent = item[0]
+            self._agents[key] = (agent, time.monotonic())
+            self._agents.move_to_end(key)
+            while len(self._agents) > self.max_size:
+                self._agents.popitem(last=False)
+        return agent
+
+    def lock(self, key: Hashable) -> asyncio.Lock:
+        """Lock to hold while using the agent of the key, its memory is one conversation at a time."""
+        with self._lock:
+            lock = self._agent_locks.get(key)
+            if lock is None:
+                lock = asyncio.Lock()
+                self._agent_locks[key] = lock
+        return lock
+
+    def pop(self, key: Hashable) -> Optional[AgenticaAgent]:
+        with self._lock:
+            item = self._agents.pop(key, None)
+        return item[0] if item is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._agents.clear()
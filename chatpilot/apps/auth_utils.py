@@ -1,4 +1,5 @@
 import logging
+import time
 from datetime import datetime, timedelta
 from typing import Union, Optional
 
@@ -6,7 +7,9 @@ import jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from passlib.context import CryptContext
-from chatpilot.config import WEBUI_SECRET_KEY
+
+from chatpilot.apps.cache_utils import TTLCache
+from chatpilot.config import WEBUI_SECRET_KEY, AUTH_CACHE_MAX_SIZE, AUTH_CACHE_TTL
 from chatpilot.constants import ERROR_MESSAGES
 
 logging.getLogger("passlib").setLevel(logging.ERROR)
@@ -21,6 +24,10 @@ ALGORITHM = "HS256"
 bearer_security = HTTPBearer()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Verified token -> user id, and user id -> UserModel
+TOKEN_CACHE = TTLCache(AUTH_CACHE_MAX_SIZE, AUTH_CACHE_TTL, name="tokens")
+USER_CACHE = TTLCache(AUTH_CACHE_MAX_SIZE, AUTH_CACHE_TTL, name="users")
+
 
 def verify_password(plain_password, hashed_password):
     return (
@@ -51,6 +58,24 @@ def decode_token(token: str) -> Optional[dict]:
         return None
 
 
+def get_user_id_from_token(token: str) -> Optional[str]:
+    """Decode the token once, then serve its user id from cache until the token or the cache entry expires."""
+    user_id = TOKEN_CACHE.get(token)
+    if user_id is not None:
+        return user_id
+    data = decode_token(token)
+    if not data or "id" not in data:
+        return None
+    ttl = data["exp"] - time.time() if "exp" in data else None
+    TOKEN_CACHE.set(token, data["id"], ttl=ttl)
+    return data["id"]
+
+
+def invalidate_user_cache(user_id: str):
+    """Drop the cached user, called when the user is updated or deleted."""
+    USER_CACHE.pop(user_id)
+
+
 def extract_token_from_auth_header(auth_header: str):
     return auth_header[len("Bearer "):]
 
@@ -67,14 +92,17 @@ def get_current_user(
         auth_token: HTTPAuthorizationCredentials = Depends(bearer_security),
 ):
     from chatpilot.apps.web.models.users import Users
-    data = decode_token(auth_token.credentials)
-    if data and "id" in data:
-        user = Users.get_user_by_id(data["id"])
+    user_id = get_user_id_from_token(auth_token.credentials)
+    if user_id is not None:
+        user = USER_CACHE.get(user_id)
         if user is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail=ERROR_MESSAGES.INVALID_TOKEN,
-            )
+            user = Users.get_user_by_id(user_id)
+            if user is None:
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail=ERROR_MESSAGES.INVALID_TOKEN,
+                )
+            USER_CACHE.set(user_id, user)
         return user
     else:
         raise HTTPException(
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Least-loaded, latency-aware load balancer with circuit breaker for the Ollama base urls
+"""
+import time
+from typing import Dict, List, Optional
+
+from chatpilot.config import (
+    OLLAMA_CB_FAILURE_THRESHOLD,
+    OLLAMA_CB_COOLDOWN,
+)
+
+
+class NodeStats:
+    """Load and health of one upstream node, indexed like OLLAMA_BASE_URLS."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.ttft = None  # EWMA of time to first token, seconds
+        self.error_rate = 0.0  # EWMA of request outcomes, 1 is error
+        self.consecutive_failures = 0
+        self.opened_at = None  # circuit opened time, None is closed
+
+    def to_dict(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ttft": round(self.ttft, 4) if self.ttft is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "consecutive_failures": self.consecutive_failures,
+            "circuit": "open" if self.opened_at is not None else "closed",
+        }
+
+
+class LoadBalancer:
+    """Pick the least-loaded healthy node, eject failing nodes with a circuit breaker.
+
+    Load score is `(in_flight + 1) * ttft`, so a node that is twice as fast takes about twice the requests.
+    After `failure_threshold` consecutive failures the circuit opens for `cooldown` seconds, then one trial
+    request is let through (half open): a success closes the circuit, a failure opens it again.
+    """
+
+    def __init__(
+            self,
+            failure_threshold: int = OLLAMA_CB_FAILURE_THRESHOLD,
+            cooldown: float = OLLAMA_CB_COOLDOWN,
+            alpha: float = 0.2,
+            default_ttft: float = 1.0,
+    ):
+        """
+        :param failure_threshold: Consecutive failures that open the circuit of a node.
+        :param cooldown: Seconds an open circuit waits before the trial request.
+        :param alpha: Smoothing factor of the EWMA of ttft and error rate.
+        :param default_ttft: Ttft assumed for a node without samples yet.
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.default_ttft = default_ttft
+        self.nodes: Dict[int, NodeStats] = {}
+
+    def __repr__(self):
+        return f"LoadBalancer(nodes={len(self.nodes)}, failure_threshold={self.failure_threshold})"
+
+    def node(self, idx: int) -> NodeStats:
+        if idx not in self.nodes:
+            self.nodes[idx] = NodeStats()
+        return self.nodes[idx]
+
+    def is_available(self, idx: int, now: Optional[float] = None) -> bool:
+        node = self.node(idx)
+        if node.opened_at is None:
+            return True
+        now = time.monotonic() if now is None else now
+        # Half open: a single trial request once the cooldown has passed
+        return now - node.opened_at >= self.cooldown and node.in_flight == 0
+
+    def score(self, idx: int) -> float:
+        node = self.node(idx)
+        ttft = node.ttft if node.ttft is not None else self.default_ttft
+        return (node.in_flight + 1) * ttft
+
+    def pick(self, url_idxs: List[int]) -> int:
+        """Return the best url index among the candidates, which are the `urls` of a model."""
+        now = time.monotonic()
+        healthy = [idx for idx in url_idxs if self.is_available(idx, now)]
+        if healthy:
+            return min(healthy, key=self.score)
+        # All circuits are open, try the node that was ejected first rather than fail the request
+        return min(url_idxs, key=lambda idx: self.node(idx).opened_at)
+
+    def acquire(self, idx: int):
+        node = self.node(idx)
+        node.in_flight += 1
+        node.requests += 1
+
+    def record_ttft(self, idx: int, seconds: float):
+        node = self.node(idx)
+        node.ttft = seconds if node.ttft is None else (1 - self.alpha) * node.ttft + self.alpha * seconds
+
+    def release(self, idx: int, error: bool = False):
+        node = self.node(idx)
+        node.in_flight = max(node.in_flight - 1, 0)
+        node.error_rate = (1 - self.alpha) * node.error_rate + self.alpha * (1.0 if error else 0.0)
+        if error:
+            node.errors += 1
+            node.consecutive_failures += 1
+            if node.consecutive_failures >= self.failure_threshold:
+                node.opened_at = time.monotonic()
+        else:
+            node.consecutive_failures = 0
+            node.opened_at = None
+
+    def reset(self):
+        self.nodes = {}
+
+    def stats(self, urls: List[str]) -> List[dict]:
+        return [{"url_idx": idx, "url": url, **self.node(idx).to_dict()} for idx, url in enumerate(urls)]
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: In-memory caches for the hot paths
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from loguru import logger
+
+
+class RefreshingCache:
+    """Cache of one async loader result with TTL and stale-while-revalidate.
+
+    A fresh value is served from memory. A stale value is served as is while one background task reloads it,
+    so a slow or dead upstream never blocks the caller once the first load is done.
+    Concurrent callers share the same load (single flight).
+    """
+
+    def __init__(
+            self,
+            loader: Callable[[], Awaitable[Any]],
+            ttl: float,
+            name: str = "",
+            on_update: Optional[Callable[[Any], None]] = None,
+    ):
+        """
+        :param loader: Coroutine function that loads the value, it should not keep state of its own,
+            a load running when the cache is invalidated is ignored.
+        :param ttl: Seconds the value is fresh, after that it is refreshed in the background.
+        :param name: Name in logs.
+        :param on_update: Called with each value stored, such as to index it.
+        """
+        self.loader = loader
+        self.on_update = on_update
+        self.ttl = ttl
+        self.name = name
+        self._value = None
+        self._loaded = False
+        self._updated_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._generation = 0  # bumped by invalidate, so an outdated load does not overwrite
+
+    def __repr__(self):
+        return f"RefreshingCache(name={self.name}, ttl={self.ttl}, loaded={self._loaded})"
+
+    async def _load(self):
+        generation = self._generation
+        try:
+            value = await self.loader()
+            if generation != self._generation:
+                return value
+            self._value = value
+            self._loaded = True
+            self._updated_at = time.monotonic()
+            if self.on_update is not None:
+                self.on_update(value)
+        except Exception as e:
+            # Keep serving the last value, retry after the next ttl
+            logger.error(f"Refresh {self.name} failed: {e}")
+            self._updated_at = time.monotonic()
+        return self._value
+
+    def _refresh_task(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._load())
+        return self._task
+
+    async def get(self):
+        """Return the cached value, waits only for the very first load."""
+        if not self._loaded:
+            return await asyncio.shield(self._refresh_task())
+        if time.monotonic() - self._updated_at >= self.ttl:
+            self._refresh_task()
+        return self._value
+
+    async def refresh(self):
+        """Reload now and return the new value."""
+        return await asyncio.shield(self._refresh_task())
+
+    def invalidate(self):
+        """
+        Drop the value, the next get loads it again, such as after the upstream urls changed.
+
+        A load already running is not stored, its loader saw the state before the change.
+        """
+        self._value = None
+        self._loaded = False
+        self._updated_at = 0.0
+        self._task = None
+        self._generation += 1
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after ttl seconds, thread safe for sync dependencies."""
+
+    def __init__(self, max_size: int, ttl: float, name: str = ""):
+        """
+        :param max_size: Max number of entries, the least recently used one is evicted first.
+        :param ttl: Default seconds an entry lives.
+        :param name: Name in logs.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"TTLCache(name={self.name}, max_size={self.max_size}, ttl={self.ttl}, size={len(self._data)})"
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[1] <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key: Hashable, value, ttl: Optional[float] = None):
+        """Add or replace an entry, ttl overrides the default ttl, such as to not outlive a token expiry."""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if self.max_size <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
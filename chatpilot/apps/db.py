@@ -1,6 +1,24 @@
 import peewee as pw
 
-from chatpilot.config import DB_PATH
+from chatpilot.config import (
+    DB_PATH,
+    DB_CACHE_SIZE,
+    DB_MMAP_SIZE,
+    DB_BUSY_TIMEOUT,
+)
 
-DB = pw.SqliteDatabase(DB_PATH)
+# Applied to every new connection.
+# WAL lets readers run alongside the single writer, and synchronous=normal is durable enough with WAL.
+DB_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -DB_CACHE_SIZE,  # negative is KiB
+    "mmap_size": DB_MMAP_SIZE,
+    "busy_timeout": DB_BUSY_TIMEOUT,  # wait for the write lock instead of failing with `database is locked`
+    "temp_store": "memory",
+}
+
+# Peewee keeps one connection per thread and opens it on first use in that thread,
+# so the threadpool workers of the routers never share a sqlite connection.
+DB = pw.SqliteDatabase(DB_PATH, pragmas=DB_PRAGMAS, thread_safe=True, autoconnect=True)
 DB.connect()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Document loading and splitting, light to import so it can run in worker processes
+"""
+from typing import Iterator, List, Optional, Tuple
+
+from langchain_community.document_loaders import (
+    TextLoader,
+    PyPDFLoader,
+    CSVLoader,
+    Docx2txtLoader,
+    UnstructuredEPubLoader,
+    UnstructuredMarkdownLoader,
+    UnstructuredXMLLoader,
+    UnstructuredRSTLoader,
+    UnstructuredExcelLoader,
+)
+
+from chatpilot.apps.text_splitter import ChineseRecursiveTextSplitter, count_tokens
+
+
+def get_loader(filename: str, file_content_type: Optional[str], file_path: str, pdf_extract_images: bool = False):
+    """Get loader by file type."""
+    file_ext = filename.split(".")[-1].lower()
+    known_type = True
+
+    known_source_ext = [
+        "go",
+        "py",
+        "java",
+        "sh",
+        "bat",
+        "ps1",
+        "cmd",
+        "js",
+        "ts",
+        "css",
+        "cpp",
+        "hpp",
+        "h",
+        "c",
+        "cs",
+        "sql",
+        "log",
+        "ini",
+        "pl",
+        "pm",
+        "r",
+        "dart",
+        "dockerfile",
+        "env",
+        "php",
+        "hs",
+        "hsc",
+        "lua",
+        "nginxconf",
+        "conf",
+        "m",
+        "mm",
+        "plsql",
+        "perl",
+        "rb",
+        "rs",
+        "db2",
+        "scala",
+        "bash",
+        "swift",
+        "vue",
+        "svelte",
+    ]
+
+    if file_ext == "pdf":
+        loader = PyPDFLoader(file_path, extract_images=pdf_extract_images)
+    elif file_ext == "csv":
+        loader = CSVLoader(file_path)
+    elif file_ext == "rst":
+        loader = UnstructuredRSTLoader(file_path, mode="elements")
+    elif file_ext == "xml":
+        loader = UnstructuredXMLLoader(file_path)
+    elif file_ext == "md":
+        loader = UnstructuredMarkdownLoader(file_path)
+    elif file_content_type == "application/epub+zip":
+        loader = UnstructuredEPubLoader(file_path)
+    elif (
+            file_content_type
+            == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+            or file_ext in ["doc", "docx"]
+    ):
+        loader = Docx2txtLoader(file_path)
+    elif file_content_type in [
+        "application/vnd.ms-excel",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ] or file_ext in ["xls", "xlsx"]:
+        loader = UnstructuredExcelLoader(file_path)
+    elif file_ext in known_source_ext or (
+            file_content_type and file_content_type.find("text/") >= 0
+    ):
+        loader = TextLoader(file_path)
+    else:
+        loader = TextLoader(file_path)
+        known_type = False
+
+    return loader, known_type
+
+
+def load_data(loader):
+    # Check if lazy_load is implemented
+    try:
+        return loader.lazy_load()
+    except NotImplementedError:
+        return loader.load()
+
+
+def iter_split_data(
+        data, chunk_size: int, chunk_overlap: int, doc_text_length_limit: int = -1, chunk_unit: str = "char"
+) -> Iterator[Tuple[str, dict]]:
+    """
+    Chunks of the documents and their metadata, split as they are consumed.
+
+    :param chunk_unit: `char`, or `token` for a chunk size and overlap in tokens of the tokenizer.
+    """
+    text_splitter = ChineseRecursiveTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+        doc_text_length_limit=doc_text_length_limit,
+        length_function=count_tokens if chunk_unit == "token" else len,
+    )
+    return text_splitter.iter_split_documents(data)
+
+
+def split_data(
+        data, chunk_size: int, chunk_overlap: int, doc_text_length_limit: int = -1, chunk_unit: str = "char"
+) -> Tuple[List[str], List[dict]]:
+    texts, metadatas = [], []
+    for text, metadata in iter_split_data(data, chunk_size, chunk_overlap, doc_text_length_limit, chunk_unit):
+        texts.append(text)
+        metadatas.append(metadata)
+    return texts, metadatas
+
+
+def load_and_split(
+        filename: str,
+        file_content_type: Optional[str],
+        file_path: str,
+        chunk_size: int,
+        chunk_overlap: int,
+        doc_text_length_limit: int = -1,
+        pdf_extract_images: bool = False,
+        chunk_unit: str = "char",
+) -> Tuple[List[str], List[dict], bool]:
+    """Parse and split a file, the CPU bound part of storing a document.
+
+    :return: texts, metadatas and whether the file type is known.
+    """
+    loader, known_type = get_loader(filename, file_content_type, file_path, pdf_extract_images)
+    texts, metadatas = split_data(load_data(loader), chunk_size, chunk_overlap, doc_text_length_limit, chunk_unit)
+    return texts, metadatas, known_type
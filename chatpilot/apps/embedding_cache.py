@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Persistent embedding cache for the RAG embedding functions
+
+Vectors are kept in a SQLite file keyed by (model, sha256 of text), so re-ingesting a document
+or re-asking a question does not call the embedding model again.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Sequence, cast
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from loguru import logger
+
+
+class EmbeddingCache:
+    """Embeddings in a SQLite file, bounded to max_size vectors, the least recently used are evicted first.
+
+    Vectors are stored as float32, shared by all workers on the same host.
+    """
+
+    # A hit refreshes its access time at most once in this many seconds, so reads rarely write
+    touch_interval = 60
+
+    def __init__(self, path: str, max_size: int = 100000):
+        """
+        :param path: SQLite file.
+        :param max_size: Max number of vectors, 0 disables the cache.
+        """
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding ("
+            "model TEXT NOT NULL, hash BLOB NOT NULL, vector BLOB NOT NULL, accessed REAL NOT NULL, "
+            "PRIMARY KEY (model, hash)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS embedding_accessed ON embedding (accessed)")
+        self._size = conn.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+
+    def __repr__(self):
+        return f"EmbeddingCache(path={self.path}, max_size={self.max_size}, size={self._size})"
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, model: str, hashes: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        """Cached vectors of the hashes that are in the cache."""
+        if self.max_size <= 0 or not hashes:
+            return {}
+        conn = self._conn()
+        found = {}
+        now = time.time()
+        for i in range(0, len(hashes), 500):
+            batch = list(hashes[i:i + 500])
+            marks = ", ".join("?" * len(batch))
+            for hash, vector in conn.execute(
+                    f"SELECT hash, vector FROM embedding WHERE model = ? AND hash IN ({marks})", (model, *batch)
+            ):
+                found[hash] = np.frombuffer(vector, dtype=np.float32)
+            if found:
+                conn.execute(
+                    f"UPDATE embedding SET accessed = ? WHERE model = ? AND hash IN ({marks}) AND accessed < ?",
+                    (now, model, *batch, now - self.touch_interval),
+                )
+        return found
+
+    def set_many(self, model: str, vectors: Dict[bytes, Sequence[float]]):
+        if self.max_size <= 0 or not vectors:
+            return
+        now = time.time()
+        conn = self._conn()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO embedding (model, hash, vector, accessed) VALUES (?, ?, ?, ?)",
+                    [
+                        (model, hash, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                        for hash, vector in vectors.items()
+                    ],
+                )
+                self._size += conn.total_changes - before
+                if self._size > self.max_size:
+                    self._evict(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self, conn: sqlite3.Connection):
+        # Other workers write too, recount before deleting; evict 10% more so this does not run on every insert
+        self._size = conn.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+        excess = self._size - int(self.max_size * 0.9)
+        if self._size > self.max_size and excess > 0:
+            conn.execute(
+                "DELETE FROM embedding WHERE (model, hash) IN "
+                "(SELECT model, hash FROM embedding ORDER BY accessed LIMIT ?)",
+                (excess,),
+            )
+            self._size -= excess
+            logger.debug(f"Evicted {excess} embeddings from {self.path}")
+
+    def clear(self):
+        self._conn().execute("DELETE FROM embedding")
+        self._size = 0
+
+
+def get_text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Wrap any embedding function, only the texts missing from the cache are sent to it."""
+
+    def __init__(self, embedding_function: EmbeddingFunction, model_name: str, cache: Optional[EmbeddingCache]):
+        """
+        :param embedding_function: The embedding function that computes the missing vectors.
+        :param model_name: Cache key of the model, texts embedded by another model never match.
+        :param cache: The cache, None computes every vector.
+        """
+        self.embedding_function = embedding_function
+        # Two embedding functions may load the same model name differently, such as the hash fallback
+        self.model_name = f"{type(embedding_function).__name__}/{model_name}"
+        self.cache = cache
+
+    def __repr__(self):
+        return f"CachedEmbeddingFunction(model_name={self.model_name}, cache={self.cache})"
+
+    @staticmethod
+    def name() -> str:
+        return "chatpilot_cached"
+
+    def _embed(self, input: Documents, model_name: str, embed) -> Embeddings:
+        if self.cache is None:
+            return embed(input)
+        hashes = [get_text_hash(text) for text in input]
+        vectors = self.cache.get_many(model_name, list(dict.fromkeys(hashes)))
+        missing = {}
+        for hash, text in zip(hashes, input):
+            if hash not in vectors:
+                missing.setdefault(hash, text)
+        if missing:
+            computed = embed(list(missing.values()))
+            new_vectors = dict(zip(missing, computed))
+            self.cache.set_many(model_name, new_vectors)
+            vectors.update(new_vectors)
+        return cast(Embeddings, [vectors[hash] for hash in hashes])
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return self._embed(input, self.model_name, self.embedding_function)
+
+    def embed_query(self, input: Documents) -> Embeddings:
+        # Models that embed queries differently keep those vectors apart
+        if type(self.embedding_function).embed_query is EmbeddingFunction.embed_query:
+            return self(input)
+        return self._embed(input, self.model_name + "/query", self.embedding_function.embed_query)
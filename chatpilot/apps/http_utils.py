@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Shared keep-alive http client for upstream calls
+"""
+from functools import partial
+from typing import Callable, Optional
+
+import aiohttp
+import anyio
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from loguru import logger
+
+from chatpilot.config import (
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+)
+
+
+async def get_error_detail(r: Optional[aiohttp.ClientResponse], e: Optional[Exception], prefix: str) -> str:
+    """Build the error detail from the upstream response body, such as `Ollama: model not found`."""
+    error_detail = "Server Connection Error"
+    if r is not None:
+        try:
+            res = await r.json(content_type=None)
+            if "error" in res:
+                error_detail = f"{prefix}: {res['error']}"
+        except Exception:
+            error_detail = f"{prefix}: {e}"
+    return error_detail
+
+
+class AsyncHttpClient:
+    """aiohttp session with a pooled keep-alive connector, one per app, created lazily on the running loop."""
+
+    def __init__(
+            self,
+            limit: int = HTTP_POOL_LIMIT,
+            limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+            connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+            read_timeout: float = HTTP_READ_TIMEOUT,
+    ):
+        """
+        :param limit: Max number of open connections.
+        :param limit_per_host: Max number of open connections to the same host.
+        :param connect_timeout: Seconds to wait for a connection from the pool and the TCP/TLS handshake.
+        :param read_timeout: Max seconds between two reads, streams may run longer than this in total.
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def __repr__(self):
+        return f"AsyncHttpClient(limit={self.limit}, limit_per_host={self.limit_per_host})"
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def request_stream(self, method: str, url: str, prefix: str = "External", **kwargs) -> aiohttp.ClientResponse:
+        """
+        Send a request and return the open response, the caller must consume it with `iter_response`.
+
+        :raises HTTPException: with the upstream status and error detail if the request failed.
+        """
+        r = None
+        try:
+            r = await self.session.request(method, url, **kwargs)
+            if r.status >= 400:
+                error_detail = await get_error_detail(r, Exception(r.reason), prefix)
+                raise HTTPException(status_code=r.status, detail=error_detail)
+            return r
+        except HTTPException:
+            r.release()
+            raise
+        except Exception as e:
+            logger.error(e)
+            raise HTTPException(status_code=500, detail=await get_error_detail(r, e, prefix))
+
+    async def request_json(self, method: str, url: str, prefix: str = "External", **kwargs):
+        """
+        Send a request and return the decoded json body.
+
+        :raises HTTPException: with the upstream status and error detail if the request failed.
+        """
+        r = await self.request_stream(method, url, prefix=prefix, **kwargs)
+        try:
+            return await r.json(content_type=None)
+        except Exception as e:
+            logger.error(e)
+            raise HTTPException(status_code=500, detail=f"{prefix}: {e}")
+        finally:
+            r.release()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+async def iter_response(r: aiohttp.ClientResponse, chunk_size: int = 8192):
+    """Yield the raw body of a streaming response, then hand the connection back to the pool."""
+    try:
+        async for chunk in r.content.iter_chunked(chunk_size):
+            yield chunk
+    finally:
+        r.release()
+
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    """StreamingResponse that stops as soon as the client disconnects and always closes its body iterator,
+    so the upstream stream is canceled instead of running on until the next chunk fails to send.
+
+    The `finally` of a body generator that never started does not run on close, such as when the client
+    is gone before the first chunk, so what the stream holds is freed by `on_close`, which always runs.
+    """
+
+    def __init__(self, content, *args, on_close: Optional[Callable[[], None]] = None, **kwargs):
+        super().__init__(content, *args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            async with anyio.create_task_group() as task_group:
+                async def wrap(func):
+                    await func()
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(wrap, partial(self.stream_response, send))
+                await wrap(partial(self.listen_for_disconnect, receive))
+        finally:
+            try:
+                if hasattr(self.body_iterator, "aclose"):
+                    await self.body_iterator.aclose()
+            finally:
+                if self.on_close is not None:
+                    self.on_close()
+
+        if self.background is not None:
+            await self.background()
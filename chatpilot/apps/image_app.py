@@ -5,7 +5,6 @@ import uuid
 from pathlib import Path
 from typing import Optional
 
-import requests
 from fastapi import (
     FastAPI,
     Request,
@@ -20,6 +19,7 @@ from chatpilot.apps.auth_utils import (
     get_current_user,
     get_admin_user
 )
+from chatpilot.apps.http_utils import AsyncHttpClient
 from chatpilot.config import (
     OPENAI_BASE_URL,
     OPENAI_API_KEY,
@@ -47,6 +47,7 @@ app.state.MODEL = "dall-e-3"
 
 app.state.IMAGE_SIZE = "1024x1024"
 app.state.IMAGE_STEPS = 50
+app.state.HTTP_CLIENT = AsyncHttpClient()
 
 
 @app.get("/config")
@@ -214,10 +215,9 @@ def save_b64_image(b64_str):
 
 
 @app.post("/generations")
-def generate_image(
+async def generate_image(
         form_data: GenerateImageForm, user=Depends(get_current_user),
 ):
-    r = None
     try:
         if app.state.ENGINE == "openai":
             api_key, base_url = app.state.OPENAI_API_KEY, app.state.OPENAI_BASE_URL
@@ -234,14 +234,14 @@ def generate_image(
             }
             image_url = f"{base_url}/images/generations"
             logger.debug(f"url: {image_url}, data: {data}, headers: {headers}")
-            r = requests.post(
-                url=image_url,
+            res = await app.state.HTTP_CLIENT.request_json(
+                "POST",
+                image_url,
+                prefix="External",
                 data=json.dumps(data),
                 headers=headers,
             )
-            logger.debug(f"request url: {image_url}, response: {r}")
-            r.raise_for_status()
-            res = r.json()
+            logger.debug(f"request url: {image_url}, response size: {len(res['data'])}")
 
             images = []
             for image in res["data"]:
@@ -253,8 +253,9 @@ def generate_image(
                     json.dump(data, f)
             return images
 
+    except HTTPException as e:
+        logger.error(e.detail)
+        raise HTTPException(status_code=400, detail=ERROR_MESSAGES.DEFAULT(e.detail))
     except Exception as e:
         logger.error(e)
-        if r:
-            logger.debug(r.json())
         raise HTTPException(status_code=400, detail=ERROR_MESSAGES.DEFAULT(e))
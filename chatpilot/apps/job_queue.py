@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Background jobs persisted in SQLite and run by an in-process worker pool
+
+A request submits a job and returns its id at once, the job runs in a worker thread and
+reports its progress to the job row, which any worker process can read.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from loguru import logger
+
+# handler(payload, progress) -> result, progress(done, total) reports how far the job is,
+# total is 0 if it is not known in advance, such as the chunks of a file split as they are embedded
+JobHandler = Callable[[dict, Callable[[int, int], None]], Any]
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    """Jobs in a SQLite file, run by a pool of worker threads.
+
+    Jobs left queued by a stopped process, or running without an update for `stale_after` seconds,
+    are run again by `resume`. A running job is touched every quarter of `stale_after`, so a long
+    step without progress, such as parsing a large PDF, is not taken as dead.
+    """
+
+    def __init__(self, path: str, workers: int = 2, stale_after: float = 600):
+        """
+        :param path: SQLite file.
+        :param workers: Number of jobs run at the same time.
+        :param stale_after: Seconds without an update after which a running job is taken as dead.
+        """
+        self.path = path
+        self.stale_after = stale_after
+        self.heartbeat_interval = stale_after / 4
+        self._handlers: Dict[str, JobHandler] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="job")
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS job ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id TEXT, status TEXT NOT NULL, "
+            "payload TEXT NOT NULL, result TEXT, error TEXT, done INTEGER NOT NULL DEFAULT 0, "
+            "total INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def __repr__(self):
+        return f"JobQueue(path={self.path}, kinds={list(self._handlers)})"
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def register(self, kind: str, handler: JobHandler):
+        self._handlers[kind] = handler
+
+    def submit(self, kind: str, payload: dict, user_id: Optional[str] = None) -> dict:
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        id = str(uuid.uuid4())
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO job (id, kind, user_id, status, payload, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (id, kind, user_id, QUEUED, json.dumps(payload), now, now),
+        )
+        self._executor.submit(self._run, id)
+        return self.get(id)
+
+    def resume(self) -> int:
+        """Queue again the jobs of a stopped process, return how many."""
+        stale = time.time() - self.stale_after
+        conn = self._conn()
+        conn.execute(
+            "UPDATE job SET status = ? WHERE status = ? AND updated_at < ?", (QUEUED, RUNNING, stale)
+        )
+        ids = [row["id"] for row in conn.execute("SELECT id FROM job WHERE status = ?", (QUEUED,))]
+        for id in ids:
+            self._executor.submit(self._run, id)
+        return len(ids)
+
+    def get(self, id: str) -> Optional[dict]:
+        row = self._conn().execute(
+            "SELECT id, kind, user_id, status, result, error, done, total, created_at, updated_at "
+            "FROM job WHERE id = ?",
+            (id,),
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def _update(self, id: str, **fields):
+        fields["updated_at"] = time.time()
+        self._conn().execute(
+            f"UPDATE job SET {', '.join(f'{key} = ?' for key in fields)} WHERE id = ?", (*fields.values(), id)
+        )
+
+    def _run(self, id: str):
+        conn = self._conn()
+        # Claim the job, another process resuming the same queue may have taken it
+        claimed = conn.execute(
+            "UPDATE job SET status = ?, updated_at = ? WHERE id = ? AND status = ?", (RUNNING, time.time(), id, QUEUED)
+        ).rowcount
+        if not claimed:
+            return
+        row = conn.execute("SELECT kind, payload FROM job WHERE id = ?", (id,)).fetchone()
+
+        def progress(done: int, total: int):
+            self._update(id, done=done, total=total)
+
+        stop = threading.Event()
+        if self.heartbeat_interval > 0:
+            threading.Thread(target=self._heartbeat, args=(id, stop), daemon=True, name="job-heartbeat").start()
+        try:
+            result = self._handlers[row["kind"]](json.loads(row["payload"]), progress)
+            self._update(id, status=DONE, result=json.dumps(result))
+        except Exception as e:
+            logger.error(f"Job {id} failed: {e}")
+            self._update(id, status=FAILED, error=str(e))
+        finally:
+            stop.set()
+
+    def _heartbeat(self, id: str, stop: threading.Event):
+        """Touch the job while it runs in this process."""
+        conn = self._conn()
+        try:
+            while not stop.wait(self.heartbeat_interval):
+                conn.execute("UPDATE job SET updated_at = ? WHERE id = ? AND status = ?", (time.time(), id, RUNNING))
+        finally:
+            conn.close()
+            self._local.conn = None
+
+    async def events(self, id: str, interval: float = 0.5) -> AsyncIterator[dict]:
+        """Yield the job each time it changes, until it is done or failed."""
+        updated_at = None
+        while True:
+            job = await run_in_threadpool(self.get, id)
+            if job is None:
+                return
+            if job["updated_at"] != updated_at:
+                updated_at = job["updated_at"]
+                yield job
+            if job["status"] in (DONE, FAILED):
+                return
+            await asyncio.sleep(interval)
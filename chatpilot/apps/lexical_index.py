@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: BM25 keyword index of the RAG chunks, next to their Chroma collections
+
+Chunks are cut into words with jieba and indexed in a SQLite FTS5 table, which ranks matches
+with bm25, so exact words and ids that the embedding misses are still found.
+"""
+import json
+import re
+import sqlite3
+import threading
+from typing import Iterable, List, Tuple
+
+import jieba
+
+# Runs of letters and digits, as the unicode61 tokenizer of the index splits them
+_word_pattern = re.compile(r"\w+")
+
+
+def get_tokens(text: str) -> List[str]:
+    """Words of a text, CJK words also cut into their shorter words, so a part of a name still matches."""
+    return [word for token in jieba.cut_for_search(text.lower()) for word in _word_pattern.findall(token)]
+
+
+def quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+class LexicalIndex:
+    """Chunks of all collections in one FTS5 table, a query is filtered by the collection column."""
+
+    # A query word in more than half of the chunks, and in at least this many, is not matched
+    common_term_chunks = 1000
+
+    def __init__(self, path: str):
+        """
+        :param path: SQLite file.
+        """
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        # Diacritics are kept, so the query words are the terms of the vocab table as they are
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunk USING fts5("
+            "text, collection, id UNINDEXED, document UNINDEXED, metadata UNINDEXED, "
+            "tokenize='unicode61 remove_diacritics 0')"
+        )
+        # Number of chunks with a term, and of chunks in a collection, to drop the terms bm25 does not weigh
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunk_vocab USING fts5vocab(chunk, 'col')")
+        conn.execute("CREATE TABLE IF NOT EXISTS collection (name TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+
+    def __repr__(self):
+        return f"LexicalIndex(path={self.path})"
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _insert(
+            conn: sqlite3.Connection, collection_name: str, ids: List[str], documents: List[str], metadatas: List[dict]
+    ):
+        conn.executemany(
+            "INSERT INTO chunk (text, collection, id, document, metadata) VALUES (?, ?, ?, ?, ?)",
+            [
+                (" ".join(get_tokens(document)), collection_name, id, document, json.dumps(metadata))
+                for id, document, metadata in zip(ids, documents, metadatas)
+            ],
+        )
+        conn.execute(
+            "INSERT INTO collection (name, size) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET size = size + excluded.size",
+            (collection_name, len(ids)),
+        )
+
+    @staticmethod
+    def _delete(conn: sqlite3.Connection, collection_name: str):
+        # The match finds the rows by index, the equality drops the names it matches as a phrase,
+        # such as `a b` of `a b c`
+        conn.execute(
+            "DELETE FROM chunk WHERE chunk MATCH ? AND collection = ?",
+            (f"collection : {quote(collection_name)}", collection_name),
+        )
+        conn.execute("DELETE FROM collection WHERE name = ?", (collection_name,))
+
+    def add(self, collection_name: str, ids: List[str], documents: List[str], metadatas: List[dict]):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert(conn, collection_name, ids, documents, metadatas)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete_collection(self, collection_name: str):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._delete(conn, collection_name)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def list_collection_names(self) -> List[str]:
+        return [row[0] for row in self._conn().execute("SELECT name FROM collection")]
+
+    def index_collection(
+            self, collection_name: str, batches: Iterable[Tuple[List[str], List[str], List[dict]]]
+    ) -> bool:
+        """
+        Add the chunks of a collection, batches of (ids, documents, metadatas), in one transaction.
+
+        Nothing is added if the collection is indexed already, such as by another process meanwhile.
+        :return: True if the collection was indexed.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM collection WHERE name = ?", (collection_name,)).fetchone():
+                conn.execute("ROLLBACK")
+                return False
+            for ids, documents, metadatas in batches:
+                self._insert(conn, collection_name, ids, documents, metadatas)
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM chunk")
+        conn.execute("DELETE FROM collection")
+
+    def _get_terms(self, conn: sqlite3.Connection, query: str) -> List[str]:
+        """
+        Words of the query worth matching.
+
+        bm25 gives no weight to a term in more than half of the chunks, in a large index matching it
+        would only rank many more rows. A term in no chunk matches nothing.
+        """
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM collection").fetchone()[0]
+        terms = []
+        for token in dict.fromkeys(get_tokens(query)):
+            row = conn.execute("SELECT doc FROM chunk_vocab WHERE term = ? AND col = 'text'", (token,)).fetchone()
+            if row is not None and (row[0] * 2 <= total or row[0] < self.common_term_chunks):
+                terms.append(token)
+        return terms
+
+    def query(self, collection_names: List[str], query: str, k: int) -> dict:
+        """
+        Top k chunks of the collections that have any word of the query, best bm25 first.
+
+        The result has the shape of a Chroma query result, the distances are the negated bm25 scores.
+        """
+        conn = self._conn()
+        terms = self._get_terms(conn, query) if collection_names and k > 0 else []
+        ids, distances, metadatas, documents = [], [], [], []
+        if terms:
+            collections = " OR ".join(quote(name) for name in collection_names)
+            match = f"collection : ({collections}) AND text : ({' OR '.join(quote(term) for term in terms)})"
+            marks = ", ".join("?" * len(collection_names))
+            for id, rank, document, metadata in conn.execute(
+                    f"SELECT id, rank, document, metadata FROM chunk WHERE chunk MATCH ? AND collection IN ({marks}) "
+                    f"ORDER BY rank LIMIT ?",
+                    (match, *collection_names, k),
+            ):
+                ids.append(id)
+                distances.append(rank)
+                documents.append(document)
+                metadatas.append(json.loads(metadata))
+        return {
+            "ids": [ids],
+            "distances": [distances],
+            "metadatas": [metadatas],
+            "documents": [documents],
+            "embeddings": None,
+            "uris": None,
+            "data": None,
+        }
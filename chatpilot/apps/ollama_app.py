@@ -5,21 +5,28 @@
 """
 import asyncio
 import json
-import random
+import time
 import uuid
 from typing import Optional, List, Union
 
 import aiohttp
-import requests
 from fastapi import FastAPI, Request, HTTPException, Depends, status
-from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from loguru import logger
 from pydantic import BaseModel, ConfigDict
 
 from chatpilot.apps.auth_utils import get_current_user, get_admin_user
-from chatpilot.config import OLLAMA_BASE_URLS, MODEL_FILTER_ENABLED, MODEL_FILTER_LIST
+from chatpilot.apps.balancer import LoadBalancer
+from chatpilot.apps.cache_utils import RefreshingCache
+from chatpilot.apps.http_utils import AsyncHttpClient, DisconnectAwareStreamingResponse, iter_response
+from chatpilot.config import (
+    OLLAMA_BASE_URLS,
+    MODEL_FILTER_ENABLED,
+    MODEL_FILTER_LIST,
+    MODEL_CATALOG_TTL,
+    MODEL_CATALOG_TIMEOUT,
+)
 from chatpilot.constants import ERROR_MESSAGES
 
 app = FastAPI()
@@ -36,16 +43,17 @@ app.state.MODEL_FILTER_LIST = MODEL_FILTER_LIST
 
 app.state.OLLAMA_BASE_URLS = OLLAMA_BASE_URLS
 app.state.MODELS = {}
+app.state.HTTP_CLIENT = AsyncHttpClient()
+app.state.BALANCER = LoadBalancer()
 
-REQUEST_POOL = []
+# request_id -> open upstream response of a running stream, closing it cancels the stream
+REQUEST_POOL = {}
 
 
 @app.middleware("http")
 async def check_url(request: Request, call_next):
-    if len(app.state.MODELS) == 0:
-        await get_all_models()
-    else:
-        pass
+    # Served from memory, only the very first request waits for the upstreams
+    await app.state.MODEL_CATALOG.get()
 
     response = await call_next(request)
     return response
@@ -63,16 +71,26 @@ class UrlUpdateForm(BaseModel):
 @app.post("/urls/update")
 async def update_ollama_api_url(form_data: UrlUpdateForm, user=Depends(get_admin_user)):
     app.state.OLLAMA_BASE_URLS = form_data.urls
+    app.state.BALANCER.reset()
+    app.state.MODEL_CATALOG.invalidate()
 
     logger.debug(f"update app.state.OLLAMA_BASE_URLS: {app.state.OLLAMA_BASE_URLS}")
     return {"OLLAMA_BASE_URLS": app.state.OLLAMA_BASE_URLS}
 
 
+@app.get("/balancer/stats")
+async def get_balancer_stats(user=Depends(get_admin_user)):
+    """Per node in-flight requests, time to first token, error rate and circuit state."""
+    return {"nodes": app.state.BALANCER.stats(app.state.OLLAMA_BASE_URLS)}
+
+
 @app.get("/cancel/{request_id}")
 async def cancel_ollama_request(request_id: str, user=Depends(get_current_user)):
     if user:
-        if request_id in REQUEST_POOL:
-            REQUEST_POOL.remove(request_id)
+        r = REQUEST_POOL.pop(request_id, None)
+        if r is not None:
+            # Close the upstream socket, Ollama stops generating as soon as it sees the disconnect
+            r.close()
         return True
     else:
         raise HTTPException(status_code=401, detail=ERROR_MESSAGES.ACCESS_PROHIBITED)
@@ -80,14 +98,115 @@ async def cancel_ollama_request(request_id: str, user=Depends(get_current_user))
 
 async def fetch_url(url):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                return await response.json()
+        timeout = aiohttp.ClientTimeout(total=MODEL_CATALOG_TIMEOUT)
+        async with app.state.HTTP_CLIENT.session.get(url, timeout=timeout) as response:
+            return await response.json()
     except Exception as e:
         logger.error(f"Connection error: {e}")
         return None
 
 
+def stream_response(
+        r: aiohttp.ClientResponse,
+        url_idx: int,
+        start_time: float,
+        send_request_id: bool,
+        id_key: str = "id",
+) -> StreamingResponse:
+    """
+    Proxy the upstream stream chunk by chunk, it is canceled by `/cancel/{request_id}` or by the client disconnect.
+
+    :param r: The open upstream response.
+    :param url_idx: The url index of the upstream node, releases it in the balancer when the stream ends.
+    :param start_time: The time the request was sent, to measure the time to first token.
+    :param send_request_id: If True, sends `{id_key: request_id, "done": False}` as the first line.
+    :param id_key: The key of the request id in the first line.
+    """
+    request_id = str(uuid.uuid4())
+    REQUEST_POOL[request_id] = r
+    released = False
+
+    def release(error: bool = False):
+        """Free the node and the connection once, when the stream ends or the response is closed."""
+        nonlocal released
+        if released:
+            return
+        released = True
+        REQUEST_POOL.pop(request_id, None)
+        app.state.BALANCER.release(url_idx, error=error)
+        if r.content.at_eof():
+            # Done, hand the connection back to the pool
+            r.release()
+        else:
+            # Canceled or client gone, drop the upstream connection
+            r.close()
+
+    async def stream_content():
+        error = False
+        try:
+            if send_request_id:
+                yield json.dumps({id_key: request_id, "done": False}) + "\n"
+            first_chunk = True
+            async for chunk in r.content.iter_chunked(8192):
+                if first_chunk:
+                    first_chunk = False
+                    app.state.BALANCER.record_ttft(url_idx, time.monotonic() - start_time)
+                yield chunk
+        except aiohttp.ClientError as e:
+            if request_id in REQUEST_POOL:
+                error = True
+                raise e
+            logger.debug("User: canceled request")
+        finally:
+            release(error)
+
+    # The response releases the stream too, if it is closed before the generator ever ran
+    return DisconnectAwareStreamingResponse(
+        stream_content(),
+        status_code=r.status,
+        media_type=r.headers.get("Content-Type"),
+        on_close=release,
+    )
+
+
+async def proxy_stream(
+        url_idx: int,
+        method: str,
+        path: str,
+        send_request_id: bool,
+        id_key: str = "id",
+        **kwargs,
+) -> StreamingResponse:
+    """Send a streaming request to the node of url_idx, tracking its load in the balancer."""
+    url = app.state.OLLAMA_BASE_URLS[url_idx]
+    logger.debug(url)
+
+    app.state.BALANCER.acquire(url_idx)
+    start_time = time.monotonic()
+    try:
+        r = await app.state.HTTP_CLIENT.request_stream(method, f"{url}/{path}", prefix="Ollama", **kwargs)
+    except HTTPException as e:
+        app.state.BALANCER.release(url_idx, error=e.status_code >= 500)
+        raise e
+    return stream_response(r, url_idx, start_time, send_request_id=send_request_id, id_key=id_key)
+
+
+async def request_json(url_idx: int, method: str, path: str, **kwargs):
+    """Send a request to the node of url_idx and return the json body, tracking its load in the balancer."""
+    url = app.state.OLLAMA_BASE_URLS[url_idx]
+    logger.debug(url)
+
+    app.state.BALANCER.acquire(url_idx)
+    error = False
+    try:
+        return await app.state.HTTP_CLIENT.request_json(method, f"{url}/{path}", prefix="Ollama", **kwargs)
+    except HTTPException as e:
+        error = e.status_code >= 500
+        raise e
+    finally:
+        app.state.BALANCER.release(url_idx, error=error)
+
+
 def merge_models_lists(model_lists):
     merged_models = {}
 
@@ -112,51 +231,42 @@ async def get_all_models():
             map(lambda response: response["models"], responses)
         )
     }
-    app.state.MODELS = {model["model"]: model for model in models["models"]}
     return models
 
 
+def set_models(models):
+    app.state.MODELS = {model["model"]: model for model in models["models"]}
+
+
+app.state.MODEL_CATALOG = RefreshingCache(
+    get_all_models, ttl=MODEL_CATALOG_TTL, name="ollama models", on_update=set_models
+)
+
+
 @app.get("/api/tags")
 @app.get("/api/tags/{url_idx}")
 async def get_ollama_tags(
         url_idx: Optional[int] = None, user=Depends(get_current_user)
 ):
     if url_idx is None:
-        models = await get_all_models()
+        models = await app.state.MODEL_CATALOG.get()
 
         if app.state.MODEL_FILTER_ENABLED:
             if user.role == "user":
-                models["models"] = list(
-                    filter(
-                        lambda model: model["name"] in app.state.MODEL_FILTER_LIST,
-                        models["models"],
-                    )
-                )
-                return models
+                # Filter a copy, the cached catalog is shared
+                return {
+                    **models,
+                    "models": list(
+                        filter(
+                            lambda model: model["name"] in app.state.MODEL_FILTER_LIST,
+                            models["models"],
+                        )
+                    ),
+                }
         return models
     else:
         url = app.state.OLLAMA_BASE_URLS[url_idx]
-        r = None
-        try:
-            r = requests.request(method="GET", url=f"{url}/api/tags")
-            r.raise_for_status()
-
-            return r.json()
-        except Exception as e:
-            logger.error(e)
-            error_detail = "Server Connection Error"
-            if r is not None:
-                try:
-                    res = r.json()
-                    if "error" in res:
-                        error_detail = f"Ollama: {res['error']}"
-                except:
-                    error_detail = f"Ollama: {e}"
-
-            raise HTTPException(
-                status_code=r.status_code if r else 500,
-                detail=error_detail,
-            )
+        return await app.state.HTTP_CLIENT.request_json("GET", f"{url}/api/tags", prefix="Ollama")
 
 
 @app.get("/api/version")
@@ -174,27 +284,16 @@ async def get_ollama_versions(url_idx: Optional[int] = None):
         return {"version": lowest_version["version"]}
     else:
         url = app.state.OLLAMA_BASE_URLS[url_idx]
-        r = None
-        try:
-            r = requests.request(method="GET", url=f"{url}/api/version")
-            r.raise_for_status()
-
-            return r.json()
-        except Exception as e:
-            logger.error(e)
-            error_detail = "Server Connection Error"
-            if r is not None:
-                try:
-                    res = r.json()
-                    if "error" in res:
-                        error_detail = f"Ollama: {res['error']}"
-                except:
-                    error_detail = f"Ollama: {e}"
+        return await app.state.HTTP_CLIENT.request_json("GET", f"{url}/api/version", prefix="Ollama")
 
-            raise HTTPException(
-                status_code=r.status_code if r else 500,
-                detail=error_detail,
-            )
+
+async def iter_model_change(r: aiohttp.ClientResponse):
+    """Stream the progress of a pull, push or create, then reload the models it changed."""
+    try:
+        async for chunk in iter_response(r):
+            yield chunk
+    finally:
+        app.state.MODEL_CATALOG.invalidate()
 
 
 class ModelNameForm(BaseModel):
@@ -209,51 +308,17 @@ async def pull_model(
     url = app.state.OLLAMA_BASE_URLS[url_idx]
     logger.debug(f"pull url: {url}")
 
-    r = None
-
-    def get_request():
-        nonlocal url
-        nonlocal r
-        try:
-
-            def stream_content():
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-
-            r = requests.request(
-                method="POST",
-                url=f"{url}/api/pull",
-                data=form_data.model_dump_json(exclude_none=True).encode(),
-                stream=True,
-            )
-
-            r.raise_for_status()
-
-            return StreamingResponse(
-                stream_content(),
-                status_code=r.status_code,
-                headers=dict(r.headers),
-            )
-        except Exception as e:
-            raise e
-
-    try:
-        return await run_in_threadpool(get_request)
-    except Exception as e:
-        logger.error(e)
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    r = await app.state.HTTP_CLIENT.request_stream(
+        "POST",
+        f"{url}/api/pull",
+        prefix="Ollama",
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
+    return StreamingResponse(
+        iter_model_change(r),
+        status_code=r.status,
+        media_type=r.headers.get("Content-Type"),
+    )
 
 
 class PushModelForm(BaseModel):
@@ -280,50 +345,18 @@ async def push_model(
 
     url = app.state.OLLAMA_BASE_URLS[url_idx]
     logger.debug(url)
-    r = None
-
-    def get_request():
-        nonlocal url
-        nonlocal r
-        try:
-
-            def stream_content():
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-
-            r = requests.request(
-                method="POST",
-                url=f"{url}/api/push",
-                data=form_data.model_dump_json(exclude_none=True).encode(),
-            )
-
-            r.raise_for_status()
-
-            return StreamingResponse(
-                stream_content(),
-                status_code=r.status_code,
-                headers=dict(r.headers),
-            )
-        except Exception as e:
-            raise e
 
-    try:
-        return await run_in_threadpool(get_request)
-    except Exception as e:
-        logger.error(e)
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    r = await app.state.HTTP_CLIENT.request_stream(
+        "POST",
+        f"{url}/api/push",
+        prefix="Ollama",
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
+    return StreamingResponse(
+        iter_model_change(r),
+        status_code=r.status,
+        media_type=r.headers.get("Content-Type"),
+    )
 
 
 class CreateModelForm(BaseModel):
@@ -342,53 +375,17 @@ async def create_model(
     url = app.state.OLLAMA_BASE_URLS[url_idx]
     logger.debug(url)
 
-    r = None
-
-    def get_request():
-        nonlocal url
-        nonlocal r
-        try:
-
-            def stream_content():
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-
-            r = requests.request(
-                method="POST",
-                url=f"{url}/api/create",
-                data=form_data.model_dump_json(exclude_none=True).encode(),
-                stream=True,
-            )
-
-            r.raise_for_status()
-
-            logger.debug(r)
-
-            return StreamingResponse(
-                stream_content(),
-                status_code=r.status_code,
-                headers=dict(r.headers),
-            )
-        except Exception as e:
-            raise e
-
-    try:
-        return await run_in_threadpool(get_request)
-    except Exception as e:
-        logger.debug(e)
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    r = await app.state.HTTP_CLIENT.request_stream(
+        "POST",
+        f"{url}/api/create",
+        prefix="Ollama",
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
+    return StreamingResponse(
+        iter_model_change(r),
+        status_code=r.status,
+        media_type=r.headers.get("Content-Type"),
+    )
 
 
 class CopyModelForm(BaseModel):
@@ -415,32 +412,14 @@ async def copy_model(
     url = app.state.OLLAMA_BASE_URLS[url_idx]
     logger.debug(url)
 
-    try:
-        r = requests.request(
-            method="POST",
-            url=f"{url}/api/copy",
-            data=form_data.model_dump_json(exclude_none=True).encode(),
-        )
-        r.raise_for_status()
-
-        logger.debug(r.text)
-
-        return True
-    except Exception as e:
-        logger.debug(e)
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    await app.state.HTTP_CLIENT.request_json(
+        "POST",
+        f"{url}/api/copy",
+        prefix="Ollama",
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
+    app.state.MODEL_CATALOG.invalidate()
+    return True
 
 
 @app.delete("/api/delete")
@@ -462,32 +441,14 @@ async def delete_model(
     url = app.state.OLLAMA_BASE_URLS[url_idx]
     logger.debug(url)
 
-    try:
-        r = requests.request(
-            method="DELETE",
-            url=f"{url}/api/delete",
-            data=form_data.model_dump_json(exclude_none=True).encode(),
-        )
-        r.raise_for_status()
-
-        logger.debug(r.text)
-
-        return True
-    except Exception as e:
-        logger.debug(e)
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    await app.state.HTTP_CLIENT.request_json(
+        "DELETE",
+        f"{url}/api/delete",
+        prefix="Ollama",
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
+    app.state.MODEL_CATALOG.invalidate()
+    return True
 
 
 @app.post("/api/show")
@@ -498,34 +459,13 @@ async def show_model_info(form_data: ModelNameForm, user=Depends(get_current_use
             detail=ERROR_MESSAGES.MODEL_NOT_FOUND(form_data.name),
         )
 
-    url_idx = random.choice(app.state.MODELS[form_data.name]["urls"])
-    url = app.state.OLLAMA_BASE_URLS[url_idx]
-    logger.debug(url)
-
-    try:
-        r = requests.request(
-            method="POST",
-            url=f"{url}/api/show",
-            data=form_data.model_dump_json(exclude_none=True).encode(),
-        )
-        r.raise_for_status()
-
-        return r.json()
-    except Exception as e:
-        logger.debug(e)
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    url_idx = app.state.BALANCER.pick(app.state.MODELS[form_data.name]["urls"])
+    return await request_json(
+        url_idx,
+        "POST",
+        "api/show",
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
 
 
 class GenerateEmbeddingsForm(BaseModel):
@@ -544,40 +484,19 @@ async def generate_embeddings(
 ):
     if url_idx is None:
         if form_data.model in app.state.MODELS:
-            url_idx = random.choice(app.state.MODELS[form_data.model]["urls"])
+            url_idx = app.state.BALANCER.pick(app.state.MODELS[form_data.model]["urls"])
         else:
             raise HTTPException(
                 status_code=400,
                 detail=ERROR_MESSAGES.MODEL_NOT_FOUND(form_data.model),
             )
 
-    url = app.state.OLLAMA_BASE_URLS[url_idx]
-    logger.debug(url)
-    r = None
-    try:
-        r = requests.request(
-            method="POST",
-            url=f"{url}/api/embeddings",
-            data=form_data.model_dump_json(exclude_none=True).encode(),
-        )
-        r.raise_for_status()
-
-        return r.json()
-    except Exception as e:
-        logger.debug(e)
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    return await request_json(
+        url_idx,
+        "POST",
+        "api/embeddings",
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
 
 
 class GenerateCompletionForm(BaseModel):
@@ -603,76 +522,20 @@ async def generate_completion(
 ):
     if url_idx is None:
         if form_data.model in app.state.MODELS:
-            url_idx = random.choice(app.state.MODELS[form_data.model]["urls"])
+            url_idx = app.state.BALANCER.pick(app.state.MODELS[form_data.model]["urls"])
         else:
             raise HTTPException(
                 status_code=400,
                 detail="error_detail",
             )
 
-    url = app.state.OLLAMA_BASE_URLS[url_idx]
-    logger.debug(url)
-
-    r = None
-
-    def get_request():
-        nonlocal form_data
-        nonlocal r
-
-        request_id = str(uuid.uuid4())
-        try:
-            REQUEST_POOL.append(request_id)
-
-            def stream_content():
-                try:
-                    if form_data.stream:
-                        yield json.dumps({"id": request_id, "done": False}) + "\n"
-
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if request_id in REQUEST_POOL:
-                            yield chunk
-                        else:
-                            logger.debug("User: canceled request")
-                            break
-                finally:
-                    if hasattr(r, "close"):
-                        r.close()
-                        if request_id in REQUEST_POOL:
-                            REQUEST_POOL.remove(request_id)
-
-            r = requests.request(
-                method="POST",
-                url=f"{url}/api/generate",
-                data=form_data.model_dump_json(exclude_none=True).encode(),
-                stream=True,
-            )
-
-            r.raise_for_status()
-
-            return StreamingResponse(
-                stream_content(),
-                status_code=r.status_code,
-                headers=dict(r.headers),
-            )
-        except Exception as e:
-            raise e
-
-    try:
-        return await run_in_threadpool(get_request)
-    except Exception as e:
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    return await proxy_stream(
+        url_idx,
+        "POST",
+        "api/generate",
+        send_request_id=form_data.stream,
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
 
 
 class ChatMessage(BaseModel):
@@ -700,79 +563,20 @@ async def generate_chat_completion(
 ):
     if url_idx is None:
         if form_data.model in app.state.MODELS:
-            url_idx = random.choice(app.state.MODELS[form_data.model]["urls"])
+            url_idx = app.state.BALANCER.pick(app.state.MODELS[form_data.model]["urls"])
         else:
             raise HTTPException(
                 status_code=400,
                 detail=ERROR_MESSAGES.MODEL_NOT_FOUND(form_data.model),
             )
 
-    url = app.state.OLLAMA_BASE_URLS[url_idx]
-    logger.debug(url)
-
-    r = None
-
-    # logger.debug(form_data.model_dump_json(exclude_none=True).encode())
-
-    def get_request():
-        nonlocal form_data
-        nonlocal r
-
-        request_id = str(uuid.uuid4())
-        try:
-            REQUEST_POOL.append(request_id)
-
-            def stream_content():
-                try:
-                    if form_data.stream:
-                        yield json.dumps({"id": request_id, "done": False}) + "\n"
-
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if request_id in REQUEST_POOL:
-                            yield chunk
-                        else:
-                            logger.debug("User: canceled request")
-                            break
-                finally:
-                    if hasattr(r, "close"):
-                        r.close()
-                        if request_id in REQUEST_POOL:
-                            REQUEST_POOL.remove(request_id)
-
-            r = requests.request(
-                method="POST",
-                url=f"{url}/api/chat",
-                data=form_data.model_dump_json(exclude_none=True).encode(),
-                stream=True,
-            )
-
-            r.raise_for_status()
-
-            return StreamingResponse(
-                stream_content(),
-                status_code=r.status_code,
-                headers=dict(r.headers),
-            )
-        except Exception as e:
-            logger.debug(e)
-            raise e
-
-    try:
-        return await run_in_threadpool(get_request)
-    except Exception as e:
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    return await proxy_stream(
+        url_idx,
+        "POST",
+        "api/chat",
+        send_request_id=form_data.stream,
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
 
 
 # TODO: we should update this part once Ollama supports other types
@@ -799,85 +603,25 @@ async def generate_openai_chat_completion(
 ):
     if url_idx is None:
         if form_data.model in app.state.MODELS:
-            url_idx = random.choice(app.state.MODELS[form_data.model]["urls"])
+            url_idx = app.state.BALANCER.pick(app.state.MODELS[form_data.model]["urls"])
         else:
             raise HTTPException(
                 status_code=400,
                 detail=ERROR_MESSAGES.MODEL_NOT_FOUND(form_data.model),
             )
 
-    url = app.state.OLLAMA_BASE_URLS[url_idx]
-    logger.debug(url)
-
-    r = None
-
-    def get_request():
-        nonlocal form_data
-        nonlocal r
-
-        request_id = str(uuid.uuid4())
-        try:
-            REQUEST_POOL.append(request_id)
-
-            def stream_content():
-                try:
-                    if form_data.stream:
-                        yield json.dumps(
-                            {"request_id": request_id, "done": False}
-                        ) + "\n"
-
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if request_id in REQUEST_POOL:
-                            yield chunk
-                        else:
-                            logger.debug("User: canceled request")
-                            break
-                finally:
-                    if hasattr(r, "close"):
-                        r.close()
-                        if request_id in REQUEST_POOL:
-                            REQUEST_POOL.remove(request_id)
-
-            r = requests.request(
-                method="POST",
-                url=f"{url}/v1/chat/completions",
-                data=form_data.model_dump_json(exclude_none=True).encode(),
-                stream=True,
-            )
-
-            r.raise_for_status()
-
-            return StreamingResponse(
-                stream_content(),
-                status_code=r.status_code,
-                headers=dict(r.headers),
-            )
-        except Exception as e:
-            raise e
-
-    try:
-        return await run_in_threadpool(get_request)
-    except Exception as e:
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    return await proxy_stream(
+        url_idx,
+        "POST",
+        "v1/chat/completions",
+        send_request_id=getattr(form_data, "stream", False),
+        id_key="request_id",
+        data=form_data.model_dump_json(exclude_none=True).encode(),
+    )
 
 
 @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
 async def deprecated_proxy(path: str, request: Request, user=Depends(get_current_user)):
-    url = app.state.OLLAMA_BASE_URLS[0]
-    target_url = f"{url}/{path}"
-
     body = await request.body()
     headers = dict(request.headers)
 
@@ -898,70 +642,21 @@ async def deprecated_proxy(path: str, request: Request, user=Depends(get_current
     headers.pop("authorization", None)
     headers.pop("origin", None)
     headers.pop("referer", None)
-
-    r = None
-
-    def get_request():
-        nonlocal r
-
-        request_id = str(uuid.uuid4())
-        try:
-            REQUEST_POOL.append(request_id)
-
-            def stream_content():
-                try:
-                    if path == "generate":
-                        data = json.loads(body.decode("utf-8"))
-
-                        if not ("stream" in data and data["stream"] == False):
-                            yield json.dumps({"id": request_id, "done": False}) + "\n"
-
-                    elif path == "chat":
-                        yield json.dumps({"id": request_id, "done": False}) + "\n"
-
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if request_id in REQUEST_POOL:
-                            yield chunk
-                        else:
-                            logger.debug("User: canceled request")
-                            break
-                finally:
-                    if hasattr(r, "close"):
-                        r.close()
-                        if request_id in REQUEST_POOL:
-                            REQUEST_POOL.remove(request_id)
-
-            r = requests.request(
-                method=request.method,
-                url=target_url,
-                data=body,
-                headers=headers,
-                stream=True,
-            )
-
-            r.raise_for_status()
-
-            return StreamingResponse(
-                stream_content(),
-                status_code=r.status_code,
-                headers=dict(r.headers),
-            )
-        except Exception as e:
-            raise e
-
-    try:
-        return await run_in_threadpool(get_request)
-    except Exception as e:
-        error_detail = "Server Connection Error"
-        if r is not None:
-            try:
-                res = r.json()
-                if "error" in res:
-                    error_detail = f"Ollama: {res['error']}"
-            except:
-                error_detail = f"Ollama: {e}"
-
-        raise HTTPException(
-            status_code=r.status_code if r else 500,
-            detail=error_detail,
-        )
+    headers.pop("content-length", None)
+
+    send_request_id = False
+    if path == "generate":
+        data = json.loads(body.decode("utf-8"))
+        if not ("stream" in data and data["stream"] == False):
+            send_request_id = True
+    elif path == "chat":
+        send_request_id = True
+
+    return await proxy_stream(
+        0,
+        request.method,
+        path,
+        send_request_id=send_request_id,
+        data=body,
+        headers=headers,
+    )
@@ -7,25 +7,26 @@ import asyncio
 import hashlib
 import json
 import time
-from collections import defaultdict
-from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List, Optional
 
 import aiohttp
-import requests
 from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, StreamingResponse
 from langchain_core.messages import AIMessage, HumanMessage
 from loguru import logger
 from pydantic import BaseModel
 
-from chatpilot.agentica_agent import AgenticaAgent
+from chatpilot.agentica_agent import AgenticaAgent, AgentPool
 from chatpilot.apps.auth_utils import (
     get_current_user,
     get_admin_user,
 )
+from chatpilot.apps.cache_utils import RefreshingCache
+from chatpilot.apps.http_utils import AsyncHttpClient, DisconnectAwareStreamingResponse, iter_response
+from chatpilot.apps.rate_limit import RateLimiter, get_rate_limit_backend
 from chatpilot.config import (
     OPENAI_BASE_URL,
     OPENAI_API_KEY,
@@ -36,7 +37,12 @@ from chatpilot.config import (
     SERPER_API_KEY,
     RPD,
     RPM,
+    RATE_LIMIT_BACKEND,
+    RATE_LIMIT_DB_PATH,
+    RATE_LIMIT_REDIS_URL,
     MODEL_TYPE,
+    MODEL_CATALOG_TTL,
+    MODEL_CATALOG_TIMEOUT,
 )
 from chatpilot.constants import ERROR_MESSAGES
 
@@ -54,16 +60,18 @@ app.state.MODEL_FILTER_LIST = MODEL_FILTER_LIST
 
 app.state.OPENAI_API_KEY = OPENAI_API_KEY
 app.state.OPENAI_BASE_URL = OPENAI_BASE_URL
+app.state.HTTP_CLIENT = AsyncHttpClient()
 
 # Get all models
 app.state.MODELS = {}
 
-# Agent for Assistant
-app.state.AGENT = None
-app.state.MODEL_NAME = None
+# Agents for Assistant, one warm agent per conversation
+app.state.AGENT_POOL = AgentPool()
 
-# User request tracking
-user_request_tracker = defaultdict(lambda: {"daily": [], "minute": []})
+# Per user request counters, constant size state whatever RPD/RPM is
+app.state.RATE_LIMITER = RateLimiter(
+    get_rate_limit_backend(RATE_LIMIT_BACKEND, sqlite_path=RATE_LIMIT_DB_PATH, redis_url=RATE_LIMIT_REDIS_URL)
+)
 
 
 async def request_rate_limiter(
@@ -76,38 +84,24 @@ async def request_rate_limiter(
         # 如果RPD和RPM都设置为-1，则不限制请求
         return
 
-    now = datetime.now()
-    today = now.date()
-    current_minute = now.replace(second=0, microsecond=0)
-
-    user_requests = user_request_tracker[user.id]
-
-    # 如果不是无限制，则进行请求记录和限制检查
-    if max_daily_requests > 0:
-        # 清理过期的每日请求记录
-        user_requests["daily"] = [dt for dt in user_requests["daily"] if dt.date() == today]
-        # 检查每日请求限制
-        if len(user_requests["daily"]) >= max_daily_requests:
-            logger.warning(f"Reach request rate limit, user: {user.email}, RPD: {max_daily_requests}")
-            raise HTTPException(status_code=429, detail=ERROR_MESSAGES.RPD_LIMIT)
-
-    if max_minute_requests > 0:
-        # 清理过期的每分钟请求记录
-        user_requests["minute"] = [dt for dt in user_requests["minute"] if dt > current_minute - timedelta(minutes=1)]
-        # 检查每分钟请求限制
-        if len(user_requests["minute"]) >= max_minute_requests:
-            logger.warning(f"Reach request rate limit, user: {user.email}, RPM: {max_minute_requests}")
-            raise HTTPException(status_code=429, detail=ERROR_MESSAGES.RPM_LIMIT)
+    limiter = app.state.RATE_LIMITER
+    if limiter.backend.blocking:
+        reached = await run_in_threadpool(limiter.acquire, user.id, max_daily_requests, max_minute_requests)
+    else:
+        reached = limiter.acquire(user.id, max_daily_requests, max_minute_requests)
 
-    # 记录新的请求
-    user_requests["daily"].append(now)
-    user_requests["minute"].append(now)
+    if reached == "RPD":
+        logger.warning(f"Reach request rate limit, user: {user.email}, RPD: {max_daily_requests}")
+        raise HTTPException(status_code=429, detail=ERROR_MESSAGES.RPD_LIMIT)
+    if reached == "RPM":
+        logger.warning(f"Reach request rate limit, user: {user.email}, RPM: {max_minute_requests}")
+        raise HTTPException(status_code=429, detail=ERROR_MESSAGES.RPM_LIMIT)
 
 
 @app.middleware("http")
 async def check_url(request: Request, call_next):
-    if len(app.state.MODELS) == 0:
-        await get_all_models()
+    # Served from memory, only the very first request waits for the upstream
+    await app.state.MODEL_CATALOG.get()
 
     response = await call_next(request)
     return response
@@ -129,6 +123,7 @@ async def get_openai_urls(user=Depends(get_admin_user)):
 @app.post("/urls/update")
 async def update_openai_urls(form_data: UrlsUpdateForm, user=Depends(get_admin_user)):
     app.state.OPENAI_BASE_URL = form_data.urls
+    app.state.MODEL_CATALOG.invalidate()
     logger.info(f"update app.state.OPENAI_BASE_URL: {app.state.OPENAI_BASE_URL}")
     return {"OPENAI_BASE_URL": app.state.OPENAI_BASE_URL}
 
@@ -141,6 +136,7 @@ async def get_openai_keys(user=Depends(get_admin_user)):
 @app.post("/keys/update")
 async def update_openai_key(form_data: KeysUpdateForm, user=Depends(get_admin_user)):
     app.state.OPENAI_API_KEY = form_data.keys[0]
+    app.state.MODEL_CATALOG.invalidate()
     logger.info(f"update app.state.OPENAI_API_KEY: {app.state.OPENAI_API_KEY}")
     return {"OPENAI_API_KEY": app.state.OPENAI_API_KEY}
 
@@ -151,7 +147,6 @@ async def speech(
         user=Depends(get_current_user),
         rate_limit=Depends(request_rate_limiter),
 ):
-    r = None
     try:
         api_key, base_url = app.state.OPENAI_API_KEY, app.state.OPENAI_BASE_URL
         body = await request.body()
@@ -168,38 +163,23 @@ async def speech(
 
         headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
 
-        try:
-            r = requests.post(
-                url=f"{base_url}/audio/speech",
-                data=body,
-                headers=headers,
-                stream=True,
-            )
-            r.raise_for_status()
-
-            # Save the streaming content to a file
-            with open(file_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-
-            with open(file_body_path, "w") as f:
-                json.dump(json.loads(body.decode("utf-8")), f)
-
-            # Return the saved file
-            return FileResponse(file_path)
+        r = await app.state.HTTP_CLIENT.request_stream(
+            "POST",
+            f"{base_url}/audio/speech",
+            prefix="External",
+            data=body,
+            headers=headers,
+        )
+        # Save the streaming content to a file
+        with open(file_path, "wb") as f:
+            async for chunk in iter_response(r):
+                f.write(chunk)
 
-        except Exception as e:
-            logger.error(e)
-            error_detail = "Server Connection Error"
-            if r is not None:
-                try:
-                    res = r.json()
-                    if "error" in res:
-                        error_detail = f"External: {res['error']}"
-                except:
-                    error_detail = f"External: {e}"
+        with open(file_body_path, "w") as f:
+            json.dump(json.loads(body.decode("utf-8")), f)
 
-            raise HTTPException(status_code=r.status_code, detail=error_detail)
+        # Return the saved file
+        return FileResponse(file_path)
 
     except ValueError:
         raise HTTPException(status_code=401, detail=ERROR_MESSAGES.OPENAI_NOT_FOUND)
@@ -208,9 +188,9 @@ async def speech(
 async def fetch_url(url, key):
     try:
         headers = {"Authorization": f"Bearer {key}"}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                return await response.json()
+        timeout = aiohttp.ClientTimeout(total=MODEL_CATALOG_TIMEOUT)
+        async with app.state.HTTP_CLIENT.session.get(url, headers=headers, timeout=timeout) as response:
+            return await response.json()
     except Exception as e:
         logger.error(f"Connection error: {e}")
         return None
@@ -249,59 +229,50 @@ async def get_all_models():
                     list(map(lambda response: response["data"], responses))
                 )
             }
+    return models
+
+
+def set_models(models):
     app.state.MODELS = {model["id"]: model for model in models["data"]}
     logger.debug(f"get_all_models done, size: {len(app.state.MODELS)}, {app.state.MODELS.keys()}")
-    return models
+
+
+app.state.MODEL_CATALOG = RefreshingCache(
+    get_all_models, ttl=MODEL_CATALOG_TTL, name="openai models", on_update=set_models
+)
 
 
 @app.get("/models")
 @app.get("/models/{url_idx}")
 async def get_models(url_idx: Optional[int] = None, user=Depends(get_current_user)):
-    r = None
     if url_idx is None:
-        models = await get_all_models()
+        models = await app.state.MODEL_CATALOG.get()
         if app.state.MODEL_FILTER_ENABLED:
             if user.role == "user":
-                models["data"] = list(
-                    filter(
-                        lambda model: model["id"] in app.state.MODEL_FILTER_LIST,
-                        models["data"],
-                    )
-                )
-                return models
+                # Filter a copy, the cached catalog is shared
+                return {
+                    **models,
+                    "data": list(
+                        filter(
+                            lambda model: model["id"] in app.state.MODEL_FILTER_LIST,
+                            models["data"],
+                        )
+                    ),
+                }
         return models
     else:
-        try:
-            logger.debug(f"get_models url_idx: {url_idx}")
-            url = app.state.OPENAI_BASE_URL
-            r = requests.request(method="GET", url=f"{url}/models")
-            r.raise_for_status()
-
-            response_data = r.json()
-            if url:
-                response_data["data"] = list(
-                    filter(lambda model: model["id"], response_data["data"])
-                )
-
-            return response_data
-        except Exception as e:
-            logger.error(e)
-            error_detail = "Server Connection Error"
-            if r is not None:
-                try:
-                    res = r.json()
-                    if "error" in res:
-                        error_detail = f"External: {res['error']}"
-                except:
-                    error_detail = f"External: {e}"
-
-            raise HTTPException(
-                status_code=r.status_code if r else 500,
-                detail=error_detail,
+        logger.debug(f"get_models url_idx: {url_idx}")
+        url = app.state.OPENAI_BASE_URL
+        response_data = await app.state.HTTP_CLIENT.request_json("GET", f"{url}/models", prefix="External")
+        if url:
+            response_data["data"] = list(
+                filter(lambda model: model["id"], response_data["data"])
             )
 
+        return response_data
+
 
-def proxy_other_request(api_key, base_url, path, body, method):
+async def proxy_other_request(api_key, base_url, path, body, method):
     """Proxy the request to OpenAI API with a modified body for gpt-4-vision-preview model."""
     # Try to decode the body of the request from bytes to a UTF-8 string (Require add max_token to fix gpt-4-vision)
     try:
@@ -332,23 +303,27 @@ def proxy_other_request(api_key, base_url, path, body, method):
 
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
 
-    r = requests.request(
-        method=method,
-        url=target_url,
+    r = await app.state.HTTP_CLIENT.request_stream(
+        method,
+        target_url,
+        prefix="External",
         data=body,
         headers=headers,
-        stream=True,
     )
-    r.raise_for_status()
     # Check if response is SSE
     if "text/event-stream" in r.headers.get("Content-Type", ""):
-        return StreamingResponse(
-            r.iter_content(chunk_size=8192),
-            status_code=r.status_code,
-            headers=dict(r.headers),
+        # The response releases the stream too, if it is closed before the generator ever ran
+        return DisconnectAwareStreamingResponse(
+            iter_response(r),
+            status_code=r.status,
+            media_type=r.headers.get("Content-Type"),
+            on_close=r.release,
         )
     else:
-        response_data = r.json()
+        try:
+            response_data = await r.json(content_type=None)
+        finally:
+            r.release()
         return response_data
 
 
@@ -369,8 +344,7 @@ async def proxy(
         body_dict = json.loads(body.decode("utf-8"))
 
         model_name = body_dict.get('model', DEFAULT_MODELS[0] if DEFAULT_MODELS else "gpt-3.5-turbo")
-        if app.state.MODEL_NAME is None:
-            app.state.MODEL_NAME = model_name
+        chat_id = body_dict.get("chat_id", "")
         max_tokens = body_dict.get("max_tokens", 1024)
         temperature = body_dict.get("temperature", 0.7)
         num_ctx = body_dict.get('num_ctx', 1024)
@@ -393,33 +367,37 @@ async def proxy(
         if messages and messages[-1]["role"] == "user":
             user_question = messages[-1]["content"]
 
-        # Init Agent when first request
-        if app.state.AGENT is None:
-            chat_agent = AgenticaAgent(model_type=MODEL_TYPE, model_name=model_name, system_prompt=system_prompt)
-            app.state.AGENT = chat_agent
-            logger.debug(chat_agent)
-        elif app.state.MODEL_NAME != model_name:
-            chat_agent = AgenticaAgent(model_type=MODEL_TYPE, model_name=model_name, system_prompt=system_prompt)
-            app.state.AGENT = chat_agent
-            app.state.MODEL_NAME = model_name
-            logger.debug(chat_agent)
+        def build_agent():
+            return AgenticaAgent(model_type=MODEL_TYPE, model_name=model_name, system_prompt=system_prompt)
+
+        if chat_id:
+            # Reuse the warm agent of this conversation, build it on first request
+            agent_key = (user.id, chat_id, model_name, hashlib.sha256(system_prompt.encode("utf-8")).hexdigest())
+            chat_agent = app.state.AGENT_POOL.get(agent_key, build_agent)
+            agent_lock = app.state.AGENT_POOL.lock(agent_key)
         else:
-            if history:
-                chat_agent = app.state.AGENT
-            else:
-                chat_agent = AgenticaAgent(model_type=MODEL_TYPE, model_name=model_name,
-                                           system_prompt=system_prompt)
-                app.state.AGENT = chat_agent
-        events = chat_agent.stream_run(user_question)
-
-        def event_generator():
-            """组装为OpenAI格式流式输出"""
+            # No conversation to continue, such as an API call, a pooled agent would be shared by all of them
+            chat_agent = build_agent()
+            agent_lock = asyncio.Lock()
+        logger.debug(f"{chat_agent}, {app.state.AGENT_POOL}")
+
+        async def event_generator():
+            # One request at a time per agent, concurrent ones would interleave its memory
+            async with agent_lock:
+                if not history:
+                    # New conversation, drop the memory of the previous one
+                    chat_agent.reset()
+                async for data in format_events(chat_agent.astream_run(user_question)):
+                    yield data
+
+        async def format_events(events):
+            """组装为OpenAI格式流式输出, 异步迭代agent事件, 不占用线程池"""
             created = int(time.time())
             in_reasoning_phase = True  # 初始状态是思考阶段
             thinking_tag_sent = False  # 是否已发送思考开始标记
             thinking_end_tag_sent = False  # 是否已发送思考结束标记
 
-            for event in events:
+            async for event in events:
                 if event is None:
                     continue
 
@@ -6,11 +6,14 @@
 import hashlib
 import json
 import mimetypes
+import multiprocessing
 import os
 import shutil
-import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import tee
 from pathlib import Path
-from typing import List, Optional, cast
+from stat import S_ISREG
+from typing import Callable, Dict, Iterable, List, Literal, Optional, cast
 
 from chromadb.api.types import Documents as ChromaDocuments
 from chromadb.api.types import (
@@ -32,41 +35,58 @@ from fastapi import (
     Form,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from langchain_community.document_loaders import (
-    WebBaseLoader,
-    TextLoader,
-    PyPDFLoader,
-    CSVLoader,
-    Docx2txtLoader,
-    UnstructuredEPubLoader,
-    UnstructuredMarkdownLoader,
-    UnstructuredXMLLoader,
-    UnstructuredRSTLoader,
-    UnstructuredExcelLoader,
-)
+from fastapi.responses import StreamingResponse
+from langchain_community.document_loaders import WebBaseLoader
 from loguru import logger
 from pydantic import BaseModel
 
 from chatpilot.apps.auth_utils import get_current_user, get_admin_user
+from chatpilot.apps.doc_utils import get_loader, iter_split_data, load_and_split, load_data
+from chatpilot.apps.embedding_cache import CachedEmbeddingFunction, EmbeddingCache
+from chatpilot.apps.job_queue import JobQueue
 from chatpilot.apps.misc import (
     calculate_sha256,
     calculate_sha256_string,
     sanitize_filename,
     extract_folders_after_data_docs,
 )
-from chatpilot.apps.rag_utils import query_doc, query_collection, ChineseRecursiveTextSplitter, CHROMA_CLIENT
+from chatpilot.apps.rag_utils import (
+    query_doc,
+    query_collection,
+    add_texts_in_batches,
+    backfill_lexical_index,
+    delete_collection,
+    reset_collections,
+    LEXICAL_INDEX,
+    VECTOR_STORE,
+)
+from chatpilot.apps.vector_store import CollectionExistsError
 from chatpilot.apps.web.models.documents import (
     Documents,
     DocumentForm,
+    DocFiles,
+    DocFileModel,
 )
 from chatpilot.config import (
     UPLOAD_DIR,
     DOCS_DIR,
     RAG_EMBEDDING_MODEL,
+    RAG_EMBEDDING_CACHE_SIZE,
+    RAG_EMBEDDING_CACHE_PATH,
+    RAG_EMBEDDING_BATCH_SIZE,
+    RAG_EMBEDDING_CONCURRENCY,
+    RAG_JOB_DB_PATH,
+    RAG_JOB_WORKERS,
+    RAG_SCAN_PROCESSES,
     CHUNK_SIZE,
     CHUNK_OVERLAP,
+    CHUNK_UNIT,
     RAG_TEMPLATE,
     RAG_TOP_K,
+    RAG_SEARCH_MODE,
+    RAG_CONTEXT_MAX_TOKENS,
+    RAG_CONTEXT_MODEL_MAX_TOKENS,
+    RAG_CONTEXT_MIN_SCORE_RATIO,
     OPENAI_API_KEY,
     OPENAI_BASE_URL,
     DOC_TEXT_LENGTH_LIMIT,
@@ -78,11 +98,23 @@ app = FastAPI()
 app.state.PDF_EXTRACT_IMAGES = False
 app.state.CHUNK_SIZE = CHUNK_SIZE
 app.state.CHUNK_OVERLAP = CHUNK_OVERLAP
+app.state.CHUNK_UNIT = CHUNK_UNIT
 app.state.RAG_TEMPLATE = RAG_TEMPLATE
 app.state.RAG_EMBEDDING_MODEL = RAG_EMBEDDING_MODEL
 app.state.TOP_K = RAG_TOP_K
+app.state.SEARCH_MODE = RAG_SEARCH_MODE
+app.state.CONTEXT_MAX_TOKENS = RAG_CONTEXT_MAX_TOKENS
+app.state.CONTEXT_MODEL_MAX_TOKENS = RAG_CONTEXT_MODEL_MAX_TOKENS
+app.state.CONTEXT_MIN_SCORE_RATIO = RAG_CONTEXT_MIN_SCORE_RATIO
 app.state.OPENAI_API_KEY = OPENAI_API_KEY
 app.state.OPENAI_BASE_URL = OPENAI_BASE_URL
+app.state.EMBEDDING_BATCH_SIZE = RAG_EMBEDDING_BATCH_SIZE
+app.state.EMBEDDING_CONCURRENCY = RAG_EMBEDDING_CONCURRENCY
+app.state.SCAN_PROCESSES = RAG_SCAN_PROCESSES
+app.state.JOB_QUEUE = JobQueue(RAG_JOB_DB_PATH, RAG_JOB_WORKERS)
+app.state.EMBEDDING_CACHE = (
+    EmbeddingCache(RAG_EMBEDDING_CACHE_PATH, RAG_EMBEDDING_CACHE_SIZE) if RAG_EMBEDDING_CACHE_SIZE > 0 else None
+)
 
 
 class LiteralHashEmbeddingFunction(EmbeddingFunction[ChromaDocuments]):
@@ -135,6 +167,9 @@ elif "w2v" in app.state.RAG_EMBEDDING_MODEL:
     )
 else:
     app.state.sentence_transformer_ef = LiteralHashEmbeddingFunction()
+app.state.sentence_transformer_ef = CachedEmbeddingFunction(
+    app.state.sentence_transformer_ef, app.state.RAG_EMBEDDING_MODEL, app.state.EMBEDDING_CACHE
+)
 
 origins = ["*"]
 
@@ -157,37 +192,56 @@ class StoreWebForm(CollectionNameForm):
     url: str
 
 
-def store_data_in_vector_db(data, collection_name, overwrite: bool = False) -> bool:
-    text_splitter = ChineseRecursiveTextSplitter(
-        chunk_size=app.state.CHUNK_SIZE, chunk_overlap=app.state.CHUNK_OVERLAP,
-        doc_text_length_limit=DOC_TEXT_LENGTH_LIMIT
+def store_data_in_vector_db(
+        data, collection_name, overwrite: bool = False, progress: Optional[Callable[[int], None]] = None
+) -> bool:
+    # The chunks are split as the batches are taken for embedding
+    chunks = iter_split_data(
+        data, app.state.CHUNK_SIZE, app.state.CHUNK_OVERLAP, DOC_TEXT_LENGTH_LIMIT, app.state.CHUNK_UNIT
+    )
+    texts, metadatas = tee(chunks)
+    return store_texts_in_vector_db(
+        (text for text, _ in texts), (metadata for _, metadata in metadatas), collection_name, overwrite, progress
     )
-    docs = text_splitter.split_documents(data)
 
-    texts = [doc.page_content for doc in docs]
-    metadatas = [doc.metadata for doc in docs]
 
+def store_texts_in_vector_db(
+        texts: Iterable[str],
+        metadatas: Iterable[dict],
+        collection_name: str,
+        overwrite: bool = False,
+        progress: Optional[Callable[[int], None]] = None,
+) -> bool:
     try:
-        if overwrite:
-            for collection in CHROMA_CLIENT.list_collections():
-                if collection_name == collection.name:
-                    logger.debug(f"deleting existing collection {collection_name}")
-                    CHROMA_CLIENT.delete_collection(name=collection_name)
-
-        collection = CHROMA_CLIENT.create_collection(
-            name=collection_name,
-            embedding_function=app.state.sentence_transformer_ef,
-        )
+        if overwrite and collection_name in VECTOR_STORE.list_collection_names():
+            logger.debug(f"deleting existing collection {collection_name}")
+            delete_collection(collection_name)
+
+        collection = VECTOR_STORE.create_collection(collection_name)
+    except CollectionExistsError as e:
+        # Stored already, such as the same file uploaded again
+        logger.debug(e)
+        return True
+    except Exception as e:
+        logger.error(e)
+        return False
 
-        collection.add(
-            documents=texts, metadatas=metadatas, ids=[str(uuid.uuid1()) for _ in texts]
+    try:
+        add_texts_in_batches(
+            collection,
+            texts,
+            metadatas,
+            app.state.sentence_transformer_ef,
+            batch_size=app.state.EMBEDDING_BATCH_SIZE,
+            concurrency=app.state.EMBEDDING_CONCURRENCY,
+            progress=progress,
+            lexical_index=LEXICAL_INDEX,
         )
         return True
     except Exception as e:
         logger.error(e)
-        if e.__class__.__name__ == "UniqueConstraintError":
-            return True
-
+        # Do not keep a half written collection, the document can be stored again
+        delete_collection(collection_name)
         return False
 
 
@@ -243,6 +297,9 @@ async def update_embedding_model(
         )
     else:
         app.state.sentence_transformer_ef = LiteralHashEmbeddingFunction()
+    app.state.sentence_transformer_ef = CachedEmbeddingFunction(
+        app.state.sentence_transformer_ef, app.state.RAG_EMBEDDING_MODEL, app.state.EMBEDDING_CACHE
+    )
     logger.debug(f"Update app.state.sentence_transformer_ef: {app.state.sentence_transformer_ef}")
 
     return {
@@ -259,6 +316,7 @@ async def get_rag_config(user=Depends(get_admin_user)):
         "chunk": {
             "chunk_size": app.state.CHUNK_SIZE,
             "chunk_overlap": app.state.CHUNK_OVERLAP,
+            "chunk_unit": app.state.CHUNK_UNIT,
         },
     }
 
@@ -266,6 +324,7 @@ async def get_rag_config(user=Depends(get_admin_user)):
 class ChunkParamUpdateForm(BaseModel):
     chunk_size: int
     chunk_overlap: int
+    chunk_unit: Optional[Literal["char", "token"]] = None
 
 
 class ConfigUpdateForm(BaseModel):
@@ -278,6 +337,7 @@ async def update_rag_config(form_data: ConfigUpdateForm, user=Depends(get_admin_
     app.state.PDF_EXTRACT_IMAGES = form_data.pdf_extract_images
     app.state.CHUNK_SIZE = form_data.chunk.chunk_size
     app.state.CHUNK_OVERLAP = form_data.chunk.chunk_overlap
+    app.state.CHUNK_UNIT = form_data.chunk.chunk_unit if form_data.chunk.chunk_unit else CHUNK_UNIT
 
     return {
         "status": True,
@@ -285,6 +345,7 @@ async def update_rag_config(form_data: ConfigUpdateForm, user=Depends(get_admin_
         "chunk": {
             "chunk_size": app.state.CHUNK_SIZE,
             "chunk_overlap": app.state.CHUNK_OVERLAP,
+            "chunk_unit": app.state.CHUNK_UNIT,
         },
     }
 
@@ -303,12 +364,14 @@ async def get_query_settings(user=Depends(get_admin_user)):
         "status": True,
         "template": app.state.RAG_TEMPLATE,
         "k": app.state.TOP_K,
+        "mode": app.state.SEARCH_MODE,
     }
 
 
 class QuerySettingsForm(BaseModel):
     k: Optional[int] = None
     template: Optional[str] = None
+    mode: Optional[Literal["vector", "hybrid"]] = None
 
 
 @app.post("/query/settings/update")
@@ -317,6 +380,7 @@ async def update_query_settings(
 ):
     app.state.RAG_TEMPLATE = form_data.template if form_data.template else RAG_TEMPLATE
     app.state.TOP_K = form_data.k if form_data.k else 4
+    app.state.SEARCH_MODE = form_data.mode if form_data.mode else RAG_SEARCH_MODE
     return {"status": True, "template": app.state.RAG_TEMPLATE}
 
 
@@ -324,6 +388,7 @@ class QueryDocForm(BaseModel):
     collection_name: str
     query: str
     k: Optional[int] = None
+    mode: Optional[Literal["vector", "hybrid"]] = None
 
 
 @app.post("/query/doc")
@@ -332,10 +397,21 @@ def query_doc_handler(
         user=Depends(get_current_user),
 ):
     try:
+        k = form_data.k if form_data.k else app.state.TOP_K
+        if (form_data.mode or app.state.SEARCH_MODE) == "hybrid":
+            # Fails like the vector search if the collection does not exist
+            VECTOR_STORE.get_collection(form_data.collection_name)
+            return query_collection(
+                collection_names=[form_data.collection_name],
+                query=form_data.query,
+                k=k,
+                embedding_function=app.state.sentence_transformer_ef,
+                mode="hybrid",
+            )
         return query_doc(
             collection_name=form_data.collection_name,
             query=form_data.query,
-            k=form_data.k if form_data.k else app.state.TOP_K,
+            k=k,
             embedding_function=app.state.sentence_transformer_ef,
         )
     except Exception as e:
@@ -350,6 +426,7 @@ class QueryCollectionsForm(BaseModel):
     collection_names: List[str]
     query: str
     k: Optional[int] = None
+    mode: Optional[Literal["vector", "hybrid"]] = None
 
 
 @app.post("/query/collection")
@@ -360,6 +437,7 @@ def query_collection_handler(form_data: QueryCollectionsForm, user=Depends(get_c
         query=form_data.query,
         k=form_data.k if form_data.k else app.state.TOP_K,
         embedding_function=app.state.sentence_transformer_ef,
+        mode=form_data.mode if form_data.mode else app.state.SEARCH_MODE,
     )
 
 
@@ -392,90 +470,6 @@ def store_web(form_data: StoreWebForm, user=Depends(get_current_user)):
         )
 
 
-def get_loader(filename: str, file_content_type: str, file_path: str):
-    """Get loader by file type."""
-    file_ext = filename.split(".")[-1].lower()
-    known_type = True
-
-    known_source_ext = [
-        "go",
-        "py",
-        "java",
-        "sh",
-        "bat",
-        "ps1",
-        "cmd",
-        "js",
-        "ts",
-        "css",
-        "cpp",
-        "hpp",
-        "h",
-        "c",
-        "cs",
-        "sql",
-        "log",
-        "ini",
-        "pl",
-        "pm",
-        "r",
-        "dart",
-        "dockerfile",
-        "env",
-        "php",
-        "hs",
-        "hsc",
-        "lua",
-        "nginxconf",
-        "conf",
-        "m",
-        "mm",
-        "plsql",
-        "perl",
-        "rb",
-        "rs",
-        "db2",
-        "scala",
-        "bash",
-        "swift",
-        "vue",
-        "svelte",
-    ]
-
-    if file_ext == "pdf":
-        loader = PyPDFLoader(file_path, extract_images=app.state.PDF_EXTRACT_IMAGES)
-    elif file_ext == "csv":
-        loader = CSVLoader(file_path)
-    elif file_ext == "rst":
-        loader = UnstructuredRSTLoader(file_path, mode="elements")
-    elif file_ext == "xml":
-        loader = UnstructuredXMLLoader(file_path)
-    elif file_ext == "md":
-        loader = UnstructuredMarkdownLoader(file_path)
-    elif file_content_type == "application/epub+zip":
-        loader = UnstructuredEPubLoader(file_path)
-    elif (
-            file_content_type
-            == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-            or file_ext in ["doc", "docx"]
-    ):
-        loader = Docx2txtLoader(file_path)
-    elif file_content_type in [
-        "application/vnd.ms-excel",
-        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    ] or file_ext in ["xls", "xlsx"]:
-        loader = UnstructuredExcelLoader(file_path)
-    elif file_ext in known_source_ext or (
-            file_content_type and file_content_type.find("text/") >= 0
-    ):
-        loader = TextLoader(file_path)
-    else:
-        loader = TextLoader(file_path)
-        known_type = False
-
-    return loader, known_type
-
-
 @app.post("/doc")
 def store_doc(
         collection_name: Optional[str] = Form(None),
@@ -497,105 +491,310 @@ def store_doc(
             collection_name = calculate_sha256(f)[:63]
         f.close()
 
-        loader, known_type = get_loader(file.filename, file.content_type, file_path)
-        # Check if lazy_load is implemented
-        try:
-            data = loader.lazy_load()
-        except NotImplementedError:
-            data = loader.load()
-
-        result = store_data_in_vector_db(data, collection_name)
-
-        if result:
-            return {
-                "status": True,
-                "collection_name": collection_name,
+        _, known_type = get_loader(filename, file.content_type, file_path)
+        # Parse, split and embed in the background, the upload returns at once
+        job = app.state.JOB_QUEUE.submit(
+            "doc",
+            {
                 "filename": filename,
-                "known_type": known_type,
-            }
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=ERROR_MESSAGES.DEFAULT(),
-            )
+                "content_type": file.content_type,
+                "file_path": file_path,
+                "collection_name": collection_name,
+            },
+            user.id,
+        )
+        return {
+            "status": True,
+            "collection_name": collection_name,
+            "filename": filename,
+            "known_type": known_type,
+            "job_id": job["id"],
+        }
     except Exception as e:
         logger.error(e)
-        if "No pandoc was found" in str(e):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=ERROR_MESSAGES.PANDOC_NOT_INSTALLED,
-            )
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=ERROR_MESSAGES.DEFAULT(e),
-            )
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=ERROR_MESSAGES.DEFAULT(e),
+        )
+
+
+def store_doc_job(payload: dict, progress: Callable[[int, int], None]) -> dict:
+    """
+    Parse, split and embed an uploaded file, the pages are loaded and split as the chunks are embedded.
+
+    The number of chunks is not known until the file is read, the progress is the count stored so far.
+    """
+    loader, _ = get_loader(
+        payload["filename"], payload["content_type"], payload["file_path"], app.state.PDF_EXTRACT_IMAGES
+    )
+    errors = []
+    chunks = 0
+
+    def load():
+        # A parse error is raised while the chunks are embedded, kept to be reported as the job error
+        try:
+            yield from load_data(loader)
+        except Exception as e:
+            errors.append(e)
+            raise
+
+    def stored(done: int):
+        nonlocal chunks
+        chunks = done
+        progress(done, 0)
+
+    if not store_data_in_vector_db(load(), payload["collection_name"], progress=stored):
+        if errors and "No pandoc was found" in str(errors[0]):
+            raise ValueError(ERROR_MESSAGES.PANDOC_NOT_INSTALLED)
+        if errors:
+            raise errors[0]
+        raise ValueError(ERROR_MESSAGES.DEFAULT())
+    return {"collection_name": payload["collection_name"], "chunks": chunks}
 
 
 @app.get("/scan")
 def scan_docs_dir(user=Depends(get_admin_user)):
-    """Scan docs dir and store in vector db, only for admin user."""
-    for path in Path(DOCS_DIR).rglob("./**/*"):
-        try:
-            if path.is_file() and not path.name.startswith("."):
-                tags = extract_folders_after_data_docs(path)
-                filename = path.name
-                file_content_type = mimetypes.guess_type(path)
+    """Scan docs dir and store in vector db in the background, only for admin user."""
+    job = app.state.JOB_QUEUE.submit("scan", {"user_id": user.id}, user.id)
+    return {"status": True, "job_id": job["id"]}
 
-                f = open(path, "rb")
-                collection_name = calculate_sha256(f)[:63]
-                f.close()
 
-                loader, known_type = get_loader(
-                    filename, file_content_type[0], str(path)
-                )
-                try:
-                    data = loader.lazy_load()
-                except NotImplementedError:
-                    data = loader.load()
-
-                result = store_data_in_vector_db(data, collection_name)
-
-                if result:
-                    sanitized_filename = sanitize_filename(filename)
-                    doc = Documents.get_doc_by_name(sanitized_filename)
-
-                    if doc is None:
-                        doc = Documents.insert_new_doc(
-                            user.id,
-                            DocumentForm(
-                                **{
-                                    "name": sanitized_filename,
-                                    "title": filename,
-                                    "collection_name": collection_name,
-                                    "filename": filename,
-                                    "content": (
-                                        json.dumps(
-                                            {
-                                                "tags": list(
-                                                    map(
-                                                        lambda name: {"name": name},
-                                                        tags,
-                                                    )
-                                                )
-                                            }
-                                        )
-                                        if len(tags)
-                                        else "{}"
-                                    ),
-                                }
-                            ),
+def store_scanned_doc(
+        path: Path, collection_name: str, texts: Optional[List[str]], metadatas: Optional[List[dict]], user_id: str
+):
+    """Store a file of the docs dir and add its document, texts is None if its collection is stored already."""
+    if texts is not None and not store_texts_in_vector_db(texts, metadatas, collection_name):
+        raise ValueError(ERROR_MESSAGES.DEFAULT())
+
+    tags = extract_folders_after_data_docs(path)
+    filename = path.name
+    sanitized_filename = sanitize_filename(filename)
+    doc = Documents.get_doc_by_name(sanitized_filename)
+
+    if doc is None:
+        doc = Documents.insert_new_doc(
+            user_id,
+            DocumentForm(
+                **{
+                    "name": sanitized_filename,
+                    "title": filename,
+                    "collection_name": collection_name,
+                    "filename": filename,
+                    "content": (
+                        json.dumps(
+                            {
+                                "tags": list(
+                                    map(
+                                        lambda name: {"name": name},
+                                        tags,
+                                    )
+                                )
+                            }
                         )
+                        if len(tags)
+                        else "{}"
+                    ),
+                }
+            ),
+        )
+    elif doc.collection_name != collection_name:
+        # The file changed, its old collection is kept if another file has the same content
+        Documents.update_doc_collection_by_name(sanitized_filename, collection_name, filename)
+
+
+def list_docs_dir() -> Dict[str, os.stat_result]:
+    """Files of the docs dir by path relative to it, hidden files are skipped."""
+    files = {}
+    for root, _, names in os.walk(DOCS_DIR):
+        for name in names:
+            if name.startswith("."):
+                continue
+            file_path = os.path.join(root, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            if S_ISREG(stat.st_mode):
+                files[os.path.relpath(file_path, DOCS_DIR)] = stat
+    return files
+
+
+def hash_file(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return calculate_sha256(f)
+
+
+def scan_docs_job(payload: dict, progress: Callable[[int, int], None]) -> dict:
+    """
+    Store the new and changed files of the docs dir, remove the collections of the deleted ones.
+
+    The manifest of the last scan tells which files changed: only those whose size or mtime differ are hashed,
+    and only those whose content differs are parsed and embedded. Files are parsed on SCAN_PROCESSES cores,
+    each one is embedded and stored as soon as it is parsed.
+    """
+    files = list_docs_dir()
+    manifest = DocFiles.get_doc_files()
+    changed = [
+        path for path, stat in files.items()
+        if path not in manifest or (manifest[path].size, manifest[path].mtime) != (stat.st_size, stat.st_mtime_ns)
+    ]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        hashes = executor.map(hash_file, [os.path.join(DOCS_DIR, path) for path in changed])
+        doc_files = [
+            DocFileModel(
+                path=path,
+                size=files[path].st_size,
+                mtime=files[path].st_mtime_ns,
+                sha256=sha256,
+                collection_name=sha256[:63],
+            )
+            for path, sha256 in zip(changed, hashes)
+        ]
+    touched, new_files = [], []
+    for doc_file in doc_files:
+        if doc_file.path in manifest and manifest[doc_file.path].sha256 == doc_file.sha256:
+            touched.append(doc_file)
+        else:
+            new_files.append(doc_file)
+    # Same content, only the manifest is updated
+    DocFiles.upsert_doc_files(touched)
+
+    # Collections of deleted or changed files that no other file has
+    new_paths = {doc_file.path for doc_file in new_files}
+    outdated = [doc_file for path, doc_file in manifest.items() if path not in files or path in new_paths]
+    kept = {doc_file.collection_name for path, doc_file in manifest.items() if path in files and path not in new_paths}
+    kept.update(doc_file.collection_name for doc_file in new_files)
+    removed = list({doc_file.collection_name for doc_file in outdated} - kept)
+    for collection_name in removed:
+        try:
+            delete_collection(collection_name)
+        except Exception as e:
+            logger.debug(f"delete collection {collection_name}: {e}")
+    Documents.delete_docs_by_collection_names(removed)
+    DocFiles.delete_doc_files([path for path in manifest if path not in files])
+
+    collection_names = set(VECTOR_STORE.list_collection_names())
+    # Files with the same content share a collection, only the first one is parsed
+    to_parse = list({
+        doc_file.collection_name: doc_file for doc_file in reversed(new_files)
+        if doc_file.collection_name not in collection_names
+    }.values())
+    progress(0, len(new_files))
+    processes = min(app.state.SCAN_PROCESSES, len(to_parse))
+    if processes > 1:
+        # spawn, forking a process with running threads may deadlock the child
+        executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
 
+    done, failed = 0, []
+    # Collections that could not be parsed or stored, the other files with the same content fail too
+    failed_collections = set()
+
+    def store(doc_file: DocFileModel, parsed=None):
+        """parsed is the future of load_and_split, None if the collection is stored already."""
+        nonlocal done
+        try:
+            if parsed is None and doc_file.collection_name in failed_collections:
+                raise ValueError(f"collection {doc_file.collection_name} of the same content failed")
+            texts, metadatas = None, None
+            try:
+                if parsed is not None:
+                    texts, metadatas, _ = parsed.result()
+                store_scanned_doc(
+                    Path(DOCS_DIR) / doc_file.path, doc_file.collection_name, texts, metadatas, payload["user_id"]
+                )
+            except Exception:
+                if parsed is not None:
+                    failed_collections.add(doc_file.collection_name)
+                raise
+            # Recorded once stored, a failed file is tried again on the next scan
+            DocFiles.upsert_doc_files([doc_file])
         except Exception as e:
-            logger.error(e)
+            logger.error(f"{doc_file.path}: {e}")
+            failed.append(doc_file.path)
+        done += 1
+        progress(done, len(new_files))
+
+    futures = {}
+    with executor:
+        for doc_file in to_parse:
+            # Parsed files wait for the embedding, keep only a few of them in memory
+            if len(futures) >= processes * 2:
+                for future in wait(futures, return_when=FIRST_COMPLETED)[0]:
+                    store(futures.pop(future), future)
+            future = executor.submit(
+                load_and_split,
+                os.path.basename(doc_file.path),
+                mimetypes.guess_type(doc_file.path)[0],
+                os.path.join(DOCS_DIR, doc_file.path),
+                app.state.CHUNK_SIZE,
+                app.state.CHUNK_OVERLAP,
+                DOC_TEXT_LENGTH_LIMIT,
+                app.state.PDF_EXTRACT_IMAGES,
+                app.state.CHUNK_UNIT,
+            )
+            futures[future] = doc_file
+        while futures:
+            for future in wait(futures, return_when=FIRST_COMPLETED)[0]:
+                store(futures.pop(future), future)
+    # Stored already, such as a file moved in the docs dir or a copy of a parsed one
+    parsed = {id(doc_file) for doc_file in to_parse}
+    for doc_file in new_files:
+        if id(doc_file) not in parsed:
+            store(doc_file)
+    return {
+        "stored": len(new_files) - len(failed),
+        "unchanged": len(files) - len(new_files),
+        "removed": len(removed),
+        "failed": failed,
+    }
 
-    return True
+
+def backfill_lexical_index_job(payload: dict, progress: Callable[[int, int], None]) -> dict:
+    return {"collections": backfill_lexical_index()}
+
+
+app.state.JOB_QUEUE.register("doc", store_doc_job)
+app.state.JOB_QUEUE.register("scan", scan_docs_job)
+app.state.JOB_QUEUE.register("lexical_backfill", backfill_lexical_index_job)
+app.state.JOB_QUEUE.resume()
+if LEXICAL_INDEX is not None:
+    # Collections stored before the keyword index have no keyword rows, the hybrid search would miss them
+    app.state.JOB_QUEUE.submit("lexical_backfill", {})
+
+
+def get_user_job(job_id: str, user) -> dict:
+    job = app.state.JOB_QUEUE.get(job_id)
+    if job is None or (user.role != "admin" and job["user_id"] != user.id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=ERROR_MESSAGES.NOT_FOUND,
+        )
+    return job
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, user=Depends(get_current_user)):
+    """Status of a background job: queued, running, done or failed, with done/total progress."""
+    return get_user_job(job_id, user)
+
+
+@app.get("/jobs/{job_id}/events")
+def get_job_events(job_id: str, user=Depends(get_current_user)):
+    """Server-sent events of a background job, one on each progress update, until it is done or failed."""
+    get_user_job(job_id, user)
+
+    async def event_stream():
+        async for job in app.state.JOB_QUEUE.events(job_id):
+            yield f"data: {json.dumps(job)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 @app.get("/reset/db")
 def reset_vector_db(user=Depends(get_admin_user)):
-    CHROMA_CLIENT.reset()
+    reset_collections()
 
 
 @app.get("/reset")
@@ -612,7 +811,7 @@ def reset(user=Depends(get_admin_user)) -> bool:
             logger.error("Failed to delete %s. Reason: %s" % (file_path, e))
 
     try:
-        CHROMA_CLIENT.reset()
+        reset_collections()
     except Exception as e:
         logger.error(e)
 
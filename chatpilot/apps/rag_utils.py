@@ -3,185 +3,207 @@
 @author:XuMing(xuming624@qq.com)
 @description: 
 """
-import re
-from typing import List, Optional, Any, Iterable
+import heapq
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Callable, Iterable, List, Optional
 
-import chromadb
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_core.documents import Document
 from loguru import logger
 
-from chatpilot.config import CHROMA_DATA_PATH
+from chatpilot.apps.lexical_index import LexicalIndex
+from chatpilot.apps.text_splitter import ChineseRecursiveTextSplitter, count_tokens  # noqa
+from chatpilot.apps.vector_store import ChromaVectorStore, LocalVectorStore
+from chatpilot.config import (
+    CHROMA_DATA_PATH,
+    LOCAL_VECTOR_DATA_PATH,
+    RAG_ANN_EF,
+    RAG_ANN_MIN_SIZE,
+    RAG_ANN_NPROBE,
+    RAG_LEXICAL_INDEX_PATH,
+    RAG_VECTOR_QUANTIZE,
+    RAG_VECTOR_STORE,
+)
 
 try:
-    CHROMA_CLIENT = chromadb.PersistentClient(
-        path=CHROMA_DATA_PATH,
-        settings=chromadb.Settings(allow_reset=True, anonymized_telemetry=False),
-    )
+    if RAG_VECTOR_STORE == "local":
+        VECTOR_STORE = LocalVectorStore(
+            LOCAL_VECTOR_DATA_PATH, quantize=RAG_VECTOR_QUANTIZE, ann_min_size=RAG_ANN_MIN_SIZE, nprobe=RAG_ANN_NPROBE
+        )
+    else:
+        VECTOR_STORE = ChromaVectorStore(CHROMA_DATA_PATH, ef_search=RAG_ANN_EF)
 except Exception as e:
-    CHROMA_CLIENT = None
-    logger.error(f"ChromaDB client failed to initialize: {e}")
+    VECTOR_STORE = None
+    logger.error(f"Vector store {RAG_VECTOR_STORE} failed to initialize: {e}")
 
+try:
+    LEXICAL_INDEX = LexicalIndex(RAG_LEXICAL_INDEX_PATH)
+except Exception as e:
+    LEXICAL_INDEX = None
+    logger.error(f"Lexical index failed to initialize: {e}")
 
-class ChineseRecursiveTextSplitter(RecursiveCharacterTextSplitter):
-    """Recursive text splitter for Chinese text.
-    copy from: https://github.com/chatchat-space/Langchain-Chatchat/tree/master
-    """
 
-    def __init__(
-            self,
-            separators: Optional[List[str]] = None,
-            keep_separator: bool = True,
-            is_separator_regex: bool = True,
-            doc_text_length_limit: int = -1,
-            **kwargs: Any,
-    ) -> None:
-        """Create a new TextSplitter."""
-        super().__init__(keep_separator=keep_separator, **kwargs)
-        self._separators = separators or [
-            "\n\n",
-            "\n",
-            "。|！|？",
-            "\.\s|\!\s|\?\s",
-            "；|;\s",
-            "，|,\s"
-        ]
-        self._is_separator_regex = is_separator_regex
-        self.doc_text_length_limit = doc_text_length_limit
-
-    @staticmethod
-    def _split_text_with_regex_from_end(
-            text: str, separator: str, keep_separator: bool
-    ) -> List[str]:
-        # Now that we have the separator, split the text
-        if separator:
-            if keep_separator:
-                # The parentheses in the pattern keep the delimiters in the result.
-                _splits = re.split(f"({separator})", text)
-                splits = ["".join(i) for i in zip(_splits[0::2], _splits[1::2])]
-                if len(_splits) % 2 == 1:
-                    splits += _splits[-1:]
-            else:
-                splits = re.split(separator, text)
-        else:
-            splits = list(text)
-        return [s for s in splits if s != ""]
-
-    def _split_text(self, text: str, separators: List[str]) -> List[str]:
-        """Split incoming text and return chunks."""
-        final_chunks = []
-        # Get appropriate separator to use
-        separator = separators[-1]
-        new_separators = []
-        for i, _s in enumerate(separators):
-            _separator = _s if self._is_separator_regex else re.escape(_s)
-            if _s == "":
-                separator = _s
-                break
-            if re.search(_separator, text):
-                separator = _s
-                new_separators = separators[i + 1:]
-                break
+def delete_collection(collection_name: str):
+    """Delete a collection and its keyword index."""
+    if LEXICAL_INDEX is not None:
+        LEXICAL_INDEX.delete_collection(collection_name)
+    VECTOR_STORE.delete_collection(collection_name)
 
-        _separator = separator if self._is_separator_regex else re.escape(separator)
-        splits = self._split_text_with_regex_from_end(text, _separator, self._keep_separator)
 
-        # Now go merging things, recursively splitting longer texts.
-        _good_splits = []
-        _separator = "" if self._keep_separator else separator
-        for s in splits:
-            if self._length_function(s) < self._chunk_size:
-                _good_splits.append(s)
-            else:
-                if _good_splits:
-                    merged_text = self._merge_splits(_good_splits, _separator)
-                    final_chunks.extend(merged_text)
-                    _good_splits = []
-                if not new_separators:
-                    final_chunks.append(s)
-                else:
-                    other_info = self._split_text(s, new_separators)
-                    final_chunks.extend(other_info)
-        if _good_splits:
-            merged_text = self._merge_splits(_good_splits, _separator)
-            final_chunks.extend(merged_text)
-        return [re.sub(r"\n{2,}", "\n", chunk.strip()) for chunk in final_chunks if chunk.strip() != ""]
-
-    def split_documents(self, documents: Iterable[Document]) -> List[Document]:
-        """Split documents."""
-        texts, metadatas = [], []
-        count = 0
-        if self.doc_text_length_limit > 0:
-            max_length = self.doc_text_length_limit
-        else:
-            max_length = None
+def reset_collections():
+    if LEXICAL_INDEX is not None:
+        LEXICAL_INDEX.clear()
+    VECTOR_STORE.reset()
 
-        for doc in documents:
-            content = doc.page_content
-            if max_length and count >= max_length:
-                logger.warning(f"Text length limit reached: {count}")
-                break
-            if max_length and len(content) > max_length:
-                content = content[:max_length]
-            texts.append(content)
-            metadatas.append(doc.metadata)
-            count += len(content)
-        return self.create_documents(texts, metadatas=metadatas)
 
+def backfill_lexical_index(batch_size: int = 1000) -> int:
+    """
+    Add the collections missing from the keyword index to it, such as those stored before it,
+    so the hybrid search also finds their chunks by keyword.
 
-def query_doc(collection_name: str, query: str, k: int, embedding_function):
-    try:
-        # if you use docker use the model from the environment variable
-        collection = CHROMA_CLIENT.get_collection(
-            name=collection_name,
-            embedding_function=embedding_function,
-        )
-        result = collection.query(
-            query_texts=[query],
-            n_results=k,
+    :return: Number of collections added.
+    """
+    if LEXICAL_INDEX is None or VECTOR_STORE is None:
+        return 0
+    indexed = set(LEXICAL_INDEX.list_collection_names())
+    added = 0
+    for collection_name in VECTOR_STORE.list_collection_names():
+        if collection_name in indexed:
+            continue
+        collection = VECTOR_STORE.get_collection(collection_name)
+
+        def get_batches():
+            for offset in range(0, collection.count(), batch_size):
+                batch = collection.get(limit=batch_size, offset=offset, include=["documents", "metadatas"])
+                yield batch["ids"], batch["documents"], batch["metadatas"]
+
+        if LEXICAL_INDEX.index_collection(collection_name, get_batches()):
+            added += 1
+    logger.debug(f"Added {added} collections to the keyword index")
+    return added
+
+
+def add_texts_in_batches(
+        collection,
+        texts: Iterable[str],
+        metadatas: Iterable[dict],
+        embedding_function,
+        batch_size: int = 64,
+        concurrency: int = 4,
+        progress: Optional[Callable[[int], None]] = None,
+        lexical_index: Optional[LexicalIndex] = None,
+) -> int:
+    """
+    Embed texts in batches and add them to the collection as each batch is done.
+
+    At most `concurrency` batches are embedded at a time, so memory and the request size to the
+    embedding provider are bounded whatever the document size. The texts and metadatas can be
+    iterators, a batch is taken from them only when it is submitted, so the chunks of a document
+    are split while the previous ones are embedded.
+    :param progress: Called with the number of texts added so far, after each batch.
+    :param lexical_index: Keyword index the texts are also added to, for hybrid search.
+    :return: Number of texts added.
+    """
+    if VECTOR_STORE is not None:
+        batch_size = min(batch_size, VECTOR_STORE.get_max_batch_size())
+    batch_size = max(batch_size, 1)
+
+    def get_batches():
+        items = zip(texts, metadatas)
+        while True:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                return
+            yield [text for text, _ in batch], [metadata for _, metadata in batch]
+
+    def embed(batch_texts: List[str], batch_metadatas: List[dict]):
+        return batch_texts, batch_metadatas, embedding_function(batch_texts)
+
+    def add(future) -> int:
+        batch_texts, batch_metadatas, embeddings = future.result()
+        ids = [str(uuid.uuid1()) for _ in batch_texts]
+        collection.add(
+            ids=ids,
+            embeddings=embeddings,
+            documents=batch_texts,
+            metadatas=batch_metadatas,
         )
-        return result
-    except Exception as e:
-        raise e
-
-
-def merge_and_sort_query_results(query_results, k):
-    # Initialize lists to store combined data
-    combined_ids = []
-    combined_distances = []
-    combined_metadatas = []
-    combined_documents = []
+        if lexical_index is not None:
+            lexical_index.add(collection.name, ids, batch_texts, batch_metadatas)
+        if progress is not None:
+            progress(count + len(batch_texts))
+        return len(batch_texts)
+
+    count = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        try:
+            for batch_texts, batch_metadatas in get_batches():
+                if len(pending) >= concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        count += add(future)
+                pending.add(executor.submit(embed, batch_texts, batch_metadatas))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    count += add(future)
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+    return count
+
+
+def embed_query(query: str, embedding_function) -> List[float]:
+    if hasattr(embedding_function, "embed_query"):
+        return embedding_function.embed_query([query])[0]
+    return embedding_function([query])[0]
+
+
+def query_doc(
+        collection_name: str, query: str, k: int, embedding_function, query_embedding: Optional[List[float]] = None
+):
+    """
+    Top k chunks of a collection, query_embedding is the embedded query if the caller has it already.
 
-    # Combine data from each dictionary
-    for data in query_results:
-        combined_ids.extend(data["ids"][0])
-        combined_distances.extend(data["distances"][0])
-        combined_metadatas.extend(data["metadatas"][0])
-        combined_documents.extend(data["documents"][0])
-
-    # Create a list of tuples (distance, id, metadata, document)
-    combined = list(
-        zip(combined_distances, combined_ids, combined_metadatas, combined_documents)
+    The result also has the `scores` of the chunks, their cosine similarity, None in a collection
+    of another distance.
+    """
+    if query_embedding is None:
+        query_embedding = embed_query(query, embedding_function)
+    # The query is embedded already, so the collection needs no embedding function
+    collection = VECTOR_STORE.get_collection(collection_name)
+    result = collection.query(
+        query_embeddings=[query_embedding],
+        n_results=k,
     )
+    cosine = VECTOR_STORE.get_space(collection) == "cosine"
+    result["scores"] = [[1 - d if cosine else None for d in distances] for distances in result["distances"]]
+    return result
 
-    # Sort the list based on distances
-    combined.sort(key=lambda x: x[0])
 
-    # Unzip the sorted list
-    sorted_distances, sorted_ids, sorted_metadatas, sorted_documents = zip(*combined)
-
-    # Slicing the lists to include only k elements
-    sorted_distances = list(sorted_distances)[:k]
-    sorted_ids = list(sorted_ids)[:k]
-    sorted_metadatas = list(sorted_metadatas)[:k]
-    sorted_documents = list(sorted_documents)[:k]
+def merge_and_sort_query_results(query_results, k):
+    # (distance, id, metadata, document, score) of every result, only the k nearest are kept
+    combined = heapq.nsmallest(
+        k,
+        (
+            row
+            for data in query_results
+            for row in zip(
+                data["distances"][0], data["ids"][0], data["metadatas"][0], data["documents"][0], data["scores"][0]
+            )
+        ),
+        key=lambda row: row[0],
+    )
 
     # Create the output dictionary
     merged_query_results = {
-        "ids": [sorted_ids],
-        "distances": [sorted_distances],
-        "metadatas": [sorted_metadatas],
-        "documents": [sorted_documents],
+        "ids": [[row[1] for row in combined]],
+        "distances": [[row[0] for row in combined]],
+        "metadatas": [[row[2] for row in combined]],
+        "documents": [[row[3] for row in combined]],
+        "scores": [[row[4] for row in combined]],
         "embeddings": None,
         "uris": None,
         "data": None,
@@ -190,28 +212,162 @@ def merge_and_sort_query_results(query_results, k):
     return merged_query_results
 
 
+def drop_low_scores(query_result, min_score_ratio: float):
+    """The result without the chunks scoring under min_score_ratio of the best one, a chunk without a score is kept."""
+    scores = query_result["scores"][0]
+    best = max((score for score in scores if score is not None), default=0)
+    if min_score_ratio <= 0 or best <= 0:
+        return query_result
+    threshold = best * min_score_ratio
+    keep = [i for i, score in enumerate(scores) if score is None or score >= threshold]
+    return {
+        **query_result,
+        **{
+            key: [[query_result[key][0][i] for i in keep]]
+            for key in ("ids", "distances", "metadatas", "documents", "scores")
+        },
+    }
+
+
+def reciprocal_rank_fusion(query_results, k, rrf_k: int = 60):
+    """
+    Fuse ranked results of different searches, a chunk scores the sum of 1 / (rrf_k + rank) of its ranks.
+
+    Scores of bm25 and of vector distances are not comparable, ranks are. The distances of the fused
+    result are the negated scores, so lower is still better, its `scores` are the fused scores.
+    """
+    scores = {}
+    rows = {}
+    for data in query_results:
+        for rank, row in enumerate(zip(data["ids"][0], data["metadatas"][0], data["documents"][0]), 1):
+            scores[row[0]] = scores.get(row[0], 0.0) + 1.0 / (rrf_k + rank)
+            rows.setdefault(row[0], row)
+    combined = heapq.nlargest(k, scores, key=scores.get)
+    return {
+        "ids": [combined],
+        "distances": [[-scores[id] for id in combined]],
+        "scores": [[scores[id] for id in combined]],
+        "metadatas": [[rows[id][1] for id in combined]],
+        "documents": [[rows[id][2] for id in combined]],
+        "embeddings": None,
+        "uris": None,
+        "data": None,
+    }
+
+
 def query_collection(
-        collection_names: List[str], query: str, k: int, embedding_function
+        collection_names: List[str],
+        query: str,
+        k: int,
+        embedding_function,
+        query_embedding: Optional[List[float]] = None,
+        concurrency: int = 8,
+        mode: str = "vector",
+        min_score_ratio: float = 0.0,
 ):
-    results = []
+    """
+    Top k chunks across the collections.
+
+    The query is embedded once, then the collections are searched concurrently, so the latency is
+    one embedding plus the slowest search, the keyword search of hybrid runs meanwhile. A collection
+    that fails is logged and left out.
+    :param mode: `vector`, or `hybrid` to fuse the vector and the keyword (bm25) results by rank.
+    :param min_score_ratio: Vector results with a cosine similarity under this ratio of the best one
+        are left out, before the fusion as fused rank scores of a top k are all close.
+    """
+    collection_names = list(dict.fromkeys(collection_names))
+    if not collection_names:
+        return merge_and_sort_query_results([], k)
+    hybrid = mode == "hybrid" and LEXICAL_INDEX is not None
 
-    for collection_name in collection_names:
+    def search(collection_name: str):
         try:
-            # if you use docker use the model from the environment variable
-            collection = CHROMA_CLIENT.get_collection(
-                name=collection_name,
-                embedding_function=embedding_function,
-            )
-
-            result = collection.query(
-                query_texts=[query],
-                n_results=k,
-            )
-            results.append(result)
-        except:
-            pass
+            return query_doc(collection_name, query, k, embedding_function, query_embedding)
+        except Exception as e:
+            logger.warning(f"query collection {collection_name} failed: {e}")
+            return None
+
+    workers = max(min(concurrency, len(collection_names)), 1)
+    with ThreadPoolExecutor(max_workers=workers + hybrid) as executor:
+        # The keyword search runs while the query is embedded and the collections are searched
+        lexical_future = executor.submit(LEXICAL_INDEX.query, collection_names, query, k) if hybrid else None
+        if query_embedding is None:
+            query_embedding = embed_query(query, embedding_function)
+        results = [result for result in executor.map(search, collection_names) if result is not None]
+        vector_results = drop_low_scores(merge_and_sort_query_results(results, k), min_score_ratio)
+        if lexical_future is None:
+            return vector_results
+        try:
+            lexical_results = lexical_future.result()
+        except Exception as e:
+            logger.warning(f"keyword search failed: {e}")
+            return vector_results
+    return reciprocal_rank_fusion([vector_results, lexical_results], k)
+
+
+def get_overlap(a: str, b: str, min_overlap: int) -> int:
+    """Length of the longest end of a that b starts with, 0 if it is shorter than min_overlap."""
+    if min(len(a), len(b)) < min_overlap:
+        return 0
+    head = b[:min_overlap]
+    pos = a.find(head, max(len(a) - len(b), 0))
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(head, pos + 1)
+    return 0
+
+
+def remove_overlap(document: str, chunk: str, min_overlap: int) -> str:
+    """The part of document not in chunk, as neighbouring chunks of a document share their ends."""
+    if document in chunk:
+        return ""
+    overlap = get_overlap(chunk, document, min_overlap)
+    if overlap:
+        return document[overlap:].strip()
+    overlap = get_overlap(document, chunk, min_overlap)
+    if overlap:
+        return document[:len(document) - overlap].strip()
+    return document
+
+
+def get_context(
+        documents: List[str],
+        max_tokens: int = -1,
+        scores: Optional[List[float]] = None,
+        min_score_ratio: float = 0.0,
+        min_overlap: int = 20,
+) -> str:
+    """
+    Pack the retrieved chunks, best first, into a context of at most max_tokens, -1 is no limit.
 
-    return merge_and_sort_query_results(results, k)
+    - The chunks with a score under min_score_ratio of the best score are dropped, a higher score is better,
+      a chunk without a score (None) is kept.
+    - A chunk in one packed before is dropped, the text it shares with the start or end of one, of at
+      least min_overlap chars, is cut off.
+    - A chunk that does not fit in the tokens left is skipped, a shorter one after it can still fit.
+    """
+    best = max((score for score in scores or [] if score is not None), default=0)
+    if min_score_ratio > 0 and best > 0:
+        threshold = best * min_score_ratio
+        documents = [
+            document for document, score in zip(documents, scores) if score is None or score >= threshold
+        ]
+    chunks, tokens = [], 0
+    for document in documents:
+        for chunk in chunks:
+            document = remove_overlap(document, chunk, min_overlap)
+            if not document:
+                break
+        if not document:
+            continue
+        if max_tokens > 0:
+            document_tokens = count_tokens(document)
+            if tokens + document_tokens > max_tokens:
+                continue
+            tokens += document_tokens
+        chunks.append(document)
+    return "\n".join(chunks)
 
 
 def get_rag_prompt(template: str, context: str, query: str):
@@ -222,7 +378,25 @@ def get_rag_prompt(template: str, context: str, query: str):
     return template
 
 
-def rag_messages(docs, messages, template, k, embedding_function):
+def rag_messages(
+        docs,
+        messages,
+        template,
+        k,
+        embedding_function,
+        max_tokens: int = -1,
+        mode: str = "vector",
+        min_score_ratio: float = 0.0,
+):
+    """
+    Add the context retrieved from the docs to the last user message.
+
+    :param k: Number of chunks retrieved across all docs.
+    :param max_tokens: Token budget of the context, -1 is no limit.
+    :param mode: Search mode of query_collection, `vector` or `hybrid`.
+    :param min_score_ratio: Chunks found by the vector search only, with a cosine similarity under this
+        ratio of the best chunk, are left out.
+    """
     logger.debug(f"docs: {docs}")
 
     last_user_message_idx = None
@@ -250,33 +424,30 @@ def rag_messages(docs, messages, template, k, embedding_function):
         content_type = None
         query = ""
 
-    relevant_contexts = []
-
+    # One search across every attached doc: the query is embedded once, the collections are
+    # searched concurrently and the k best chunks of all of them are kept
+    collection_names = []
     for doc in docs:
-        context = None
-        try:
-            if doc["type"] == "collection":
-                context = query_collection(
-                    collection_names=doc["collection_names"],
-                    query=query,
-                    k=k,
-                    embedding_function=embedding_function,
-                )
-            else:
-                context = query_doc(
-                    collection_name=doc["collection_name"],
-                    query=query,
-                    k=k,
-                    embedding_function=embedding_function,
-                )
-        except Exception as e:
-            logger.error(e)
-        relevant_contexts.append(context)
+        if doc["type"] == "collection":
+            collection_names.extend(doc["collection_names"])
+        else:
+            collection_names.append(doc["collection_name"])
 
-    context_string = ""
-    for context in relevant_contexts:
-        if context:
-            context_string += " ".join(context["documents"][0]) + "\n"
+    documents = []
+    try:
+        context = query_collection(
+            collection_names=collection_names,
+            query=query,
+            k=k,
+            embedding_function=embedding_function,
+            mode=mode,
+            min_score_ratio=min_score_ratio,
+        )
+        # Best first, the low scoring chunks are dropped already
+        documents = context["documents"][0]
+    except Exception as e:
+        logger.error(e)
+    context_string = get_context(documents, max_tokens)
 
     ra_content = get_rag_prompt(
         template=template,
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Sliding window counter rate limiter with constant size state per user
+
+The count of a window is estimated from the counter of the current fixed window and the previous one:
+    count = previous * (1 - elapsed / window) + current
+so each limit of a user keeps three numbers, whatever its RPD/RPM is.
+"""
+import math
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+# (window seconds, max requests in window)
+Limits = List[Tuple[int, int]]
+
+
+def _estimate(previous: int, current: int, window: int, now: float) -> float:
+    elapsed = now - math.floor(now / window) * window
+    return previous * (1 - elapsed / window) + current
+
+
+class MemoryRateLimitBackend:
+    """In-process counters, exact for a single worker."""
+
+    blocking = False
+
+    def __init__(self):
+        self._counters: Dict[Tuple[str, int], List[int]] = {}  # (key, window) -> [window_idx, previous, current]
+        self._lock = threading.Lock()
+
+    def _counter(self, key: str, window: int, now: float) -> List[int]:
+        window_idx = int(now // window)
+        counter = self._counters.get((key, window))
+        if counter is None:
+            counter = [window_idx, 0, 0]
+            self._counters[(key, window)] = counter
+        elif counter[0] != window_idx:
+            # Roll over, the previous window only counts if it is the adjacent one
+            previous = counter[2] if counter[0] == window_idx - 1 else 0
+            counter[:] = [window_idx, previous, 0]
+        return counter
+
+    def acquire(self, key: str, limits: Limits, now: float) -> Optional[int]:
+        with self._lock:
+            counters = [self._counter(key, window, now) for window, _ in limits]
+            for i, ((window, limit), counter) in enumerate(zip(limits, counters)):
+                if _estimate(counter[1], counter[2], window, now) >= limit:
+                    return i
+            for counter in counters:
+                counter[2] += 1
+        return None
+
+
+class SQLiteRateLimitBackend:
+    """Counters in a SQLite file, shared by all workers on the same host."""
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit ("
+            "key TEXT NOT NULL, window INTEGER NOT NULL, window_idx INTEGER NOT NULL, "
+            "previous INTEGER NOT NULL, current INTEGER NOT NULL, PRIMARY KEY (key, window))"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, key: str, limits: Limits, now: float) -> Optional[int]:
+        conn = self._conn()
+        # Take the write lock first, so check and increment are atomic across workers
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            counters = []
+            for window, _ in limits:
+                window_idx = int(now // window)
+                row = conn.execute(
+                    "SELECT window_idx, previous, current FROM rate_limit WHERE key = ? AND window = ?",
+                    (key, window),
+                ).fetchone()
+                if row is None:
+                    counters.append((window_idx, 0, 0))
+                elif row[0] != window_idx:
+                    counters.append((window_idx, row[2] if row[0] == window_idx - 1 else 0, 0))
+                else:
+                    counters.append(row)
+            for i, ((window, limit), counter) in enumerate(zip(limits, counters)):
+                if _estimate(counter[1], counter[2], window, now) >= limit:
+                    conn.execute("ROLLBACK")
+                    return i
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_limit (key, window, window_idx, previous, current) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(key, window, c[0], c[1], c[2] + 1) for (window, _), c in zip(limits, counters)],
+            )
+            conn.execute("COMMIT")
+            return None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class RedisRateLimitBackend:
+    """Counters in a Redis compatible store, shared by all workers and hosts.
+
+    Only INCR/DECR/GET/EXPIRE are used, so any Redis compatible server or a local stand-in works.
+    """
+
+    blocking = True
+
+    def __init__(self, client=None, url: str = "redis://localhost:6379/0", prefix: str = "chatpilot:rl"):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ValueError(
+                    "The redis python package is not installed. Please install it with `pip install redis`"
+                )
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def acquire(self, key: str, limits: Limits, now: float) -> Optional[int]:
+        keys = []
+        pipe = self.client.pipeline()
+        for window, _ in limits:
+            window_idx = int(now // window)
+            current_key = f"{self.prefix}:{key}:{window}:{window_idx}"
+            keys.append(current_key)
+            pipe.incr(current_key)
+            pipe.expire(current_key, window * 2)
+            pipe.get(f"{self.prefix}:{key}:{window}:{window_idx - 1}")
+        results = pipe.execute()
+
+        violated = None
+        for i, (window, limit) in enumerate(limits):
+            current, _, previous = results[i * 3: i * 3 + 3]
+            # current includes this request
+            if _estimate(int(previous or 0), int(current) - 1, window, now) >= limit:
+                violated = i
+                break
+        if violated is not None:
+            # Rejected requests do not count
+            pipe = self.client.pipeline()
+            for current_key in keys:
+                pipe.decr(current_key)
+            pipe.execute()
+        return violated
+
+
+class RateLimiter:
+    """Per user RPD and RPM limiter over a pluggable backend."""
+
+    DAY = 24 * 60 * 60
+    MINUTE = 60
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryRateLimitBackend()
+
+    def __repr__(self):
+        return f"RateLimiter(backend={self.backend.__class__.__name__})"
+
+    def acquire(self, key: str, max_daily_requests: int, max_minute_requests: int) -> Optional[str]:
+        """
+        Count one request of key if it is under the limits.
+
+        :param key: The user id.
+        :param max_daily_requests: RPD, <= 0 means no limit.
+        :param max_minute_requests: RPM, <= 0 means no limit.
+        :return: None if allowed, else "RPD" or "RPM", the limit that was reached.
+        """
+        limits, names = [], []
+        if max_daily_requests > 0:
+            limits.append((self.DAY, max_daily_requests))
+            names.append("RPD")
+        if max_minute_requests > 0:
+            limits.append((self.MINUTE, max_minute_requests))
+            names.append("RPM")
+        if not limits:
+            return None
+        violated = self.backend.acquire(key, limits, time.time())
+        return names[violated] if violated is not None else None
+
+
+def get_rate_limit_backend(name: str, sqlite_path: str = "", redis_url: str = ""):
+    if name == "sqlite":
+        return SQLiteRateLimitBackend(sqlite_path)
+    if name == "redis":
+        return RedisRateLimitBackend(url=redis_url)
+    if name != "memory":
+        logger.warning(f"Unknown rate limit backend: {name}, use memory")
+    return MemoryRateLimitBackend()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Text splitters, light to import so document parsing can run in worker processes
+"""
+import re
+from collections import deque
+from functools import lru_cache
+from typing import List, Optional, Any, Iterable, Iterator, Tuple
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from loguru import logger
+
+_newlines_pattern = re.compile(r"\n{2,}")
+_cjk_pattern = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    """The tiktoken encoding, None if it can not be loaded, such as offline without a cached vocab."""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken encoding not available, token counts are estimated: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # About one token per CJK char and per 4 other chars
+    cjk = len(_cjk_pattern.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ChineseRecursiveTextSplitter(RecursiveCharacterTextSplitter):
+    """Recursive text splitter for Chinese text.
+    copy from: https://github.com/chatchat-space/Langchain-Chatchat/tree/master
+
+    The text is split in one pass over (start, end) offsets with precompiled separators, a chunk
+    is only copied out of the text when it is yielded, and the chunks are yielded lazily.
+    """
+
+    def __init__(
+            self,
+            separators: Optional[List[str]] = None,
+            keep_separator: bool = True,
+            is_separator_regex: bool = True,
+            doc_text_length_limit: int = -1,
+            **kwargs: Any,
+    ) -> None:
+        """Create a new TextSplitter."""
+        super().__init__(keep_separator=keep_separator, **kwargs)
+        self._separators = separators or [
+            "\n\n",
+            "\n",
+            "。|！|？",
+            r"\.\s|!\s|\?\s",
+            r"；|;\s",
+            r"，|,\s",
+        ]
+        self._is_separator_regex = is_separator_regex
+        self.doc_text_length_limit = doc_text_length_limit
+        # None splits into characters
+        self._patterns = [
+            re.compile(s if is_separator_regex else re.escape(s)) if s else None for s in self._separators
+        ]
+
+    def _length(self, text: str, start: int, end: int) -> int:
+        if self._length_function is len:
+            return end - start
+        return self._length_function(text[start:end])
+
+    def _merge_spans(self, splits: List[Tuple[int, int, int]]) -> Iterator[Tuple[int, int]]:
+        """Merge the (start, end, length) splits into chunks of the chunk size, each overlapping the previous one."""
+        current = deque()
+        total = 0
+        for start, end, length in splits:
+            if total + length > self._chunk_size:
+                if current:
+                    yield current[0][0], current[-1][1]
+                    # Keep the last splits as the overlap, while they leave room for this one
+                    while total > self._chunk_overlap or (total + length > self._chunk_size and total > 0):
+                        total -= current.popleft()[2]
+            current.append((start, end, length))
+            total += length
+        if current:
+            yield current[0][0], current[-1][1]
+
+    def _split_spans(self, text: str, start: int, end: int, level: int) -> Iterator[Tuple[int, int]]:
+        """Chunks of text[start:end], split by the first separator from `level` on that is found in it."""
+        patterns = self._patterns
+        pattern = patterns[-1]
+        next_level = len(patterns)
+        for i in range(level, len(patterns)):
+            if patterns[i] is None:
+                pattern = None
+                break
+            if patterns[i].search(text, start, end):
+                pattern = patterns[i]
+                next_level = i + 1
+                break
+
+        if pattern is None:
+            splits = [(i, i + 1) for i in range(start, end)]
+        else:
+            splits = []
+            pos = start
+            for match in pattern.finditer(text, start, end):
+                # A split ends with its separator, or before it
+                split_end = match.end() if self._keep_separator else match.start()
+                if split_end > pos:
+                    splits.append((pos, split_end))
+                pos = match.end()
+            if pos < end:
+                splits.append((pos, end))
+
+        # Now go merging things, recursively splitting longer texts.
+        good_splits = []
+        for split_start, split_end in splits:
+            # Measured once, a token count is not cheap
+            length = self._length(text, split_start, split_end)
+            if length < self._chunk_size:
+                good_splits.append((split_start, split_end, length))
+                continue
+            if good_splits:
+                yield from self._merge_spans(good_splits)
+                good_splits = []
+            if next_level >= len(patterns):
+                yield split_start, split_end
+            else:
+                yield from self._split_spans(text, split_start, split_end, next_level)
+        if good_splits:
+            yield from self._merge_spans(good_splits)
+
+    def iter_spans(self, text: str) -> Iterator[Tuple[int, int]]:
+        """(start, end) offsets of the chunks in the text, without the whitespace around them."""
+        for start, end in self._split_spans(text, 0, len(text), 0):
+            while start < end and text[start].isspace():
+                start += 1
+            while end > start and text[end - 1].isspace():
+                end -= 1
+            if start < end:
+                yield start, end
+
+    @staticmethod
+    def _get_chunk(text: str, start: int, end: int) -> str:
+        chunk = text[start:end]
+        if "\n\n" in chunk:
+            chunk = _newlines_pattern.sub("\n", chunk)
+        return chunk
+
+    def iter_split_text(self, text: str) -> Iterator[str]:
+        for start, end in self.iter_spans(text):
+            yield self._get_chunk(text, start, end)
+
+    def split_text(self, text: str) -> List[str]:
+        return list(self.iter_split_text(text))
+
+    def iter_split_documents(self, documents: Iterable[Document]) -> Iterator[Tuple[str, dict]]:
+        """
+        Split documents, yield their chunks and metadata one at a time.
+
+        The chunks of a document share its metadata, which is not copied unless the start index is added.
+        """
+        count = 0
+        if self.doc_text_length_limit > 0:
+            max_length = self.doc_text_length_limit
+        else:
+            max_length = None
+
+        for doc in documents:
+            content = doc.page_content
+            if max_length and count >= max_length:
+                logger.warning(f"Text length limit reached: {count}")
+                break
+            if max_length and len(content) > max_length:
+                content = content[:max_length]
+            count += len(content)
+            for start, end in self.iter_spans(content):
+                metadata = doc.metadata
+                if self._add_start_index:
+                    metadata = {**metadata, "start_index": start}
+                yield self._get_chunk(content, start, end), metadata
+
+    def split_documents(self, documents: Iterable[Document]) -> List[Document]:
+        """Split documents."""
+        return [
+            Document(page_content=chunk, metadata=metadata)
+            for chunk, metadata in self.iter_split_documents(documents)
+        ]
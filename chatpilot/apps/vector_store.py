@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Vector stores of the RAG collections, Chroma or a local NumPy store
+
+A store creates, lists and deletes collections, a collection has the `add` and `query` of a Chroma
+collection, so the RAG code works the same with either store.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence, Set
+
+import numpy as np
+from loguru import logger
+
+
+class CollectionExistsError(ValueError):
+    pass
+
+
+class CollectionNotFoundError(ValueError):
+    pass
+
+
+class VectorStore(ABC):
+    """Collections of chunks with their embeddings."""
+
+    @abstractmethod
+    def create_collection(self, name: str):
+        """Create an empty collection, raise CollectionExistsError if it exists."""
+
+    @abstractmethod
+    def get_collection(self, name: str):
+        """The collection, raise CollectionNotFoundError if it does not exist."""
+
+    @abstractmethod
+    def list_collection_names(self) -> List[str]:
+        """Names of all collections."""
+
+    @abstractmethod
+    def delete_collection(self, name: str):
+        """Delete the collection and its chunks."""
+
+    @abstractmethod
+    def reset(self):
+        """Delete all collections."""
+
+    @abstractmethod
+    def get_max_batch_size(self) -> int:
+        """Max number of chunks added in one call."""
+
+    @abstractmethod
+    def get_space(self, collection) -> str:
+        """Distance of the query results of a collection, `cosine` is 1 - cosine similarity."""
+
+
+class ChromaVectorStore(VectorStore):
+    def __init__(self, path: str, ef_search: int = 0):
+        """
+        :param path: Dir of the Chroma db.
+        :param ef_search: Candidates of the HNSW search of new collections, more is better recall and slower,
+            0 is Chroma's default.
+        """
+        import chromadb
+
+        self.path = path
+        self.ef_search = ef_search
+        self.client = chromadb.PersistentClient(
+            path=path,
+            settings=chromadb.Settings(allow_reset=True, anonymized_telemetry=False),
+        )
+
+    def __repr__(self):
+        return f"ChromaVectorStore(path={self.path})"
+
+    def create_collection(self, name: str):
+        from chromadb.errors import ChromaError
+
+        # Chunks are added with their embeddings, the collection needs no embedding function.
+        # Cosine distances as the local store, Chroma's default is squared L2, which has no scale to compare.
+        configuration = {"hnsw": {"space": "cosine"}}
+        if self.ef_search > 0:
+            configuration["hnsw"]["ef_search"] = self.ef_search
+        try:
+            return self.client.create_collection(name=name, configuration=configuration)
+        except ChromaError as e:
+            if name in self.list_collection_names():
+                raise CollectionExistsError(f"Collection {name} already exists") from e
+            raise
+
+    def get_collection(self, name: str):
+        from chromadb.errors import NotFoundError
+
+        try:
+            return self.client.get_collection(name=name)
+        except NotFoundError as e:
+            raise CollectionNotFoundError(f"Collection {name} does not exist") from e
+
+    def list_collection_names(self) -> List[str]:
+        return [collection.name for collection in self.client.list_collections()]
+
+    def delete_collection(self, name: str):
+        self.client.delete_collection(name=name)
+
+    def reset(self):
+        self.client.reset()
+
+    def get_max_batch_size(self) -> int:
+        return self.client.get_max_batch_size()
+
+    def get_space(self, collection) -> str:
+        # Collections created before the cosine space are L2
+        return (collection.configuration.get("hnsw") or {}).get("space", "l2")
+
+
+class IvfReaders:
+    """
+    Queries reading each IVF generation of a collection. A retrained generation is retired, its files
+    are removed once no query reads them, so a query never loses the files of the info it read.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: Dict[int, int] = {}
+        self.retired: Set[int] = set()
+
+
+# Names Chroma accepts, so a collection can move between the stores, also safe as a dir name
+_collection_name_pattern = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9._-]{1,510}[a-zA-Z0-9]$")
+
+
+class LocalCollection:
+    """
+    Chunks of a collection in a dir, read by memory map, nothing is loaded until a query.
+
+    Files:
+        collection.json: dim, dtype, count and records_size, the rows past them are an unfinished add.
+        vectors.bin: unit length vectors, count x dim float32, or int8 with a float32 scale per row in scales.bin.
+        records.jsonl: [id, document, metadata] per row, offsets.bin has the uint64 offset of each line.
+        ivf-<n>.centroids, ivf-<n>.lists: the IVF index trained on the first n rows, nlist x dim float32
+            centroids and the int32 list of each row, new rows are added to the list of their nearest centroid.
+            A retrain writes a new generation, the old one is removed once the queries reading it are done.
+    """
+
+    # Rows scored at a time, so an int8 collection is not converted to float32 at once
+    block_size = 65536
+    # The IVF index is trained again once the collection has grown this many times its trained size
+    retrain_growth = 4
+    # Rows sampled per list to train the IVF centroids, and k-means iterations
+    train_rows_per_list = 256
+    train_iterations = 10
+
+    def __init__(
+            self,
+            name: str,
+            path: str,
+            lock: threading.Lock,
+            ann_min_size: int = 0,
+            nprobe: int = 16,
+            readers: Optional[IvfReaders] = None,
+    ):
+        """
+        :param lock: Lock of the writers of the collection.
+        :param readers: Queries of each IVF generation, shared by the objects of the collection like the lock.
+        :param ann_min_size: Rows from which the collection is searched with an IVF index, 0 is always exact.
+        :param nprobe: Lists of the IVF index searched by a query, more is better recall and slower.
+        """
+        self.name = name
+        self.path = path
+        self.ann_min_size = ann_min_size
+        self.nprobe = nprobe
+        self._lock = lock
+        self._readers = readers or IvfReaders()
+
+    def __repr__(self):
+        return f"LocalCollection(name={self.name}, path={self.path})"
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_info(self) -> dict:
+        with open(self._file("collection.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_info(self, info: dict):
+        tmp = self._file("collection.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        os.replace(tmp, self._file("collection.json"))
+
+    def count(self) -> int:
+        return self._read_info()["count"]
+
+    def _acquire_info(self) -> dict:
+        """Read the info and hold its IVF generation until `_release_info`, so its files are kept."""
+        with self._readers.lock:
+            info = self._read_info()
+            if info.get("ivf"):
+                trained = info["ivf"]["trained"]
+                self._readers.counts[trained] = self._readers.counts.get(trained, 0) + 1
+        return info
+
+    def _release_info(self, info: dict):
+        if not info.get("ivf"):
+            return
+        trained = info["ivf"]["trained"]
+        with self._readers.lock:
+            self._readers.counts[trained] -= 1
+            if self._readers.counts[trained] == 0:
+                del self._readers.counts[trained]
+                self._remove_retired()
+
+    def _remove_retired(self):
+        """Remove the files of the retired generations no query reads, with the readers lock held."""
+        for trained in [trained for trained in self._readers.retired if trained not in self._readers.counts]:
+            for suffix in ("centroids", "lists"):
+                try:
+                    os.remove(self._file(f"ivf-{trained}.{suffix}"))
+                except FileNotFoundError:
+                    pass
+            self._readers.retired.discard(trained)
+
+    def add(self, ids: List[str], embeddings, documents: List[str], metadatas: Optional[List[dict]] = None):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(ids) or len(documents) != len(ids):
+            raise ValueError("ids, embeddings and documents must have the same length")
+        metadatas = metadatas or [None] * len(ids)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1)
+        records = [
+            json.dumps([id, document, metadata], ensure_ascii=False).encode("utf-8") + b"\n"
+            for id, document, metadata in zip(ids, documents, metadatas)
+        ]
+
+        with self._lock:
+            info = self._read_info()
+            dim = info["dim"]
+            if dim is None:
+                dim = info["dim"] = vectors.shape[1]
+            elif dim != vectors.shape[1]:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match collection dimension {dim}")
+            count, records_size = info["count"], info["records_size"]
+            if info["dtype"] == "int8":
+                scales = np.abs(vectors).max(axis=1) / 127
+                scales[scales == 0] = 1
+                data = np.round(vectors / scales[:, None]).astype(np.int8)
+                self._append("scales.bin", count * 4, scales.astype(np.float32).tobytes())
+            else:
+                data = vectors
+            self._append("vectors.bin", count * dim * data.itemsize, data.tobytes())
+            offsets = records_size + np.cumsum([0] + [len(record) for record in records[:-1]], dtype=np.uint64)
+            self._append("offsets.bin", count * 8, offsets.astype(np.uint64).tobytes())
+            self._append("records.jsonl", records_size, b"".join(records))
+            ivf = info.get("ivf")
+            if ivf:
+                centroids = self._read_centroids(info)
+                lists = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+                self._append(f"ivf-{ivf['trained']}.lists", count * 4, lists.tobytes())
+            info["count"] = count + len(ids)
+            info["records_size"] = records_size + sum(len(record) for record in records)
+            if 0 < self.ann_min_size <= info["count"] and (
+                    not ivf or info["count"] >= ivf["trained"] * self.retrain_growth
+            ):
+                self._train(info)
+            # The rows are visible once the info is replaced, the new IVF generation too, queries read the
+            # info with the readers lock held, so a query that read the old one holds its files
+            with self._readers.lock:
+                self._write_info(info)
+                if ivf and info["ivf"] is not ivf:
+                    self._readers.retired.add(ivf["trained"])
+                    self._remove_retired()
+
+    def _append(self, name: str, size: int, data: bytes):
+        with open(self._file(name), "ab") as f:
+            # Drop what an interrupted add left past the recorded size
+            f.truncate(size)
+            f.write(data)
+
+    def _vectors(self, info: dict):
+        """Memory maps of the vectors and of their scales, None if they are float32."""
+        count, dim = info["count"], info["dim"]
+        if info["dtype"] == "int8":
+            vectors = np.memmap(self._file("vectors.bin"), dtype=np.int8, mode="r", shape=(count, dim))
+            scales = np.memmap(self._file("scales.bin"), dtype=np.float32, mode="r", shape=(count,))
+            return vectors, scales
+        return np.memmap(self._file("vectors.bin"), dtype=np.float32, mode="r", shape=(count, dim)), None
+
+    def _blocks(self, info: dict, rows: Optional[np.ndarray] = None):
+        """
+        float32 blocks of the vectors of rows, all rows if None, with the start of each block and the
+        scales of an int8 collection, None if float32. A score of a block row is multiplied by its scale.
+        """
+        vectors, scales = self._vectors(info)
+        total = info["count"] if rows is None else len(rows)
+        for start in range(0, total, self.block_size):
+            index = slice(start, min(start + self.block_size, total)) if rows is None \
+                else rows[start:start + self.block_size]
+            if scales is None:
+                yield start, vectors[index], None
+            else:
+                yield start, vectors[index].astype(np.float32), scales[index]
+
+    def _read_centroids(self, info: dict) -> np.ndarray:
+        ivf = info["ivf"]
+        return np.fromfile(self._file(f"ivf-{ivf['trained']}.centroids"), dtype=np.float32).reshape(
+            ivf["nlist"], info["dim"]
+        )
+
+    def _train(self, info: dict):
+        """Train the IVF centroids by spherical k-means on a sample of the rows, then assign every row to a list."""
+        count, dim = info["count"], info["dim"]
+        nlist = max(int(np.sqrt(count)), 1)
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(count, min(count, nlist * self.train_rows_per_list), replace=False))
+        data = np.concatenate([
+            block if scales is None else block * scales[:, None] for _, block, scales in self._blocks(info, sample)
+        ])
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+        for _ in range(self.train_iterations):
+            assigned = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros((nlist, dim), dtype=np.float32)
+            np.add.at(sums, assigned, data)
+            sizes = np.bincount(assigned, minlength=nlist)
+            # An empty list restarts from a random row
+            empty = sizes == 0
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms > 0, norms, 1)
+
+        # The scale of a row does not change its nearest centroid
+        lists = np.empty(count, dtype=np.int32)
+        for start, block, _ in self._blocks(info):
+            lists[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        centroids.astype(np.float32).tofile(self._file(f"ivf-{count}.centroids"))
+        lists.tofile(self._file(f"ivf-{count}.lists"))
+        info["ivf"] = {"trained": count, "nlist": nlist}
+        logger.debug(f"Trained the IVF index of collection {self.name}: {count} rows in {nlist} lists")
+
+    def _candidates(self, info: dict, query: np.ndarray, nprobe: int, k: int) -> Optional[np.ndarray]:
+        """Rows in the nprobe lists nearest to the query, None to search all rows."""
+        ivf = info.get("ivf")
+        if not ivf or nprobe <= 0 or nprobe >= ivf["nlist"]:
+            return None
+        centroid_scores = self._read_centroids(info) @ query
+        probe = np.zeros(ivf["nlist"], dtype=bool)
+        probe[np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]] = True
+        lists = np.memmap(self._file(f"ivf-{ivf['trained']}.lists"), dtype=np.int32, mode="r", shape=(info["count"],))
+        rows = np.flatnonzero(probe[lists])
+        return rows if len(rows) >= k else None
+
+    def _get_records(self, info: dict, rows: Sequence[int]) -> List[list]:
+        offsets = np.memmap(self._file("offsets.bin"), dtype=np.uint64, mode="r", shape=(info["count"],))
+        records = []
+        with open(self._file("records.jsonl"), "rb") as f:
+            for row in rows:
+                f.seek(int(offsets[row]))
+                records.append(json.loads(f.readline()))
+        return records
+
+    def get(
+            self, limit: Optional[int] = None, offset: int = 0, include: Sequence[str] = ("documents", "metadatas")
+    ) -> dict:
+        """ids, documents and metadatas of the rows from offset, like a Chroma get, include is ignored."""
+        info = self._read_info()
+        end = info["count"] if limit is None else min(offset + limit, info["count"])
+        records = self._get_records(info, range(offset, end)) if offset < end else []
+        return {
+            "ids": [record[0] for record in records],
+            "documents": [record[1] for record in records],
+            "metadatas": [record[2] for record in records],
+        }
+
+    def query(self, query_embeddings, n_results: int = 10, nprobe: Optional[int] = None) -> dict:
+        """
+        Nearest chunks of each query by cosine, the distances are 1 - cosine similarity.
+
+        :param nprobe: Lists searched if the collection has an IVF index, default the collection's, 0 is exact.
+        """
+        info = self._acquire_info()
+        try:
+            return self._query(info, query_embeddings, n_results, self.nprobe if nprobe is None else nprobe)
+        finally:
+            self._release_info(info)
+
+    def _query(self, info: dict, query_embeddings, n_results: int, nprobe: int) -> dict:
+        result = {"ids": [], "distances": [], "metadatas": [], "documents": []}
+        for query_embedding in query_embeddings:
+            ids, distances, metadatas, documents = [], [], [], []
+            if info["count"] and n_results > 0:
+                query = np.asarray(query_embedding, dtype=np.float32)
+                if query.shape != (info["dim"],):
+                    raise ValueError(f"Query dimension {query.shape} does not match collection dimension {info['dim']}")
+                query = query / (np.linalg.norm(query) or 1)
+                k = min(n_results, info["count"])
+                rows = self._candidates(info, query, nprobe, k)
+                scores = np.empty(info["count"] if rows is None else len(rows), dtype=np.float32)
+                for start, block, scales in self._blocks(info, rows):
+                    scores[start:start + len(block)] = block @ query if scales is None else (block @ query) * scales
+                top = np.argpartition(-scores, k - 1)[:k]
+                top = top[np.argsort(-scores[top], kind="stable")]
+                for (id, document, metadata), score in zip(
+                        self._get_records(info, top if rows is None else rows[top]), scores[top]
+                ):
+                    ids.append(id)
+                    distances.append(float(1 - score))
+                    metadatas.append(metadata)
+                    documents.append(document)
+            result["ids"].append(ids)
+            result["distances"].append(distances)
+            result["metadatas"].append(metadatas)
+            result["documents"].append(documents)
+        result.update({"embeddings": None, "uris": None, "data": None})
+        return result
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Collections as files under a dir, searched with NumPy, exactly or by an IVF index once they are large.
+
+    Opening the store reads nothing, a query maps the vectors of its collection, so thousands of
+    small collections cost no memory until they are searched.
+    """
+
+    def __init__(self, path: str, quantize: bool = False, ann_min_size: int = 0, nprobe: int = 16):
+        """
+        :param path: Dir of the collections.
+        :param quantize: Store the vectors of new collections as int8, a quarter of the size of float32.
+        :param ann_min_size: Rows from which a collection is searched with an IVF index, 0 is always exact.
+        :param nprobe: Lists of an IVF index searched by a query, more is better recall and slower.
+        """
+        self.path = path
+        self.quantize = quantize
+        self.ann_min_size = ann_min_size
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        # A writer per collection, training the index of a large one does not hold up the others
+        self._collection_locks: Dict[str, threading.Lock] = {}
+        self._collection_readers: Dict[str, IvfReaders] = {}
+        os.makedirs(path, exist_ok=True)
+
+    def __repr__(self):
+        return f"LocalVectorStore(path={self.path}, quantize={self.quantize}, ann_min_size={self.ann_min_size})"
+
+    def _collection(self, name: str, path: str) -> LocalCollection:
+        with self._lock:
+            lock = self._collection_locks.setdefault(name, threading.Lock())
+            readers = self._collection_readers.setdefault(name, IvfReaders())
+        return LocalCollection(name, path, lock, self.ann_min_size, self.nprobe, readers)
+
+    def _dir(self, name: str) -> str:
+        if not _collection_name_pattern.match(name):
+            raise ValueError(f"Invalid collection name: {name}")
+        return os.path.join(self.path, name)
+
+    def create_collection(self, name: str) -> LocalCollection:
+        path = self._dir(name)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            # A dir with no info is left by a create that did not finish
+            if os.path.isfile(os.path.join(path, "collection.json")):
+                raise CollectionExistsError(f"Collection {name} already exists")
+        collection = self._collection(name, path)
+        collection._write_info(
+            {"dim": None, "dtype": "int8" if self.quantize else "float32", "count": 0, "records_size": 0}
+        )
+        return collection
+
+    def get_collection(self, name: str) -> LocalCollection:
+        path = self._dir(name)
+        if not os.path.isfile(os.path.join(path, "collection.json")):
+            raise CollectionNotFoundError(f"Collection {name} does not exist")
+        return self._collection(name, path)
+
+    def list_collection_names(self) -> List[str]:
+        return sorted(
+            entry.name
+            for entry in os.scandir(self.path)
+            if entry.is_dir() and os.path.isfile(os.path.join(entry.path, "collection.json"))
+        )
+
+    def delete_collection(self, name: str):
+        path = self._dir(name)
+        if not os.path.isdir(path):
+            raise CollectionNotFoundError(f"Collection {name} does not exist")
+        shutil.rmtree(path)
+
+    def reset(self):
+        for entry in os.scandir(self.path):
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+        logger.debug(f"Deleted all collections in {self.path}")
+
+    def get_max_batch_size(self) -> int:
+        return 100000
+
+    def get_space(self, collection) -> str:
+        return "cosine"
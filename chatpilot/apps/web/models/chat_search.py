@@ -0,0 +1,199 @@
+import re
+from typing import Dict, Iterable, List, Optional
+
+import jieba
+import peewee as pw
+from pydantic import BaseModel
+
+from chatpilot.apps.db import DB
+
+####################
+# Chat Search DB Schema
+####################
+
+# CJK text has no spaces, each char is indexed as one token and a query word is matched as a phrase of its chars
+CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_cjk_char_pattern = re.compile(f"([{CJK_RANGES}])")
+# The spaces added between CJK chars, also around the highlight tags of a snippet
+_cjk_gap_pattern = re.compile(f"([{CJK_RANGES}](?:</mark>)?) +(?=(?:<mark>)?[{CJK_RANGES}])")
+
+
+class ChatSearch(pw.Model):
+    """Searchable text of a chat, one row per message and one for the title, with an empty message_id.
+
+    It is the content table of the FTS5 index `chatsearch_fts`, which triggers keep in sync.
+    """
+    id = pw.AutoField()
+    chat_id = pw.CharField()
+    message_id = pw.CharField()
+    user_id = pw.CharField()
+    text = pw.TextField()
+
+    class Meta:
+        database = DB
+        indexes = ((("chat_id", "message_id"), True),)
+
+
+class ChatSearchResponse(BaseModel):
+    id: str
+    title: str
+    timestamp: int
+    snippet: str
+    score: float
+
+
+def create_search_index(db: pw.Database) -> bool:
+    """
+    Create the search tables, the FTS5 index and its triggers.
+
+    :return: True if they were created now, so the existing chats must be indexed.
+    """
+    table = ChatSearch._meta.table_name
+    created = not db.table_exists(table)
+    db.create_tables([ChatSearch])
+    # user_id is indexed, so a search only ranks the chats of its user
+    columns = "text, user_id, chat_id UNINDEXED"
+    values = "new.text, new.user_id, new.chat_id"
+    old_values = "old.text, old.user_id, old.chat_id"
+    for sql in (
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+            f"{columns}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {table}_fts(rowid, text, user_id, chat_id) VALUES (new.id, {values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {table}_fts({table}_fts, rowid, text, user_id, chat_id) "
+            f"VALUES ('delete', old.id, {old_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE ON {table} BEGIN "
+            f"INSERT INTO {table}_fts({table}_fts, rowid, text, user_id, chat_id) "
+            f"VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO {table}_fts(rowid, text, user_id, chat_id) VALUES (new.id, {values}); END",
+    ):
+        db.execute_sql(sql)
+    return created
+
+
+def get_search_text(text: str) -> str:
+    return _cjk_char_pattern.sub(r" \1 ", text)
+
+
+def get_message_text(message: dict) -> str:
+    """Text content of a message, also of a multimodal one with a list of parts."""
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(
+            part["text"] for part in content if isinstance(part, dict) and isinstance(part.get("text"), str)
+        )
+    return ""
+
+
+def get_match_phrases(query: str) -> List[str]:
+    """
+    FTS5 phrases of the words of a user input, the last one as a prefix for search as you type.
+
+    CJK input is cut into words with jieba, so `北京天气` also matches `北京的天气`.
+    """
+    words = []
+    for word in query.split():
+        words.extend(jieba.cut(word) if _cjk_char_pattern.search(word) else [word])
+    phrases = []
+    for word in words:
+        tokens = get_search_text(word).split()
+        if tokens:
+            phrases.append('"' + " ".join(tokens).replace('"', '""') + '"')
+    if phrases and not _cjk_char_pattern.search(phrases[-1]):
+        phrases[-1] += "*"
+    return phrases
+
+
+class ChatSearchTable:
+    def __init__(self, db):
+        self.db = db
+
+    def index_chat(
+            self,
+            chat_id: str,
+            user_id: str,
+            title: Optional[str] = None,
+            messages: Optional[Dict[str, dict]] = None,
+    ):
+        """Add or replace the title and messages of a chat in the index, the others are left as is."""
+        rows = []
+        if title is not None:
+            rows.append({"chat_id": chat_id, "message_id": "", "user_id": user_id, "text": get_search_text(title)})
+        for message_id, message in (messages or {}).items():
+            text = get_search_text(get_message_text(message))
+            rows.append({"chat_id": chat_id, "message_id": message_id, "user_id": user_id, "text": text})
+        for i in range(0, len(rows), 100):
+            ChatSearch.insert_many(rows[i:i + 100]).on_conflict(
+                conflict_target=[ChatSearch.chat_id, ChatSearch.message_id],
+                preserve=[ChatSearch.text],
+                # An unchanged text is not written, so the triggers do not touch the fts index
+                where=(ChatSearch.text != pw.EXCLUDED.text),
+            ).execute()
+
+    def remove_messages(self, chat_id: str, message_ids: List[str]):
+        for i in range(0, len(message_ids), 500):
+            ChatSearch.delete().where(
+                (ChatSearch.chat_id == chat_id) & (ChatSearch.message_id.in_(message_ids[i:i + 500]))
+            ).execute()
+
+    def remove_chats(self, chat_ids: Iterable[str]):
+        """chat_ids may be a subquery, such as the chats of a user."""
+        ChatSearch.delete().where(ChatSearch.chat_id.in_(chat_ids)).execute()
+
+    def search(self, user_id: str, query: str, skip: int = 0, limit: int = 20) -> List[ChatSearchResponse]:
+        """
+        Chats of a user that have all words of query, in any of their messages or the title,
+        best bm25 of a matching row first, with a snippet of that row.
+
+        Only the index is scanned, titles and snippets are read for the returned page.
+        """
+        from chatpilot.apps.web.models.chats import Chat
+
+        phrases = get_match_phrases(query)
+        if not phrases:
+            return []
+        user_match = f'user_id : "{user_id.replace(chr(34), chr(34) * 2)}"'
+        # A row per message, the words of a query may be in different messages of a chat:
+        # rows with any word are ranked, and the chat must have each word in one of its rows
+        match = f"{user_match} AND text : ({' OR '.join(phrases)})"
+        db = ChatSearch._meta.database
+        table = ChatSearch._meta.table_name
+        word_filter = f" AND chat_id IN (SELECT chat_id FROM {table}_fts WHERE {table}_fts MATCH ?)"
+        word_matches = [f"{user_match} AND text : {phrase}" for phrase in phrases] if len(phrases) > 1 else []
+        hits = db.execute_sql(
+            f"SELECT chat_id, MIN(rank) AS score, rowid FROM {table}_fts WHERE {table}_fts MATCH ?"
+            f"{word_filter * len(word_matches)} GROUP BY chat_id ORDER BY score LIMIT ? OFFSET ?",
+            (match, *word_matches, limit, skip),
+        ).fetchall()
+        if not hits:
+            return []
+
+        rowids = [rowid for _, _, rowid in hits]
+        snippets = dict(
+            db.execute_sql(
+                f"SELECT rowid, snippet({table}_fts, 0, '<mark>', '</mark>', '...', 24) FROM {table}_fts "
+                f"WHERE {table}_fts MATCH ? AND rowid IN ({', '.join('?' * len(rowids))})",
+                (match, *rowids),
+            ).fetchall()
+        )
+        chats = {
+            chat["id"]: chat
+            for chat in Chat.select(Chat.id, Chat.title, Chat.timestamp)
+            .where(Chat.id.in_([chat_id for chat_id, _, _ in hits]))
+            .dicts()
+        }
+        return [
+            ChatSearchResponse(
+                **chats[chat_id],
+                snippet=_cjk_gap_pattern.sub(r"\1", snippets.get(rowid, "")).strip(),
+                score=-score,
+            )
+            for chat_id, score, rowid in hits
+            if chat_id in chats
+        ]
+
+
+ChatSearches = ChatSearchTable(DB)
@@ -1,13 +1,16 @@
+import hashlib
 import json
 import time
 import uuid
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import peewee as pw
 from playhouse.shortcuts import model_to_dict
 from pydantic import BaseModel
 
 from chatpilot.apps.db import DB
+from chatpilot.apps.web.models.chat_search import ChatSearch, ChatSearches, create_search_index
+from chatpilot.apps.web.models.tags import ChatIdTag
 
 
 ####################
@@ -24,6 +27,23 @@ class Chat(pw.Model):
 
     class Meta:
         database = DB
+        indexes = (
+            # Sidebar list of a user, newest first, keyset pagination on (timestamp, id)
+            (("user_id", "timestamp", "id"), False),
+        )
+
+
+class ChatMessage(pw.Model):
+    """One message of `history.messages` of a chat, so a new message writes one row instead of the whole chat."""
+    chat_id = pw.CharField()
+    message_id = pw.CharField()
+    message = pw.TextField()  # Save Message JSON as Text
+    hash = pw.CharField()  # blake2b of message, unchanged messages are not written again
+    timestamp = pw.BigIntegerField()  # last write in epoch
+
+    class Meta:
+        database = DB
+        primary_key = pw.CompositeKey("chat_id", "message_id")
 
 
 class ChatModel(BaseModel):
@@ -43,6 +63,11 @@ class ChatForm(BaseModel):
     chat: dict
 
 
+class ChatMessagesForm(BaseModel):
+    messages: Dict[str, dict]  # message id -> message, of the new or changed messages
+    currentId: Optional[str] = None
+
+
 class ChatTitleForm(BaseModel):
     title: str
 
@@ -58,12 +83,185 @@ class ChatResponse(BaseModel):
 class ChatTitleIdResponse(BaseModel):
     id: str
     title: str
+    timestamp: Optional[int] = None
+
+
+def get_chat_cursor(chat: ChatTitleIdResponse) -> str:
+    """Cursor of the page after this chat, in the order of `get_chat_lists_by_user_id`."""
+    return f"{chat.timestamp}_{chat.id}"
+
+
+def parse_chat_cursor(cursor: str) -> Tuple[int, str]:
+    """:raises ValueError: if the cursor is malformed."""
+    timestamp, id = cursor.split("_", 1)
+    return int(timestamp), id
+
+
+_message_encoder = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(",", ":"))
+
+
+def _message_path(messages: Dict[str, dict], current_id: Optional[str]) -> List[dict]:
+    """Messages from the root to current_id, the same list the frontend derives from the history."""
+    path = []
+    message = messages.get(current_id) if current_id else None
+    while message is not None and len(path) <= len(messages):
+        path.append(message)
+        parent_id = message.get("parentId")
+        message = messages.get(parent_id) if parent_id else None
+    return path[::-1]
+
+
+def _split_chat(chat: dict) -> Tuple[dict, Optional[Dict[str, dict]]]:
+    """
+    Split a chat into the json kept in `Chat.chat` and the history messages kept in `ChatMessage`.
+
+    :return: (meta, messages), messages is None if the chat has no history to normalize.
+    """
+    history = chat.get("history")
+    if not isinstance(history, dict) or not isinstance(history.get("messages"), dict):
+        return chat, None
+    messages = history["messages"]
+    meta = {**chat, "history": {k: v for k, v in history.items() if k != "messages"}}
+    # `messages` is rebuilt from the history on read, unless the client sent something else
+    if "messages" in meta and meta["messages"] == _message_path(messages, history.get("currentId")):
+        meta.pop("messages")
+    return meta, messages
+
+
+def _join_chat(meta: dict, messages: Optional[Dict[str, dict]]) -> dict:
+    """Inverse of `_split_chat`, messages is None for a chat stored as one json."""
+    if messages is None:
+        return meta
+    history = {**meta["history"], "messages": messages}
+    chat = {**meta, "history": history}
+    if "messages" not in chat:
+        chat["messages"] = _message_path(messages, history.get("currentId"))
+    return chat
+
+
+def _is_split(meta: dict) -> bool:
+    history = meta.get("history")
+    return isinstance(history, dict) and "messages" not in history
 
 
 class ChatTable:
     def __init__(self, db):
         self.db = db
-        db.create_tables([Chat])
+        db.create_tables([Chat, ChatMessage])
+        if create_search_index(db):
+            self.reindex()
+
+    def _load_messages(self, chat_ids: Iterable[str]) -> Dict[str, Dict[str, dict]]:
+        chat_ids = list(chat_ids)
+        messages = {chat_id: {} for chat_id in chat_ids}
+        for i in range(0, len(chat_ids), 500):
+            query = (
+                ChatMessage.select(ChatMessage.chat_id, ChatMessage.message_id, ChatMessage.message)
+                .where(ChatMessage.chat_id.in_(chat_ids[i:i + 500]))
+                .order_by(pw.SQL("rowid"))
+                .tuples()
+            )
+            for chat_id, message_id, message in query:
+                messages[chat_id][message_id] = json.loads(message)
+        return messages
+
+    def _to_chat_models(self, chats: List[Chat]) -> List[ChatModel]:
+        """Rebuild the full chat json of each row, with one query for the messages of all of them."""
+        metas = [json.loads(chat.chat) for chat in chats]
+        messages = self._load_messages(chat.id for chat, meta in zip(chats, metas) if _is_split(meta))
+        return [
+            ChatModel(**{**model_to_dict(chat), "chat": json.dumps(_join_chat(meta, messages.get(chat.id)))})
+            for chat, meta in zip(chats, metas)
+        ]
+
+    def _diff_messages(
+            self, id: str, messages: Dict[str, dict], replace: bool, existing: Optional[Dict[str, str]] = None
+    ) -> Tuple[List[dict], List[str]]:
+        """
+        Rows of the new or changed messages, and the ids of the removed ones if replace.
+
+        :param existing: Message id -> hash of the stored messages, loaded if None, only of messages unless replace.
+        """
+        if existing is None:
+            query = ChatMessage.select(ChatMessage.message_id, ChatMessage.hash).where(ChatMessage.chat_id == id)
+            if replace:
+                queries = [query]
+            else:
+                message_ids = list(messages)
+                queries = [
+                    query.where(ChatMessage.message_id.in_(message_ids[i:i + 500]))
+                    for i in range(0, len(message_ids), 500)
+                ]
+            # Raw rows, this runs on every save of a chat
+            existing = {}
+            for query in queries:
+                existing.update(ChatMessage._meta.database.execute(query).fetchall())
+        now = int(time.time())
+        rows = []
+        for message_id, message in messages.items():
+            text = _message_encoder.encode(message)
+            digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+            if existing.get(message_id) != digest:
+                rows.append(
+                    {"chat_id": id, "message_id": message_id, "message": text, "hash": digest, "timestamp": now}
+                )
+        removed = [message_id for message_id in existing if message_id not in messages] if replace else []
+        return rows, removed
+
+    def _write_messages(
+            self, id: str, user_id: str, rows: List[dict], removed: List[str], messages: Dict[str, dict]
+    ):
+        """Write the diff of `_diff_messages` and update the search index with it."""
+        for i in range(0, len(rows), 100):
+            ChatMessage.insert_many(rows[i:i + 100]).on_conflict(
+                conflict_target=[ChatMessage.chat_id, ChatMessage.message_id],
+                preserve=[ChatMessage.message, ChatMessage.hash, ChatMessage.timestamp],
+            ).execute()
+        for i in range(0, len(removed), 500):
+            ChatMessage.delete().where(
+                (ChatMessage.chat_id == id) & (ChatMessage.message_id.in_(removed[i:i + 500]))
+            ).execute()
+        changed = {row["message_id"]: messages[row["message_id"]] for row in rows}
+        ChatSearches.index_chat(id, user_id, messages=changed)
+        ChatSearches.remove_messages(id, removed)
+
+    def append_messages(
+            self, id: str, user_id: str, messages: Dict[str, dict], current_id: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        Add or update history messages of a chat, one row per message that is new or changed.
+
+        Only the given messages are encoded and compared with the stored ones, so saving a response
+        costs the same whatever the length of the chat.
+        :param id: Chat id.
+        :param messages: Message id -> message, such as the new user message, the response to it and their parents.
+        :param current_id: New `history.currentId`, the last message shown.
+        :return: Number of rows written, None if the chat is not found.
+        """
+        # The stored messages are diffed under the write lock, so a concurrent save is not lost
+        with self.db.atomic("IMMEDIATE"):
+            try:
+                chat_row = Chat.get(Chat.id == id, Chat.user_id == user_id)
+            except pw.DoesNotExist:
+                return None
+            meta = json.loads(chat_row.chat)
+            if not _is_split(meta):
+                # Still one json, split on this write
+                history = meta.get("history") if isinstance(meta.get("history"), dict) else {}
+                history = {**history, "messages": {**history.get("messages", {}), **messages}}
+                if current_id is not None:
+                    history["currentId"] = current_id
+                meta.pop("messages", None)
+                return len(messages) if self.update_chat_by_id(id, {**meta, "history": history}) else None
+
+            if current_id is not None:
+                meta["history"]["currentId"] = current_id
+            # Rebuilt from the history on read, the path changes with the new messages
+            meta.pop("messages", None)
+            Chat.update(chat=json.dumps(meta), timestamp=int(time.time())).where(Chat.id == id).execute()
+            rows, _ = self._diff_messages(id, messages, replace=False)
+            self._write_messages(id, user_id, rows, [], messages)
+        return len(rows)
 
     def insert_new_chat(self, user_id: str, form_data: ChatForm) -> Optional[ChatModel]:
         id = str(uuid.uuid4())
@@ -79,76 +277,183 @@ class ChatTable:
             }
         )
 
-        result = Chat.create(**chat.model_dump())
+        meta, messages = _split_chat(form_data.chat)
+        rows, _ = self._diff_messages(id, messages or {}, replace=False, existing={})
+        with self.db.atomic():
+            result = Chat.create(**{**chat.model_dump(), "chat": json.dumps(meta)})
+            self._write_messages(id, user_id, rows, [], messages or {})
+            ChatSearches.index_chat(id, user_id, title=chat.title)
         return chat if result else None
 
     def update_chat_by_id(self, id: str, chat: dict) -> Optional[ChatModel]:
+        """Replace the chat, only the messages that changed are written."""
         try:
-            query = Chat.update(
-                chat=json.dumps(chat),
-                title=chat["title"] if "title" in chat else "New Chat",
-                timestamp=int(time.time()),
-            ).where(Chat.id == id)
-            query.execute()
-
-            chat = Chat.get(Chat.id == id)
-            return ChatModel(**model_to_dict(chat))
+            meta, messages = _split_chat(chat)
+            # The stored messages are diffed under the write lock, so a concurrent save is not lost
+            with self.db.atomic("IMMEDIATE"):
+                user_id = Chat.select(Chat.user_id).where(Chat.id == id).scalar()
+                rows, removed = self._diff_messages(id, messages or {}, replace=True)
+                query = Chat.update(
+                    chat=json.dumps(meta),
+                    title=chat["title"] if "title" in chat else "New Chat",
+                    timestamp=int(time.time()),
+                ).where(Chat.id == id)
+                query.execute()
+                self._write_messages(id, user_id, rows, removed, messages or {})
+                ChatSearches.index_chat(id, user_id, title=chat["title"] if "title" in chat else "New Chat")
+
+            chat_row = Chat.get(Chat.id == id)
+            return ChatModel(**{**model_to_dict(chat_row), "chat": json.dumps(chat)})
         except:
             return None
 
+    def merge_chat_by_id_and_user_id(self, id: str, user_id: str, updated: dict) -> Optional[ChatModel]:
+        """
+        Update the top level keys of a chat with updated, like `{**chat, **updated}`.
+
+        The stored messages are not loaded unless the history is replaced, so renaming a chat or
+        saving a new message does not read and rewrite the whole conversation.
+        """
+        # Read and written under the write lock, so a concurrent update is not overwritten
+        with self.db.atomic("IMMEDIATE"):
+            try:
+                chat_row = Chat.get(Chat.id == id, Chat.user_id == user_id)
+            except pw.DoesNotExist:
+                return None
+            meta = json.loads(chat_row.chat)
+            if "history" in updated or not _is_split(meta):
+                # The history is replaced, or the chat is still one json and gets split on this write
+                return self.update_chat_by_id(id, {**meta, **updated})
+
+            meta = {**meta, **updated}
+            title = meta["title"] if "title" in meta else "New Chat"
+            Chat.update(
+                chat=json.dumps(meta),
+                title=title,
+                timestamp=int(time.time()),
+            ).where(Chat.id == id).execute()
+            ChatSearches.index_chat(id, user_id, title=title)
+        return self._to_chat_models([Chat.get(Chat.id == id)])[0]
+
     def get_chat_lists_by_user_id(
-            self, user_id: str, skip: int = 0, limit: int = 50
-    ) -> List[ChatModel]:
-        return [
-            ChatModel(**model_to_dict(chat))
-            for chat in Chat.select()
+            self, user_id: str, skip: int = 0, limit: Optional[int] = None, cursor: Optional[str] = None
+    ) -> List[ChatTitleIdResponse]:
+        """
+        Sidebar list of a user, newest first, the chat json is never loaded.
+
+        :param skip: Offset, ignored if cursor is set.
+        :param limit: Page size, None is all.
+        :param cursor: `get_chat_cursor` of the last chat of the previous page.
+        :raises ValueError: if the cursor is malformed.
+        """
+        query = (
+            Chat.select(Chat.id, Chat.title, Chat.timestamp)
             .where(Chat.user_id == user_id)
-            .order_by(Chat.timestamp.desc())
-            # .limit(limit)
-            # .offset(skip)
-        ]
+            .order_by(Chat.timestamp.desc(), Chat.id.desc())
+        )
+        if cursor:
+            timestamp, id = parse_chat_cursor(cursor)
+            query = query.where(
+                (Chat.timestamp < timestamp) | ((Chat.timestamp == timestamp) & (Chat.id < id))
+            )
+        elif skip:
+            query = query.offset(skip)
+        if limit is not None:
+            query = query.limit(limit)
+        return [ChatTitleIdResponse(**chat) for chat in query.dicts()]
 
     def get_chat_lists_by_chat_ids(
             self, chat_ids: List[str], skip: int = 0, limit: int = 50
-    ) -> List[ChatModel]:
+    ) -> List[ChatTitleIdResponse]:
         return [
-            ChatModel(**model_to_dict(chat))
-            for chat in Chat.select()
+            ChatTitleIdResponse(**chat)
+            for chat in Chat.select(Chat.id, Chat.title, Chat.timestamp)
             .where(Chat.id.in_(chat_ids))
             .order_by(Chat.timestamp.desc())
+            .dicts()
         ]
 
-    def get_all_chats(self) -> List[ChatModel]:
+    def get_chat_lists_by_tag_name_and_user_id(
+            self, tag_name: str, user_id: str, skip: int = 0, limit: int = 50
+    ) -> List[ChatTitleIdResponse]:
+        """Sidebar list of the chats of a user with a tag, newest first, in one query."""
         return [
-            ChatModel(**model_to_dict(chat))
-            for chat in Chat.select().order_by(Chat.timestamp.desc())
+            ChatTitleIdResponse(**chat)
+            for chat in Chat.select(Chat.id, Chat.title, Chat.timestamp)
+            .join(ChatIdTag, on=(ChatIdTag.chat_id == Chat.id))
+            .where(
+                (ChatIdTag.user_id == user_id)
+                & (ChatIdTag.tag_name == tag_name)
+                & (Chat.user_id == user_id)
+            )
+            .group_by(Chat.id)
+            .order_by(Chat.timestamp.desc(), Chat.id.desc())
+            .offset(skip)
+            .limit(limit)
+            .dicts()
         ]
 
+    def get_all_chats(self) -> List[ChatModel]:
+        return self._to_chat_models(list(Chat.select().order_by(Chat.timestamp.desc())))
+
     def get_all_chats_by_user_id(self, user_id: str) -> List[ChatModel]:
-        return [
-            ChatModel(**model_to_dict(chat))
-            for chat in Chat.select()
-            .where(Chat.user_id == user_id)
-            .order_by(Chat.timestamp.desc())
-        ]
+        return self._to_chat_models(
+            list(
+                Chat.select()
+                .where(Chat.user_id == user_id)
+                .order_by(Chat.timestamp.desc())
+            )
+        )
+
+    def iter_chats(self, user_id: Optional[str] = None, batch_size: int = 100) -> Iterator[ChatModel]:
+        """
+        Yield the chats of a user, or of all users if user_id is None, newest first.
+
+        Rows are read in keyset batches of batch_size, so memory does not grow with the db, and no sqlite cursor
+        is held between batches, the caller may resume the iterator from another thread.
+        """
+        cursor = None
+        while True:
+            query = Chat.select().order_by(Chat.timestamp.desc(), Chat.id.desc()).limit(batch_size)
+            if user_id is not None:
+                query = query.where(Chat.user_id == user_id)
+            if cursor is not None:
+                timestamp, id = cursor
+                query = query.where(
+                    (Chat.timestamp < timestamp) | ((Chat.timestamp == timestamp) & (Chat.id < id))
+                )
+            chats = self._to_chat_models(list(query))
+            yield from chats
+            if len(chats) < batch_size:
+                break
+            cursor = (chats[-1].timestamp, chats[-1].id)
+
+    def reindex(self):
+        """Rebuild the search index from the stored chats, such as for a db created before the index."""
+        with self.db.atomic():
+            ChatSearch.delete().execute()
+            for chat in self.iter_chats():
+                content = json.loads(chat.chat)
+                _, messages = _split_chat(content)
+                ChatSearches.index_chat(chat.id, chat.user_id, title=chat.title, messages=messages)
 
     def get_chat_by_id_and_user_id(self, id: str, user_id: str) -> Optional[ChatModel]:
         try:
             chat = Chat.get(Chat.id == id, Chat.user_id == user_id)
-            return ChatModel(**model_to_dict(chat))
+            return self._to_chat_models([chat])[0]
         except:
             return None
 
     def get_chats(self, skip: int = 0, limit: int = 50) -> List[ChatModel]:
-        return [
-            ChatModel(**model_to_dict(chat))
-            for chat in Chat.select().limit(limit).offset(skip)
-        ]
+        return self._to_chat_models(list(Chat.select().limit(limit).offset(skip)))
 
     def delete_chat_by_id_and_user_id(self, id: str, user_id: str) -> bool:
         try:
-            query = Chat.delete().where((Chat.id == id) & (Chat.user_id == user_id))
-            query.execute()  # Remove the rows, return number of rows removed.
+            with self.db.atomic():
+                query = Chat.delete().where((Chat.id == id) & (Chat.user_id == user_id))
+                if query.execute():  # Remove the rows, return number of rows removed.
+                    ChatMessage.delete().where(ChatMessage.chat_id == id).execute()
+                    ChatSearches.remove_chats([id])
 
             return True
         except:
@@ -156,8 +461,13 @@ class ChatTable:
 
     def delete_chats_by_user_id(self, user_id: str) -> bool:
         try:
-            query = Chat.delete().where(Chat.user_id == user_id)
-            query.execute()  # Remove the rows, return number of rows removed.
+            with self.db.atomic():
+                ChatMessage.delete().where(
+                    ChatMessage.chat_id.in_(Chat.select(Chat.id).where(Chat.user_id == user_id))
+                ).execute()
+                ChatSearches.remove_chats(Chat.select(Chat.id).where(Chat.user_id == user_id))
+                query = Chat.delete().where(Chat.user_id == user_id)
+                query.execute()  # Remove the rows, return number of rows removed.
 
             return True
         except:
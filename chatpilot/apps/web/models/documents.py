@@ -1,6 +1,6 @@
 import json
 import time
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 import peewee as pw
 from playhouse.shortcuts import model_to_dict
@@ -27,6 +27,18 @@ class Document(pw.Model):
         database = DB
 
 
+class DocFile(pw.Model):
+    """A file of the docs dir stored by a scan, the next scan only hashes it again if its size or mtime changed."""
+    path = pw.CharField(unique=True)  # relative to the docs dir
+    size = pw.BigIntegerField()
+    mtime = pw.BigIntegerField()  # st_mtime_ns
+    sha256 = pw.CharField()
+    collection_name = pw.CharField()
+
+    class Meta:
+        database = DB
+
+
 class DocumentModel(BaseModel):
     collection_name: str
     name: str
@@ -37,6 +49,14 @@ class DocumentModel(BaseModel):
     timestamp: int  # timestamp in epoch
 
 
+class DocFileModel(BaseModel):
+    path: str
+    size: int
+    mtime: int
+    sha256: str
+    collection_name: str
+
+
 ####################
 # Forms
 ####################
@@ -119,6 +139,24 @@ class DocumentsTable:
             print(e)
             return None
 
+    def update_doc_collection_by_name(
+            self, name: str, collection_name: str, title: str
+    ) -> Optional[DocumentModel]:
+        """Point the doc at the collection of its new content, the old one may be used by another doc."""
+        try:
+            query = Document.update(
+                collection_name=collection_name,
+                title=title,
+                timestamp=int(time.time()),
+            ).where(Document.name == name)
+            query.execute()
+
+            doc = Document.get(Document.name == name)
+            return DocumentModel(**model_to_dict(doc))
+        except Exception as e:
+            print(e)
+            return None
+
     def update_doc_content_by_name(
             self, name: str, updated: dict
     ) -> Optional[DocumentModel]:
@@ -139,6 +177,12 @@ class DocumentsTable:
             print(e)
             return None
 
+    def delete_docs_by_collection_names(self, collection_names: List[str]) -> int:
+        count = 0
+        for i in range(0, len(collection_names), 500):
+            count += Document.delete().where(Document.collection_name.in_(collection_names[i:i + 500])).execute()
+        return count
+
     def delete_doc_by_name(self, name: str) -> bool:
         try:
             query = Document.delete().where((Document.name == name))
@@ -150,3 +194,34 @@ class DocumentsTable:
 
 
 Documents = DocumentsTable(DB)
+
+
+class DocFilesTable:
+    def __init__(self, db):
+        self.db = db
+        self.db.create_tables([DocFile])
+
+    def get_doc_files(self) -> Dict[str, DocFileModel]:
+        """The manifest of the docs dir, by path."""
+        return {
+            doc_file["path"]: DocFileModel(**doc_file)
+            for doc_file in DocFile.select(
+                DocFile.path, DocFile.size, DocFile.mtime, DocFile.sha256, DocFile.collection_name
+            ).dicts()
+        }
+
+    def upsert_doc_files(self, doc_files: List[DocFileModel]):
+        with self.db.atomic():
+            for i in range(0, len(doc_files), 100):
+                DocFile.insert_many([doc_file.model_dump() for doc_file in doc_files[i:i + 100]]).on_conflict(
+                    conflict_target=[DocFile.path],
+                    preserve=[DocFile.size, DocFile.mtime, DocFile.sha256, DocFile.collection_name],
+                ).execute()
+
+    def delete_doc_files(self, paths: List[str]):
+        with self.db.atomic():
+            for i in range(0, len(paths), 500):
+                DocFile.delete().where(DocFile.path.in_(paths[i:i + 500])).execute()
+
+
+DocFiles = DocFilesTable(DB)
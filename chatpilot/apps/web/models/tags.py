@@ -22,6 +22,7 @@ class Tag(pw.Model):
 
     class Meta:
         database = DB
+        indexes = ((("user_id", "name"), False),)
 
 
 class ChatIdTag(pw.Model):
@@ -33,6 +34,10 @@ class ChatIdTag(pw.Model):
 
     class Meta:
         database = DB
+        indexes = (
+            (("user_id", "tag_name"), False),
+            (("chat_id",), False),
+        )
 
 
 class TagModel(BaseModel):
@@ -60,6 +65,11 @@ class ChatIdTagForm(BaseModel):
     chat_id: str
 
 
+class ChatIdsTagsForm(BaseModel):
+    chat_ids: List[str]
+    tag_names: List[str]
+
+
 class TagChatIdsResponse(BaseModel):
     chat_ids: List[str]
 
@@ -97,55 +107,118 @@ class TagTable:
     def add_tag_to_chat(
             self, user_id: str, form_data: ChatIdTagForm
     ) -> Optional[ChatIdTagModel]:
-        tag = self.get_tag_by_name_and_user_id(form_data.tag_name, user_id)
-        if tag is None:
-            tag = self.insert_new_tag(form_data.tag_name, user_id)
-
-        id = str(uuid.uuid4())
-        chatIdTag = ChatIdTagModel(
-            **{
-                "id": id,
-                "user_id": user_id,
-                "chat_id": form_data.chat_id,
-                "tag_name": tag.name,
-                "timestamp": int(time.time()),
-            }
-        )
         try:
-            result = ChatIdTag.create(**chatIdTag.dict())
-            if result:
-                return chatIdTag
-            else:
-                return None
-        except:
+            chat_id_tags = self.add_tags_to_chats(user_id, [form_data.chat_id], [form_data.tag_name])
+            return chat_id_tags[0] if chat_id_tags else None
+        except Exception as e:
+            print("add_tag", e)
             return None
 
-    def get_tags_by_user_id(self, user_id: str) -> List[TagModel]:
-        tag_names = [
-            ChatIdTagModel(**model_to_dict(chat_id_tag)).tag_name
-            for chat_id_tag in ChatIdTag.select()
-            .where(ChatIdTag.user_id == user_id)
-            .order_by(ChatIdTag.timestamp.desc())
-        ]
+    def add_tags_to_chats(
+            self, user_id: str, chat_ids: List[str], tag_names: List[str]
+    ) -> List[ChatIdTagModel]:
+        """Tag every chat with every tag name in one transaction, pairs that exist already are skipped."""
+        chat_ids, tag_names = list(dict.fromkeys(chat_ids)), list(dict.fromkeys(tag_names))
+        if not chat_ids or not tag_names:
+            return []
+        timestamp = int(time.time())
+        with self.db.atomic():
+            names = set()
+            for j in range(0, len(tag_names), 400):
+                names.update(
+                    tag.name
+                    for tag in Tag.select(Tag.name).where(
+                        (Tag.user_id == user_id) & (Tag.name.in_(tag_names[j:j + 400]))
+                    )
+                )
+            new_tags = [
+                {"id": str(uuid.uuid4()), "user_id": user_id, "name": name}
+                for name in tag_names
+                if name not in names
+            ]
+            if new_tags:
+                Tag.insert_many(new_tags).execute()
+
+            existing = set()
+            # 500 chat ids and 400 tag names per query, under the 999 variables of older SQLite
+            for i in range(0, len(chat_ids), 500):
+                for j in range(0, len(tag_names), 400):
+                    existing.update(
+                        ChatIdTag.select(ChatIdTag.chat_id, ChatIdTag.tag_name)
+                        .where(
+                            (ChatIdTag.user_id == user_id)
+                            & (ChatIdTag.chat_id.in_(chat_ids[i:i + 500]))
+                            & (ChatIdTag.tag_name.in_(tag_names[j:j + 400]))
+                        )
+                        .tuples()
+                    )
+            chat_id_tags = [
+                ChatIdTagModel(
+                    id=str(uuid.uuid4()),
+                    user_id=user_id,
+                    chat_id=chat_id,
+                    tag_name=tag_name,
+                    timestamp=timestamp,
+                )
+                for chat_id in chat_ids
+                for tag_name in tag_names
+                if (chat_id, tag_name) not in existing
+            ]
+            for i in range(0, len(chat_id_tags), 100):
+                ChatIdTag.insert_many([t.model_dump() for t in chat_id_tags[i:i + 100]]).execute()
+        return chat_id_tags
+
+    def remove_tags_from_chats(self, user_id: str, chat_ids: List[str], tag_names: List[str]) -> int:
+        """Untag the chats in one transaction, tags left without chats are deleted. Return the number removed."""
+        tag_names = list(dict.fromkeys(tag_names))
+        count = 0
+        with self.db.atomic():
+            for i in range(0, len(chat_ids), 500):
+                for j in range(0, len(tag_names), 400):
+                    count += ChatIdTag.delete().where(
+                        (ChatIdTag.user_id == user_id)
+                        & (ChatIdTag.chat_id.in_(chat_ids[i:i + 500]))
+                        & (ChatIdTag.tag_name.in_(tag_names[j:j + 400]))
+                    ).execute()
+            self._delete_unused_tags(user_id, tag_names)
+        return count
+
+    def _delete_unused_tags(self, user_id: str, tag_names: List[str]):
+        """Delete the tags of tag_names that no chat of the user has anymore, one query per 500 names."""
+        for i in range(0, len(tag_names), 500):
+            Tag.delete().where(
+                (Tag.user_id == user_id)
+                & (Tag.name.in_(tag_names[i:i + 500]))
+                & ~pw.fn.EXISTS(
+                    ChatIdTag.select(ChatIdTag.id).where(
+                        (ChatIdTag.user_id == user_id) & (ChatIdTag.tag_name == Tag.name)
+                    )
+                )
+            ).execute()
 
+    def get_tags_by_user_id(self, user_id: str) -> List[TagModel]:
+        """Tags that are on chats of the user, the most recently used first."""
         return [
-            TagModel(**model_to_dict(tag))
-            for tag in Tag.select().where(Tag.name.in_(tag_names))
+            TagModel(**tag)
+            for tag in Tag.select(Tag.id, Tag.name, Tag.user_id, Tag.data)
+            .join(ChatIdTag, on=((ChatIdTag.user_id == Tag.user_id) & (ChatIdTag.tag_name == Tag.name)))
+            .where(Tag.user_id == user_id)
+            .group_by(Tag.id)
+            .order_by(pw.fn.MAX(ChatIdTag.timestamp).desc())
+            .dicts()
         ]
 
     def get_tags_by_chat_id_and_user_id(
             self, chat_id: str, user_id: str
     ) -> List[TagModel]:
-        tag_names = [
-            ChatIdTagModel(**model_to_dict(chat_id_tag)).tag_name
-            for chat_id_tag in ChatIdTag.select()
-            .where((ChatIdTag.user_id == user_id) & (ChatIdTag.chat_id == chat_id))
-            .order_by(ChatIdTag.timestamp.desc())
-        ]
-
         return [
-            TagModel(**model_to_dict(tag))
-            for tag in Tag.select().where(Tag.name.in_(tag_names))
+            TagModel(**tag)
+            for tag in Tag.select(Tag.id, Tag.name, Tag.user_id, Tag.data)
+            .join(ChatIdTag, on=((ChatIdTag.user_id == Tag.user_id) & (ChatIdTag.tag_name == Tag.name)))
+            .where((ChatIdTag.user_id == user_id) & (ChatIdTag.chat_id == chat_id))
+            .group_by(Tag.id)
+            .order_by(pw.fn.MAX(ChatIdTag.timestamp).desc())
+            .dicts()
         ]
 
     def get_chat_ids_by_tag_name_and_user_id(
@@ -169,19 +242,14 @@ class TagTable:
 
     def delete_tag_by_tag_name_and_user_id(self, tag_name: str, user_id: str) -> bool:
         try:
-            query = ChatIdTag.delete().where(
-                (ChatIdTag.tag_name == tag_name) & (ChatIdTag.user_id == user_id)
-            )
-            res = query.execute()  # Remove the rows, return number of rows removed.
-            print(res)
-
-            tag_count = self.count_chat_ids_by_tag_name_and_user_id(tag_name, user_id)
-            if tag_count == 0:
-                # Remove tag item from Tag col as well
-                query = Tag.delete().where(
+            with self.db.atomic():
+                ChatIdTag.delete().where(
+                    (ChatIdTag.tag_name == tag_name) & (ChatIdTag.user_id == user_id)
+                ).execute()
+                # No chat has the tag anymore, remove tag item from Tag col as well
+                Tag.delete().where(
                     (Tag.name == tag_name) & (Tag.user_id == user_id)
-                )
-                query.execute()  # Remove the rows, return number of rows removed.
+                ).execute()
 
             return True
         except Exception as e:
@@ -192,36 +260,25 @@ class TagTable:
             self, tag_name: str, chat_id: str, user_id: str
     ) -> bool:
         try:
-            query = ChatIdTag.delete().where(
-                (ChatIdTag.tag_name == tag_name)
-                & (ChatIdTag.chat_id == chat_id)
-                & (ChatIdTag.user_id == user_id)
-            )
-            res = query.execute()  # Remove the rows, return number of rows removed.
-            print(res)
-
-            tag_count = self.count_chat_ids_by_tag_name_and_user_id(tag_name, user_id)
-            if tag_count == 0:
-                # Remove tag item from Tag col as well
-                query = Tag.delete().where(
-                    (Tag.name == tag_name) & (Tag.user_id == user_id)
-                )
-                query.execute()  # Remove the rows, return number of rows removed.
-
+            self.remove_tags_from_chats(user_id, [chat_id], [tag_name])
             return True
         except Exception as e:
             print("delete_tag", e)
             return False
 
     def delete_tags_by_chat_id_and_user_id(self, chat_id: str, user_id: str) -> bool:
-        tags = self.get_tags_by_chat_id_and_user_id(chat_id, user_id)
-
-        for t in tags:
-            self.delete_tag_by_tag_name_and_chat_id_and_user_id(
-                t.name, chat_id, user_id
-            )
-
-        return True
+        try:
+            with self.db.atomic():
+                tag_names = [
+                    chat_id_tag.tag_name
+                    for chat_id_tag in ChatIdTag.select(ChatIdTag.tag_name)
+                    .where((ChatIdTag.chat_id == chat_id) & (ChatIdTag.user_id == user_id))
+                ]
+                self.remove_tags_from_chats(user_id, [chat_id], tag_names)
+            return True
+        except Exception as e:
+            print("delete_tag", e)
+            return False
 
 
 Tags = TagTable(DB)
@@ -5,6 +5,7 @@ import peewee as pw
 from playhouse.shortcuts import model_to_dict
 from pydantic import BaseModel
 
+from chatpilot.apps.auth_utils import invalidate_user_cache
 from chatpilot.apps.db import DB
 from chatpilot.apps.web.models.chats import Chats
 
@@ -104,6 +105,7 @@ class UsersTable:
         try:
             query = User.update(role=role).where(User.id == id)
             query.execute()
+            invalidate_user_cache(id)
 
             user = User.get(User.id == id)
             return UserModel(**model_to_dict(user))
@@ -118,6 +120,7 @@ class UsersTable:
                 User.id == id
             )
             query.execute()
+            invalidate_user_cache(id)
 
             user = User.get(User.id == id)
             return UserModel(**model_to_dict(user))
@@ -128,6 +131,7 @@ class UsersTable:
         try:
             query = User.update(**updated).where(User.id == id)
             query.execute()
+            invalidate_user_cache(id)
 
             user = User.get(User.id == id)
             return UserModel(**model_to_dict(user))
@@ -143,6 +147,7 @@ class UsersTable:
                 # Delete User
                 query = User.delete().where(User.id == id)
                 query.execute()  # Remove the rows, return number of rows removed.
+                invalidate_user_cache(id)
 
                 return True
             else:
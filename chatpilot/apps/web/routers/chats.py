@@ -1,19 +1,26 @@
 import json
-from typing import List, Optional
+import zlib
+from typing import Iterator, List, Literal, Optional
 
 from fastapi import APIRouter
-from fastapi import Depends, Request, HTTPException, status
+from fastapi import Depends, Request, Response, HTTPException, status
+from fastapi.responses import StreamingResponse
 
 from chatpilot.apps.web.models.chats import (
+    ChatModel,
     ChatResponse,
     ChatForm,
+    ChatMessagesForm,
     ChatTitleIdResponse,
     Chats,
+    get_chat_cursor,
 )
+from chatpilot.apps.web.models.chat_search import ChatSearchResponse, ChatSearches
 from chatpilot.apps.web.models.tags import (
     TagModel,
     ChatIdTagModel,
     ChatIdTagForm,
+    ChatIdsTagsForm,
     Tags,
 )
 from chatpilot.apps.auth_utils import get_current_user, get_admin_user
@@ -29,9 +36,82 @@ router = APIRouter()
 
 @router.get("/", response_model=List[ChatTitleIdResponse])
 async def get_user_chats(
-        user=Depends(get_current_user), skip: int = 0, limit: int = 50
+        response: Response,
+        user=Depends(get_current_user),
+        skip: int = 0,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
 ):
-    return Chats.get_chat_lists_by_user_id(user.id, skip, limit)
+    """Newest first, all chats by default. With limit, the `X-Next-Cursor` header is the cursor of the next page."""
+    try:
+        chats = Chats.get_chat_lists_by_user_id(user.id, skip, limit, cursor)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=ERROR_MESSAGES.DEFAULT("Invalid cursor")
+        )
+    if limit and len(chats) == limit:
+        response.headers["X-Next-Cursor"] = get_chat_cursor(chats[-1])
+    return chats
+
+
+############################
+# ExportChats
+############################
+
+
+def _encode_chat(chat: ChatModel) -> str:
+    """ChatResponse json of a chat, the stored chat json is embedded as is instead of parsed and dumped again."""
+    return (
+        f'{{"id":{json.dumps(chat.id)},"user_id":{json.dumps(chat.user_id)},"title":{json.dumps(chat.title)},'
+        f'"chat":{chat.chat},"timestamp":{int(chat.timestamp)}}}'
+    )
+
+
+def _iter_export(chats: Iterator[ChatModel], format: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    first = True
+    buffer = ["["] if format == "json" else []
+    size = 0
+    for chat in chats:
+        if format == "json":
+            item = _encode_chat(chat) if first else "," + _encode_chat(chat)
+        else:
+            item = _encode_chat(chat) + "\n"
+        first = False
+        buffer.append(item)
+        size += len(item)
+        if size >= chunk_size:
+            yield "".join(buffer).encode("utf-8")
+            buffer, size = [], 0
+    if format == "json":
+        buffer.append("]")
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def _iter_gzip(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chats(chats: Iterator[ChatModel], format: str = "json", gzip: bool = False) -> StreamingResponse:
+    """
+    Stream chats one at a time, memory stays constant whatever the db size is.
+
+    :param chats: Such as `Chats.iter_chats(user_id)`.
+    :param format: `json` for a json array, `ndjson` for one chat per line.
+    :param gzip: Compress the body with `Content-Encoding: gzip`.
+    """
+    body = _iter_export(chats, format)
+    headers = {}
+    if gzip:
+        body = _iter_gzip(body)
+        headers["Content-Encoding"] = "gzip"
+    media_type = "application/json" if format == "json" else "application/x-ndjson"
+    return StreamingResponse(body, media_type=media_type, headers=headers)
 
 
 ############################
@@ -40,11 +120,12 @@ async def get_user_chats(
 
 
 @router.get("/all", response_model=List[ChatResponse])
-async def get_all_user_chats(user=Depends(get_current_user)):
-    return [
-        ChatResponse(**{**chat.model_dump(), "chat": json.loads(chat.chat)})
-        for chat in Chats.get_all_chats_by_user_id(user.id)
-    ]
+async def get_all_user_chats(
+        user=Depends(get_current_user),
+        format: Literal["json", "ndjson"] = "json",
+        gzip: bool = False,
+):
+    return export_chats(Chats.iter_chats(user.id), format, gzip)
 
 
 ############################
@@ -53,11 +134,12 @@ async def get_all_user_chats(user=Depends(get_current_user)):
 
 
 @router.get("/all/db", response_model=List[ChatResponse])
-async def get_all_user_chats_in_db(user=Depends(get_admin_user)):
-    return [
-        ChatResponse(**{**chat.model_dump(), "chat": json.loads(chat.chat)})
-        for chat in Chats.get_all_chats()
-    ]
+async def get_all_user_chats_in_db(
+        user=Depends(get_admin_user),
+        format: Literal["json", "ndjson"] = "json",
+        gzip: bool = False,
+):
+    return export_chats(Chats.iter_chats(), format, gzip)
 
 
 ############################
@@ -103,12 +185,7 @@ async def get_all_tags(user=Depends(get_current_user)):
 async def get_user_chats_by_tag_name(
         tag_name: str, user=Depends(get_current_user), skip: int = 0, limit: int = 50
 ):
-    chat_ids = [
-        chat_id_tag.chat_id
-        for chat_id_tag in Tags.get_chat_ids_by_tag_name_and_user_id(tag_name, user.id)
-    ]
-
-    chats = Chats.get_chat_lists_by_chat_ids(chat_ids, skip, limit)
+    chats = Chats.get_chat_lists_by_tag_name_and_user_id(tag_name, user.id, skip, limit)
 
     if len(chats) == 0:
         Tags.delete_tag_by_tag_name_and_user_id(tag_name, user.id)
@@ -116,6 +193,53 @@ async def get_user_chats_by_tag_name(
     return chats
 
 
+############################
+# AddTagsToChats
+############################
+
+
+@router.post("/tags/bulk", response_model=List[ChatIdTagModel])
+async def add_tags_to_chats(form_data: ChatIdsTagsForm, user=Depends(get_current_user)):
+    """Tag many chats at once, in one transaction. Return the new chat tags, existing ones are skipped."""
+    try:
+        return Tags.add_tags_to_chats(user.id, form_data.chat_ids, form_data.tag_names)
+    except Exception as e:
+        print(e)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=ERROR_MESSAGES.DEFAULT()
+        )
+
+
+############################
+# RemoveTagsFromChats
+############################
+
+
+@router.delete("/tags/bulk", response_model=int)
+async def remove_tags_from_chats(form_data: ChatIdsTagsForm, user=Depends(get_current_user)):
+    """Untag many chats at once, in one transaction. Return the number of chat tags removed."""
+    try:
+        return Tags.remove_tags_from_chats(user.id, form_data.chat_ids, form_data.tag_names)
+    except Exception as e:
+        print(e)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=ERROR_MESSAGES.DEFAULT()
+        )
+
+
+############################
+# SearchChats
+############################
+
+
+@router.get("/search", response_model=List[ChatSearchResponse])
+async def search_user_chats(
+        q: str, user=Depends(get_current_user), skip: int = 0, limit: int = 20
+):
+    """Chats whose title or messages contain all words of q, best match first, with a highlighted snippet."""
+    return ChatSearches.search(user.id, q, skip, limit)
+
+
 ############################
 # GetChatById
 ############################
@@ -142,11 +266,9 @@ async def get_chat_by_id(id: str, user=Depends(get_current_user)):
 async def update_chat_by_id(
         id: str, form_data: ChatForm, user=Depends(get_current_user)
 ):
-    chat = Chats.get_chat_by_id_and_user_id(id, user.id)
+    # Only the new or changed messages are written
+    chat = Chats.merge_chat_by_id_and_user_id(id, user.id, form_data.chat)
     if chat:
-        updated_chat = {**json.loads(chat.chat), **form_data.chat}
-
-        chat = Chats.update_chat_by_id(id, updated_chat)
         return ChatResponse(**{**chat.model_dump(), "chat": json.loads(chat.chat)})
     else:
         raise HTTPException(
@@ -155,6 +277,19 @@ async def update_chat_by_id(
         )
 
 
+@router.post("/{id}/messages", response_model=bool)
+async def append_chat_messages_by_id(
+        id: str, form_data: ChatMessagesForm, user=Depends(get_current_user)
+):
+    # Only the sent messages are written, such as a response and its parents, not the whole history
+    if Chats.append_messages(id, user.id, form_data.messages, form_data.currentId) is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=ERROR_MESSAGES.ACCESS_PROHIBITED,
+        )
+    return True
+
+
 ############################
 # DeleteChatById
 ############################
@@ -203,7 +338,7 @@ async def add_chat_tag_by_id(
 ):
     tags = Tags.get_tags_by_chat_id_and_user_id(id, user.id)
 
-    if form_data.tag_name not in tags:
+    if form_data.tag_name not in [tag.name for tag in tags]:
         tag = Tags.add_tag_to_chat(user.id, form_data)
 
         if tag:
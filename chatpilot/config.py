@@ -25,6 +25,9 @@ else:
 
 DATA_DIR = str(os.path.expanduser(os.getenv("DATA_DIR", "~/.cache/chatpilot/data")))
 DB_PATH = f"{DATA_DIR}/web.db"
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", 64 * 1024))  # page cache per connection, KiB
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 1024 * 1024))  # bytes
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", 5000))  # ms
 ENV = os.getenv("ENV", "dev")
 # Frontend build dir, which is npm build dir
 FRONTEND_BUILD_DIR = str(Path(os.getenv("FRONTEND_BUILD_DIR", os.path.join(pwd_path, "../web/build"))))
@@ -101,6 +104,23 @@ if OLLAMA_BASE_URL == "" and OLLAMA_API_BASE_URL != "":
 
 OLLAMA_BASE_URLS = [url.strip() for url in OLLAMA_BASE_URL.split(";")]
 
+# Circuit breaker of the Ollama load balancer
+OLLAMA_CB_FAILURE_THRESHOLD = int(os.getenv("OLLAMA_CB_FAILURE_THRESHOLD", 3))  # consecutive failures to eject a node
+OLLAMA_CB_COOLDOWN = float(os.getenv("OLLAMA_CB_COOLDOWN", 30))  # seconds before an ejected node is retried
+
+####################################
+# HTTP client for upstream calls
+####################################
+
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 256))  # max keep-alive connections per app
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 64))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 300))  # max seconds between two chunks of a stream
+
+# Model list cache, served from memory and refreshed in the background when older than ttl
+MODEL_CATALOG_TTL = float(os.getenv("MODEL_CATALOG_TTL", 60))
+MODEL_CATALOG_TIMEOUT = float(os.getenv("MODEL_CATALOG_TIMEOUT", 5))  # seconds to wait for a model list upstream
+
 ####################################
 # OPENAI_API
 ####################################
@@ -121,8 +141,16 @@ DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1"
 MOONSHOT_API_KEY = os.getenv("MOONSHOT_API_KEY", "")
 MOONSHOT_API_BASE = os.getenv("MOONSHOT_API_BASE", "https://api.moonshot.cn/v1")
 
+# Agent pool, reuse warm agents per conversation
+AGENT_POOL_MAX_SIZE = int(os.getenv("AGENT_POOL_MAX_SIZE", 256))
+AGENT_POOL_TTL = int(os.getenv("AGENT_POOL_TTL", 1800))  # idle seconds before an agent is evicted
+
 RPD = int(os.getenv("RPD", -1))  # RPD(Request Pre Day)
 RPM = int(os.getenv("RPM", -1))  # RPM(Request Per Minute)
+# Where the request counters live: memory (one worker), sqlite (workers on one host), redis (all hosts)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", f"{DATA_DIR}/rate_limit.db")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
 
 # Search engine
 SERPER_API_KEY = os.getenv("SERPER_API_KEY", None)
@@ -136,12 +164,49 @@ E2B_API_KEY = os.getenv("E2B_API_KEY", None)
 ####################################
 
 CHROMA_DATA_PATH = f"{DATA_DIR}/vector_db"
+# Vector store of the collections: chroma, or local to keep them as memory-mapped NumPy files
+RAG_VECTOR_STORE = os.getenv("RAG_VECTOR_STORE", "chroma")
+LOCAL_VECTOR_DATA_PATH = f"{DATA_DIR}/local_vector_db"
+# Vectors of new local collections stored as int8, a quarter of the size, at a small loss of precision
+RAG_VECTOR_QUANTIZE = os.getenv("RAG_VECTOR_QUANTIZE", "False").lower() == "true"
+# Local collections with this many chunks are searched by an IVF index, in RAG_ANN_NPROBE of its lists, 0 is exact
+RAG_ANN_MIN_SIZE = int(os.getenv("RAG_ANN_MIN_SIZE", 100000))
+RAG_ANN_NPROBE = int(os.getenv("RAG_ANN_NPROBE", 16))
+# Candidates of the HNSW search of new chroma collections, 0 is chroma's default
+RAG_ANN_EF = int(os.getenv("RAG_ANN_EF", 0))
 # openai embedding is support, text2vec and sentence-transformers are also available
 RAG_EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL", "text-embedding-ada-002")
+# Embeddings cached by (model, text hash), so the same chunk or query is never embedded twice, 0 disables
+RAG_EMBEDDING_CACHE_SIZE = int(os.getenv("RAG_EMBEDDING_CACHE_SIZE", 100000))
+RAG_EMBEDDING_CACHE_PATH = os.getenv("RAG_EMBEDDING_CACHE_PATH", f"{CACHE_DIR}/embeddings.db")
+# Documents are embedded in batches of this many chunks, with this many batches in flight
+RAG_EMBEDDING_BATCH_SIZE = int(os.getenv("RAG_EMBEDDING_BATCH_SIZE", 64))
+RAG_EMBEDDING_CONCURRENCY = int(os.getenv("RAG_EMBEDDING_CONCURRENCY", 4))
+# Uploads and scans are stored by background jobs, persisted so a restart resumes them
+RAG_JOB_DB_PATH = os.getenv("RAG_JOB_DB_PATH", f"{DATA_DIR}/rag_jobs.db")
+RAG_JOB_WORKERS = int(os.getenv("RAG_JOB_WORKERS", 2))
+# Processes that parse the files of a docs dir scan
+RAG_SCAN_PROCESSES = int(os.getenv("RAG_SCAN_PROCESSES", os.cpu_count() or 1))
+# Keyword (bm25) index of the chunks, built at ingest for the hybrid search mode
+RAG_LEXICAL_INDEX_PATH = os.getenv("RAG_LEXICAL_INDEX_PATH", f"{DATA_DIR}/rag_lexical.db")
 
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1000))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 100))
+# char, or token to size the chunks in tokens of the tokenizer
+CHUNK_UNIT = os.getenv("CHUNK_UNIT", "char")
 RAG_TOP_K = int(os.getenv("RAG_TOP_K", 5))
+# vector, or hybrid to fuse the vector and keyword results
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "hybrid")
+RAG_CONTEXT_MAX_TOKENS = int(os.getenv("RAG_CONTEXT_MAX_TOKENS", 3000))
+# Budget of the context per model, such as "gpt-4o:8000,gpt-3.5-turbo:2000", other models have the one above
+RAG_CONTEXT_MODEL_MAX_TOKENS = {
+    model.strip(): int(tokens)
+    for model, tokens in (
+        item.rsplit(":", 1) for item in os.getenv("RAG_CONTEXT_MODEL_MAX_TOKENS", "").split(",") if item.strip()
+    )
+}
+# Chunks scoring under this ratio of the best chunk are left out of the context, 0 keeps all
+RAG_CONTEXT_MIN_SCORE_RATIO = float(os.getenv("RAG_CONTEXT_MIN_SCORE_RATIO", 0.4))
 DOC_TEXT_LENGTH_LIMIT = int(os.getenv("DOC_TEXT_LENGTH_LIMIT", -1))
 
 RAG_TEMPLATE = """根据以下文档资料（context）回答问题，不要使用外部工具。
@@ -258,3 +323,7 @@ WEBUI_SECRET_KEY = os.getenv(
 
 if WEBUI_AUTH and WEBUI_SECRET_KEY == "":
     raise ValueError(ERROR_MESSAGES.ENV_VAR_NOT_FOUND)
+
+# Cache of verified tokens and their users, saves a jwt decode and a db lookup per request
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", 4096))
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", 60))
@@ -11,6 +11,7 @@ from typing import List
 import requests
 from fastapi import FastAPI, Request, Depends, status
 from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
@@ -89,12 +90,17 @@ class RAGMiddleware(BaseHTTPMiddleware):
             # data["modified"] = True  # Example modification
             if "docs" in data:
                 data = {**data}
-                data["messages"] = rag_messages(
+                # Embedding and search block, keep them off the event loop
+                data["messages"] = await run_in_threadpool(
+                    rag_messages,
                     data["docs"],
                     data["messages"],
                     rag_app.state.RAG_TEMPLATE,
                     rag_app.state.TOP_K,
                     rag_app.state.sentence_transformer_ef,
+                    rag_app.state.CONTEXT_MODEL_MAX_TOKENS.get(data.get("model"), rag_app.state.CONTEXT_MAX_TOKENS),
+                    rag_app.state.SEARCH_MODE,
+                    rag_app.state.CONTEXT_MIN_SCORE_RATIO,
                 )
                 del data["docs"]
             logger.debug(f"data: {data}")
@@ -147,6 +153,13 @@ async def on_startup():
     await litellm_app_startup()
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Mounted sub apps get no lifespan events, close their pooled http clients here
+    for sub_app in [ollama_app, openai_app, images_app]:
+        await sub_app.state.HTTP_CLIENT.close()
+
+
 app.mount("/api/v1", webui_app)
 app.mount("/litellm/api", litellm_app)
 # app.mount("/dashscope/api", dashscope_app)
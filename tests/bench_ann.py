@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Benchmark recall and latency of the IVF index of the local vector store against exact search
+
+usage:
+    python bench_ann.py --size 1000000 --dim 384 --nprobe 4 8 16 32 64
+    python bench_ann.py --quantize  # int8 vectors
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append('..')
+from chatpilot.apps.vector_store import LocalVectorStore
+
+
+def make_vectors(rng, dim, clusters, noise):
+    """Batches of gaussian clusters, closer to real embeddings than uniform noise, which no index can search well."""
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    while True:
+        labels = rng.integers(0, clusters, 10000)
+        yield centers[labels] + rng.normal(scale=noise, size=(len(labels), dim)).astype(np.float32)
+
+
+def timed_query(collection, queries, k, nprobe):
+    ids, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=[query.tolist()], n_results=k, nprobe=nprobe)
+        latencies.append(time.perf_counter() - start)
+        ids.append(set(result["ids"][0]))
+    return ids, np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200000, help="chunks in the collection")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--noise", type=float, default=2.0, help="spread of a cluster, 1 is as far as the centers")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    parser.add_argument("--quantize", action="store_true", help="int8 vectors")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = LocalVectorStore(tmp_dir, quantize=args.quantize, ann_min_size=args.size)
+        collection = store.create_collection("bench")
+        start = time.perf_counter()
+        added = 0
+        batches = make_vectors(rng, args.dim, args.clusters, args.noise)
+        for vectors in batches:
+            vectors = vectors[:args.size - added]
+            collection.add(
+                ids=[str(i) for i in range(added, added + len(vectors))],
+                embeddings=vectors,
+                documents=[""] * len(vectors),
+            )
+            added += len(vectors)
+            if added >= args.size:
+                break
+        info = collection._read_info()
+        size = sum(os.path.getsize(os.path.join(collection.path, name)) for name in os.listdir(collection.path))
+        print(
+            f"stored {added} vectors of {args.dim} in {time.perf_counter() - start:.1f}s with the index training, "
+            f"{info['ivf']['nlist']} lists, {size / 2 ** 20:.0f}MB on disk"
+        )
+
+        # Queries from the same clusters as the stored vectors
+        queries = next(batches)[:args.queries]
+        exact_ids, latencies = timed_query(collection, queries, args.k, 0)
+        print(f"exact     recall@{args.k}: 1.000  p50: {np.percentile(latencies, 50):7.2f}ms  "
+              f"p95: {np.percentile(latencies, 95):7.2f}ms")
+        for nprobe in args.nprobe:
+            ids, latencies = timed_query(collection, queries, args.k, nprobe)
+            recall = np.mean([len(found & exact) / len(exact) for found, exact in zip(ids, exact_ids)])
+            print(f"nprobe {nprobe:<3}recall@{args.k}: {recall:.3f}  p50: {np.percentile(latencies, 50):7.2f}ms  "
+                  f"p95: {np.percentile(latencies, 95):7.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Benchmark chat saves and sidebar loads of the web db under concurrent writers
+
+usage:
+    python bench_db.py --writers 8 --readers 8 --seconds 10
+    python bench_db.py --legacy  # the old setup, rollback journal and default pragmas
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append('..')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def report(name, latencies, errors, seconds):
+    ms = [i * 1000 for i in latencies]
+    print(
+        f"{name:<8} ops/s: {len(ms) / seconds:8.1f}  p50: {percentile(ms, 0.5):7.2f}ms  "
+        f"p95: {percentile(ms, 0.95):7.2f}ms  p99: {percentile(ms, 0.99):7.2f}ms  errors: {errors}"
+    )
+
+
+def write_bytes():
+    """Bytes this process caused to be written to storage, linux only."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def db_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--chats", type=int, default=20, help="chats per user")
+    parser.add_argument("--messages", type=int, default=200, help="messages per chat at start")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--legacy", action="store_true", help="no WAL and default pragmas")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="chatpilot_bench_")
+    os.environ["DATA_DIR"] = data_dir
+    from chatpilot.apps.db import DB
+    from chatpilot.apps.web.models.chats import Chats, ChatForm
+
+    if args.legacy:
+        DB.close()
+        DB.init(os.path.join(data_dir, "web.db"), pragmas={})
+        DB.execute_sql("PRAGMA journal_mode=delete")
+    print(f"db: {DB.database}, pragmas: {DB._pragmas}")
+
+    def add_message(chat):
+        messages = chat["history"]["messages"]
+        parent_id = chat["history"]["currentId"]
+        message_id = str(len(messages))
+        messages[message_id] = {
+            "id": message_id,
+            "parentId": parent_id,
+            "childrenIds": [],
+            "role": "user" if len(messages) % 2 == 0 else "assistant",
+            "content": "hello world " * 40,
+        }
+        if parent_id is not None:
+            messages[parent_id]["childrenIds"].append(message_id)
+        chat["history"]["currentId"] = message_id
+        chat["messages"] = chat["messages"] + [messages[message_id]]
+
+    def make_chat(i):
+        chat = {"title": f"chat {i}", "messages": [], "history": {"messages": {}, "currentId": None}}
+        for _ in range(args.messages):
+            add_message(chat)
+        return chat
+
+    chat_ids, chats = {}, {}
+    t0 = time.time()
+    with DB.atomic():
+        for u in range(args.users):
+            user_id = f"user-{u}"
+            chat_ids[user_id] = []
+            for i in range(args.chats):
+                chat = make_chat(i)
+                chat_id = Chats.insert_new_chat(user_id, ChatForm(chat=chat)).id
+                chat_ids[user_id].append(chat_id)
+                chats[chat_id] = chat
+    print(f"seeded {args.users * args.chats} chats in {time.time() - t0:.2f}s")
+
+    stop = threading.Event()
+    results = {"save": ([], [0]), "sidebar": ([], [0])}
+    lock = threading.Lock()
+
+    def writer(own_chat_ids):
+        # Each save adds one message to a conversation, like a chat that goes on
+        latencies, errors = [], 0
+        while not stop.is_set():
+            chat_id = random.choice(own_chat_ids)
+            chat = chats[chat_id]
+            add_message(chat)
+            start = time.perf_counter()
+            if Chats.update_chat_by_id(chat_id, chat) is None:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+        DB.close()
+        with lock:
+            results["save"][0].extend(latencies)
+            results["save"][1][0] += errors
+
+    def reader():
+        latencies, errors = [], 0
+        while not stop.is_set():
+            user_id = random.choice(list(chat_ids))
+            start = time.perf_counter()
+            try:
+                Chats.get_chat_lists_by_user_id(user_id)
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+        DB.close()
+        with lock:
+            results["sidebar"][0].extend(latencies)
+            results["sidebar"][1][0] += errors
+
+    all_chat_ids = list(chats)
+    threads = [threading.Thread(target=writer, args=(all_chat_ids[i::args.writers],)) for i in range(args.writers)]
+    threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+    written, size = write_bytes(), db_size(DB.database)
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    print(f"writers: {args.writers}, readers: {args.readers}, seconds: {args.seconds}")
+    for name, (latencies, errors) in results.items():
+        report(name, latencies, errors[0], args.seconds)
+    saves = max(len(results["save"][0]), 1)
+    if written is not None:
+        print(f"written per save: {(write_bytes() - written) / saves / 1024:.1f}KiB")
+    print(f"db + wal growth per save: {(db_size(DB.database) - size) / saves / 1024:.1f}KiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Benchmark the throughput of the offset based text splitter against the previous, string based one
+
+usage:
+    python bench_text_splitter.py --size 100
+    python bench_text_splitter.py --file corpus.txt --chunk-size 500 --chunk-overlap 50
+"""
+import argparse
+import random
+import re
+import sys
+import time
+from typing import Iterable, List
+
+from langchain_core.documents import Document
+
+sys.path.append('..')
+from chatpilot.apps.text_splitter import ChineseRecursiveTextSplitter
+
+
+class LegacyTextSplitter(ChineseRecursiveTextSplitter):
+    """The splitter before the offsets, which re-splits strings at each separator and copies the metadata."""
+
+    @staticmethod
+    def _split_text_with_regex_from_end(text: str, separator: str, keep_separator: bool) -> List[str]:
+        if separator:
+            if keep_separator:
+                _splits = re.split(f"({separator})", text)
+                splits = ["".join(i) for i in zip(_splits[0::2], _splits[1::2])]
+                if len(_splits) % 2 == 1:
+                    splits += _splits[-1:]
+            else:
+                splits = re.split(separator, text)
+        else:
+            splits = list(text)
+        return [s for s in splits if s != ""]
+
+    def _split_text(self, text: str, separators: List[str]) -> List[str]:
+        final_chunks = []
+        separator = separators[-1]
+        new_separators = []
+        for i, _s in enumerate(separators):
+            _separator = _s if self._is_separator_regex else re.escape(_s)
+            if _s == "":
+                separator = _s
+                break
+            if re.search(_separator, text):
+                separator = _s
+                new_separators = separators[i + 1:]
+                break
+
+        _separator = separator if self._is_separator_regex else re.escape(separator)
+        splits = self._split_text_with_regex_from_end(text, _separator, self._keep_separator)
+
+        _good_splits = []
+        _separator = "" if self._keep_separator else separator
+        for s in splits:
+            if self._length_function(s) < self._chunk_size:
+                _good_splits.append(s)
+            else:
+                if _good_splits:
+                    final_chunks.extend(self._merge_splits(_good_splits, _separator))
+                    _good_splits = []
+                if not new_separators:
+                    final_chunks.append(s)
+                else:
+                    final_chunks.extend(self._split_text(s, new_separators))
+        if _good_splits:
+            final_chunks.extend(self._merge_splits(_good_splits, _separator))
+        return [re.sub(r"\n{2,}", "\n", chunk.strip()) for chunk in final_chunks if chunk.strip() != ""]
+
+    def split_text(self, text: str) -> List[str]:
+        return self._split_text(text, self._separators)
+
+    def split_documents(self, documents: Iterable[Document]) -> List[Document]:
+        documents = list(documents)
+        return self.create_documents([doc.page_content for doc in documents], [doc.metadata for doc in documents])
+
+
+def make_text(rng: random.Random, size: int) -> str:
+    """Paragraphs of Chinese and English sentences, of about `size` bytes in UTF-8."""
+    words = ["the", "model", "retrieval", "vector", "index", "query", "chunk", "document", "search", "embedding"]
+    hanzi = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定"
+    parts, length = [], 0
+    while length < size:
+        if rng.random() < 0.5:
+            sentence = "".join(rng.choices(hanzi, k=rng.randint(8, 60)))
+            sentence += rng.choice(["，", "。", "！", "？", "；"])
+        else:
+            sentence = " ".join(rng.choices(words, k=rng.randint(4, 25)))
+            sentence += rng.choice([", ", ". ", "! ", "? ", "; "])
+        if rng.random() < 0.1:
+            sentence += rng.choice(["\n", "\n\n", "\n\n\n"])
+        parts.append(sentence)
+        length += len(sentence.encode("utf-8"))
+    return "".join(parts)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=float, default=20, help="MB of generated text, if no file")
+    parser.add_argument("--file", type=str, default=None, help="UTF-8 text file to split")
+    parser.add_argument("--doc-size", type=int, default=100000, help="characters of a document, as a page or a file")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = make_text(random.Random(0), int(args.size * 1e6))
+    mb = len(text.encode("utf-8")) / 1e6
+    documents = [
+        Document(page_content=text[start:start + args.doc_size], metadata={"source": f"doc{start}", "page": start})
+        for start in range(0, len(text), args.doc_size)
+    ]
+    print(f"{mb:.1f} MB, {len(documents)} documents, chunk size {args.chunk_size}, overlap {args.chunk_overlap}")
+
+    kwargs = dict(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    legacy, legacy_time = timed(lambda: LegacyTextSplitter(**kwargs).split_documents(documents))
+    splitter = ChineseRecursiveTextSplitter(**kwargs)
+    chunks, new_time = timed(lambda: list(splitter.iter_split_documents(documents)))
+    assert [(doc.page_content, doc.metadata) for doc in legacy] == chunks, "chunks differ"
+    print(f"{len(chunks)} chunks, the same of both splitters")
+    print(f"legacy split_documents   {mb / legacy_time:8.2f} MB/s")
+    print(f"iter_split_documents     {mb / new_time:8.2f} MB/s, {legacy_time / new_time:.1f}x")
+    _, time_docs = timed(lambda: splitter.split_documents(documents))
+    print(f"split_documents          {mb / time_docs:8.2f} MB/s, {legacy_time / time_docs:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
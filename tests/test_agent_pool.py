@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import asyncio
+import sys
+import time
+import unittest
+
+sys.path.append('..')
+from chatpilot.agentica_agent import AgentPool
+
+
+class AgentPoolTestCase(unittest.TestCase):
+    def test_reuse(self):
+        pool = AgentPool(max_size=4, ttl=60)
+        a = pool.get(("u1", "c1"), object)
+        b = pool.get(("u1", "c1"), object)
+        c = pool.get(("u2", "c1"), object)
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+        self.assertEqual(len(pool), 2)
+
+    def test_lru_eviction(self):
+        pool = AgentPool(max_size=2, ttl=60)
+        a = pool.get("a", object)
+        pool.get("b", object)
+        pool.get("a", object)  # touch a, b becomes the least recently used
+        pool.get("c", object)
+        self.assertEqual(len(pool), 2)
+        self.assertIs(pool.get("a", object), a)
+        self.assertIsNone(pool.pop("b"))
+
+    def test_ttl(self):
+        pool = AgentPool(max_size=4, ttl=0.05)
+        a = pool.get("a", object)
+        time.sleep(0.1)
+        self.assertIsNot(pool.get("a", object), a)
+        self.assertEqual(len(pool), 1)
+
+    def test_lock(self):
+        pool = AgentPool(max_size=4, ttl=60)
+        order = []
+
+        async def use(key, name):
+            async with pool.lock(key):
+                order.append(f"{name} start")
+                await asyncio.sleep(0.01)
+                order.append(f"{name} end")
+
+        async def run():
+            await asyncio.gather(use("a", "1"), use("a", "2"), use("b", "3"))
+
+        asyncio.run(run())
+        # The requests of one agent do not interleave, other agents run meanwhile
+        self.assertLess(order.index("1 end"), order.index("2 start"))
+        self.assertLess(order.index("3 start"), order.index("1 end"))
+        self.assertIs(pool.lock("a"), pool.lock("a"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+import time
+import unittest
+
+sys.path.append('..')
+from chatpilot.apps.balancer import LoadBalancer
+
+
+class LoadBalancerTestCase(unittest.TestCase):
+    def test_least_loaded(self):
+        b = LoadBalancer()
+        b.acquire(0)
+        self.assertEqual(b.pick([0, 1]), 1)
+        b.acquire(1)
+        b.acquire(1)
+        self.assertEqual(b.pick([0, 1]), 0)
+
+    def test_latency_aware(self):
+        b = LoadBalancer()
+        b.record_ttft(0, 2.0)
+        b.record_ttft(1, 0.5)
+        self.assertEqual(b.pick([0, 1]), 1)
+        # The fast node still wins with one request in flight, (1 + 1) * 0.5 < 2.0
+        b.acquire(1)
+        self.assertEqual(b.pick([0, 1]), 1)
+
+    def test_circuit_breaker(self):
+        b = LoadBalancer(failure_threshold=2, cooldown=0.05)
+        b.record_ttft(1, 5.0)
+        for _ in range(2):
+            b.acquire(0)
+            b.release(0, error=True)
+        self.assertFalse(b.is_available(0))
+        self.assertEqual(b.pick([0, 1]), 1)
+        self.assertEqual(b.stats(["a", "b"])[0]["circuit"], "open")
+
+        time.sleep(0.1)
+        # Half open, one trial request closes the circuit on success
+        self.assertEqual(b.pick([0, 1]), 0)
+        b.acquire(0)
+        self.assertFalse(b.is_available(0))
+        b.release(0)
+        self.assertTrue(b.is_available(0))
+        self.assertEqual(b.stats(["a", "b"])[0]["circuit"], "closed")
+
+    def test_all_open(self):
+        b = LoadBalancer(failure_threshold=1, cooldown=60)
+        b.release(1, error=True)
+        b.release(0, error=True)
+        self.assertEqual(b.pick([0, 1]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import asyncio
+import sys
+import time
+import unittest
+
+sys.path.append('..')
+from chatpilot.apps.cache_utils import RefreshingCache, TTLCache
+
+
+class RefreshingCacheTestCase(unittest.TestCase):
+    def test_stale_while_revalidate(self):
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+
+        async def run():
+            cache = RefreshingCache(loader, ttl=0.1)
+            # Concurrent first loads share one call
+            self.assertEqual(await asyncio.gather(cache.get(), cache.get()), [1, 1])
+            self.assertEqual(await cache.get(), 1)
+            await asyncio.sleep(0.15)
+            # Stale value is served at once, refreshed in the background
+            self.assertEqual(await cache.get(), 1)
+            await asyncio.sleep(0.1)
+            self.assertEqual(await cache.get(), 2)
+            cache.invalidate()
+            self.assertEqual(await cache.get(), 3)
+
+        asyncio.run(run())
+
+    def test_failed_refresh_keeps_value(self):
+        state = {"fail": False}
+
+        async def loader():
+            if state["fail"]:
+                raise ValueError("upstream down")
+            return "models"
+
+        async def run():
+            cache = RefreshingCache(loader, ttl=0)
+            self.assertEqual(await cache.get(), "models")
+            state["fail"] = True
+            self.assertEqual(await cache.refresh(), "models")
+            self.assertEqual(await cache.get(), "models")
+
+        asyncio.run(run())
+
+
+    def test_invalidate_during_load(self):
+        state = {"urls": "old"}
+        updates = []
+
+        async def loader():
+            urls = state["urls"]
+            await asyncio.sleep(0.05)
+            return urls
+
+        async def run():
+            cache = RefreshingCache(loader, ttl=60, on_update=updates.append)
+            task = asyncio.create_task(cache.get())
+            await asyncio.sleep(0.01)
+            state["urls"] = "new"
+            cache.invalidate()
+            # The load that started before the change is not stored
+            self.assertEqual(await cache.get(), "new")
+            await task
+            self.assertEqual(await cache.get(), "new")
+            self.assertEqual(updates, ["new"])
+
+        asyncio.run(run())
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    def test_lru_and_ttl(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)  # touch a, b becomes the least recently used
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.get("a"))
+
+        cache.set("d", 4, ttl=0.05)
+        self.assertEqual(cache.get("d"), 4)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("d"))
+        cache.set("e", 5, ttl=-1)  # already expired, not cached
+        self.assertIsNone(cache.get("e"))
+
+
+if __name__ == '__main__':
+    unittest.main()
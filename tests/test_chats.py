@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import peewee as pw
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+sys.path.append('..')
+from chatpilot.apps.auth_utils import get_current_user, get_admin_user
+from chatpilot.apps.web.models.chat_search import ChatSearch, ChatSearches
+from chatpilot.apps.web.models.chats import Chat, ChatMessage, ChatForm, ChatTable, get_chat_cursor
+from chatpilot.apps.web.models.tags import Tag, ChatIdTag, ChatIdTagForm, TagTable
+from chatpilot.apps.web.routers import chats as routers_chats
+from chatpilot.apps.web.routers.chats import router
+
+
+class ChatDBTestCase(unittest.TestCase):
+    def setUp(self):
+        # A file, the streaming responses read it from other threads
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = pw.SqliteDatabase(os.path.join(self.tmp_dir.name, "web.db"))
+        self.ctx = self.db.bind_ctx([Chat, ChatMessage, ChatSearch, Tag, ChatIdTag])
+        self.ctx.__enter__()
+        # Tables on the test db, so their transactions are on it too
+        self.tags = TagTable(self.db)
+        self.chats = ChatTable(self.db)
+        self.patches = [
+            patch.object(routers_chats, "Chats", self.chats),
+            patch.object(routers_chats, "Tags", self.tags),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        self.ctx.__exit__(None, None, None)
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+
+class ChatListTestCase(ChatDBTestCase):
+    def setUp(self):
+        super().setUp()
+        # Two chats share each timestamp, so pages must break ties on id
+        Chat.insert_many([
+            {"id": f"c{i:02d}", "user_id": "u1", "title": f"t{i}", "chat": "{}", "timestamp": 1000 + i // 2}
+            for i in range(10)
+        ] + [{"id": "other", "user_id": "u2", "title": "x", "chat": "{}", "timestamp": 2000}]).execute()
+
+    def test_keyset_pages(self):
+        all_chats = self.chats.get_chat_lists_by_user_id("u1")
+        self.assertEqual([c.id for c in all_chats], [f"c{i:02d}" for i in range(9, -1, -1)])
+
+        ids, cursor = [], None
+        while True:
+            page = self.chats.get_chat_lists_by_user_id("u1", limit=3, cursor=cursor)
+            ids.extend(c.id for c in page)
+            if len(page) < 3:
+                break
+            cursor = get_chat_cursor(page[-1])
+        self.assertEqual(ids, [c.id for c in all_chats])
+        self.assertEqual([c.id for c in self.chats.get_chat_lists_by_user_id("u1", skip=8)], ["c01", "c00"])
+
+    def test_projection(self):
+        self.assertNotIn("chat", self.chats.get_chat_lists_by_user_id("u1", limit=1)[0].model_dump())
+        plan = " ".join(
+            str(row) for row in self.db.execute_sql(
+                "EXPLAIN QUERY PLAN SELECT id, title, timestamp FROM chat WHERE user_id = ? "
+                "ORDER BY timestamp DESC, id DESC", ("u1",)
+            )
+        )
+        self.assertIn("chat_user_id_timestamp_id", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_bad_cursor(self):
+        with self.assertRaises(ValueError):
+            self.chats.get_chat_lists_by_user_id("u1", cursor="bad")
+
+
+def make_history(n):
+    messages = {}
+    for i in range(n):
+        messages[f"m{i}"] = {
+            "id": f"m{i}",
+            "parentId": f"m{i - 1}" if i else None,
+            "childrenIds": [f"m{i + 1}"] if i < n - 1 else [],
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"message {i}",
+        }
+    return {"messages": messages, "currentId": f"m{n - 1}"}
+
+
+class ChatMessageTestCase(ChatDBTestCase):
+    def test_round_trip(self):
+        history = make_history(4)
+        chat = {"title": "hi", "models": ["gpt-4o"], "messages": list(history["messages"].values()), "history": history}
+        new = self.chats.insert_new_chat("u1", ChatForm(chat=chat))
+        self.assertEqual(ChatMessage.select().where(ChatMessage.chat_id == new.id).count(), 4)
+        stored = json.loads(Chat.get(Chat.id == new.id).chat)
+        self.assertNotIn("messages", stored)
+        self.assertNotIn("messages", stored["history"])
+        self.assertEqual(json.loads(self.chats.get_chat_by_id_and_user_id(new.id, "u1").chat), chat)
+
+    def test_append_writes_changed_messages(self):
+        history = make_history(4)
+        new = self.chats.insert_new_chat("u1", ChatForm(chat={"title": "hi", "history": history}))
+
+        history = make_history(6)
+        self.assertEqual(self.chats.append_messages(new.id, "u1", history["messages"]), 3)  # m3 got a child, m4, m5
+        self.assertEqual(self.chats.append_messages(new.id, "u1", history["messages"]), 0)
+
+        updated = self.chats.merge_chat_by_id_and_user_id(new.id, "u1", {"title": "renamed"})
+        chat = json.loads(updated.chat)
+        self.assertEqual(chat["title"], "renamed")
+        self.assertEqual(len(chat["history"]["messages"]), 6)
+        self.assertEqual([m["id"] for m in chat["messages"]], ["m0", "m1", "m2", "m3"])  # currentId is still m3
+
+        history = make_history(2)
+        self.chats.merge_chat_by_id_and_user_id(new.id, "u1", {"history": history})
+        chat = json.loads(self.chats.get_chat_by_id_and_user_id(new.id, "u1").chat)
+        self.assertEqual(chat["history"], history)
+        self.assertIsNone(self.chats.merge_chat_by_id_and_user_id(new.id, "u2", {"title": "x"}))
+
+        self.chats.delete_chat_by_id_and_user_id(new.id, "u1")
+        self.assertEqual(ChatMessage.select().count(), 0)
+
+    def test_append_route(self):
+        new = self.chats.insert_new_chat("u1", ChatForm(chat={"title": "hi", "history": make_history(4)}))
+        app = FastAPI()
+        app.include_router(router, prefix="/chats")
+        app.dependency_overrides[get_current_user] = User
+        client = TestClient(app)
+
+        # The response saved with its parents, whose childrenIds changed, the other messages are not sent
+        history = make_history(6)
+        delta = {message_id: history["messages"][message_id] for message_id in ("m3", "m4", "m5")}
+        r = client.post(f"/chats/{new.id}/messages", json={"messages": delta, "currentId": "m5"})
+        self.assertEqual(r.json(), True)
+        chat = json.loads(self.chats.get_chat_by_id_and_user_id(new.id, "u1").chat)
+        self.assertEqual(chat["history"], history)
+        self.assertEqual([m["id"] for m in chat["messages"]], [f"m{i}" for i in range(6)])
+        self.assertEqual([r.id for r in ChatSearches.search("u1", "message 5")], [new.id])
+
+        other = self.chats.insert_new_chat("u2", ChatForm(chat={"title": "other"}))
+        r = client.post(f"/chats/{other.id}/messages", json={"messages": delta, "currentId": "m5"})
+        self.assertEqual(r.status_code, 401)
+
+    def test_diff_under_write_lock(self):
+        new = self.chats.insert_new_chat("u1", ChatForm(chat={"title": "hi", "history": make_history(2)}))
+        diff_messages = self.chats._diff_messages
+        writes = []
+
+        def diff_and_write(*args, **kwargs):
+            # Another writer while the stored messages are read, it must wait for the merge
+            conn = sqlite3.connect(os.path.join(self.tmp_dir.name, "web.db"), timeout=0)
+            try:
+                conn.execute("UPDATE chat SET title = 'other' WHERE id = ?", (new.id,))
+                conn.commit()
+                writes.append("written")
+            except sqlite3.OperationalError as e:
+                writes.append(str(e))
+            finally:
+                conn.close()
+            return diff_messages(*args, **kwargs)
+
+        with patch.object(self.chats, "_diff_messages", diff_and_write):
+            self.chats.merge_chat_by_id_and_user_id(new.id, "u1", {"history": make_history(3)})
+            self.chats.append_messages(new.id, "u1", make_history(4)["messages"])
+        self.assertEqual(writes, ["database is locked"] * 2)
+        chat = json.loads(self.chats.get_chat_by_id_and_user_id(new.id, "u1").chat)
+        self.assertEqual(len(chat["history"]["messages"]), 4)
+
+    def test_legacy_chat(self):
+        history = make_history(2)
+        Chat.create(id="legacy", user_id="u1", title="old", chat=json.dumps({"title": "old", "history": history}),
+                    timestamp=1)
+        self.assertEqual(json.loads(self.chats.get_chat_by_id_and_user_id("legacy", "u1").chat)["history"], history)
+        # Split on the first write
+        self.chats.merge_chat_by_id_and_user_id("legacy", "u1", {"title": "new"})
+        self.assertEqual(ChatMessage.select().where(ChatMessage.chat_id == "legacy").count(), 2)
+        chat = json.loads(self.chats.get_chat_by_id_and_user_id("legacy", "u1").chat)
+        self.assertEqual((chat["title"], chat["history"]), ("new", history))
+
+        Chat.create(id="legacy2", user_id="u1", title="old", chat=json.dumps({"title": "old", "history": history}),
+                    timestamp=1)
+        history = make_history(3)
+        self.assertEqual(self.chats.append_messages("legacy2", "u1", {"m2": history["messages"]["m2"]}, "m2"), 1)
+        chat = json.loads(self.chats.get_chat_by_id_and_user_id("legacy2", "u1").chat)
+        self.assertEqual(len(chat["history"]["messages"]), 3)
+        self.assertEqual(chat["history"]["currentId"], "m2")
+
+
+class ChatSearchTestCase(ChatDBTestCase):
+    def make_chat(self, user_id, title, contents):
+        history = make_history(len(contents))
+        for message, content in zip(history["messages"].values(), contents):
+            message["content"] = content
+        return self.chats.insert_new_chat(user_id, ChatForm(chat={"title": title, "history": history}))
+
+    def test_search(self):
+        a = self.make_chat("u1", "Python tips", ["how to sort a list", "use sorted(list)"])
+        b = self.make_chat("u1", "天气", ["今天北京的天气怎么样", "北京今天晴"])
+        self.make_chat("u2", "other user", ["how to sort a list"])
+
+        self.assertEqual([r.id for r in ChatSearches.search("u1", "sort list")], [a.id])
+        self.assertEqual([r.id for r in ChatSearches.search("u1", "pyth")], [a.id])  # prefix of the last word
+        results = ChatSearches.search("u1", "北京天气")
+        self.assertEqual([r.id for r in results], [b.id])
+        self.assertIn("<mark>", results[0].snippet)
+        self.assertNotIn("北 京", results[0].snippet)
+        self.assertEqual(ChatSearches.search("u1", "京北"), [])
+        self.assertEqual(ChatSearches.search("u1", '" OR *'), [])
+
+    def test_search_across_messages(self):
+        a = self.make_chat("u1", "Trip", ["book a flight to Paris", "and a hotel near the station"])
+        self.make_chat("u1", "Paris", ["museums"])
+        self.make_chat("u2", "other user", ["flight", "hotel"])
+
+        # The words are in different messages of the chat, or in its title
+        self.assertEqual([r.id for r in ChatSearches.search("u1", "flight hotel")], [a.id])
+        self.assertEqual([r.id for r in ChatSearches.search("u1", "trip hotel")], [a.id])
+        results = ChatSearches.search("u1", "paris")
+        self.assertEqual(len(results), 2)
+        self.assertEqual([r.id for r in ChatSearches.search("u1", "paris stat")], [a.id])
+        self.assertEqual(ChatSearches.search("u1", "flight museums"), [])
+
+    def test_sync(self):
+        a = self.make_chat("u1", "first", ["apples"])
+        chat = json.loads(self.chats.get_chat_by_id_and_user_id(a.id, "u1").chat)
+        chat["history"]["messages"]["m0"]["content"] = "bananas"
+        self.chats.merge_chat_by_id_and_user_id(a.id, "u1", {"history": chat["history"]})
+        self.assertEqual(ChatSearches.search("u1", "apples"), [])
+        self.assertEqual(len(ChatSearches.search("u1", "bananas")), 1)
+
+        self.chats.merge_chat_by_id_and_user_id(a.id, "u1", {"title": "renamed"})
+        self.assertEqual(ChatSearches.search("u1", "first"), [])
+        self.assertEqual(len(ChatSearches.search("u1", "renamed")), 1)
+
+        self.make_chat("u1", "second", ["bananas too"])
+        self.assertEqual(len(ChatSearches.search("u1", "bananas", limit=1)), 1)
+        self.assertEqual(len(ChatSearches.search("u1", "bananas", skip=1)), 1)
+        self.chats.delete_chat_by_id_and_user_id(a.id, "u1")
+        self.assertEqual(len(ChatSearches.search("u1", "bananas")), 1)
+        self.chats.delete_chats_by_user_id("u1")
+        self.assertEqual(ChatSearch.select().count(), 0)
+
+    def test_reindex(self):
+        self.make_chat("u1", "first", ["apples"])
+        ChatSearch.delete().execute()
+        self.assertEqual(ChatSearches.search("u1", "apples"), [])
+        self.chats.reindex()
+        self.assertEqual(len(ChatSearches.search("u1", "apples")), 1)
+
+
+class TagTestCase(ChatDBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chat_ids = [
+            self.chats.insert_new_chat("u1", ChatForm(chat={"title": f"t{i}"})).id for i in range(4)
+        ]
+
+    def test_bulk(self):
+        added = self.tags.add_tags_to_chats("u1", self.chat_ids[:3], ["work", "todo"])
+        self.assertEqual(len(added), 6)
+        self.assertEqual(len(self.tags.add_tags_to_chats("u1", self.chat_ids, ["work"])), 1)
+        self.assertEqual(Tag.select().count(), 2)
+        self.assertEqual(ChatIdTag.select().count(), 7)  # the 4th chat got work
+
+        self.assertEqual(self.tags.remove_tags_from_chats("u1", self.chat_ids, ["todo"]), 3)
+        self.assertEqual([t.name for t in self.tags.get_tags_by_user_id("u1")], ["work"])
+
+    def test_many_tags(self):
+        # More tag names than one query takes, as the chat ids
+        names = [f"tag{i}" for i in range(1200)]
+        self.assertEqual(len(self.tags.add_tags_to_chats("u1", self.chat_ids[:2], names)), 2400)
+        self.assertEqual(self.tags.add_tags_to_chats("u1", self.chat_ids[:2], names), [])
+        self.assertEqual(self.tags.remove_tags_from_chats("u1", self.chat_ids, names[:1000]), 2000)
+        self.assertEqual(sorted(t.name for t in self.tags.get_tags_by_user_id("u1")), sorted(names[1000:]))
+        self.assertEqual(Tag.select().count(), 200)
+
+    def test_queries(self):
+        self.tags.add_tags_to_chats("u1", self.chat_ids[:2], ["work"])
+        self.tags.add_tags_to_chats("u2", ["other"], ["work"])
+        self.tags.add_tag_to_chat("u1", ChatIdTagForm(tag_name="home", chat_id=self.chat_ids[0]))
+        self.assertIsNone(self.tags.add_tag_to_chat("u1", ChatIdTagForm(tag_name="home", chat_id=self.chat_ids[0])))
+
+        self.assertEqual(sorted(t.name for t in self.tags.get_tags_by_chat_id_and_user_id(self.chat_ids[0], "u1")),
+                         ["home", "work"])
+        self.assertEqual({t.user_id for t in self.tags.get_tags_by_user_id("u1")}, {"u1"})
+        chats = self.chats.get_chat_lists_by_tag_name_and_user_id("work", "u1")
+        self.assertEqual(sorted(c.id for c in chats), sorted(self.chat_ids[:2]))
+        self.assertEqual(len(self.chats.get_chat_lists_by_tag_name_and_user_id("work", "u1", skip=1)), 1)
+
+        self.tags.delete_tags_by_chat_id_and_user_id(self.chat_ids[0], "u1")
+        self.assertEqual([t.name for t in self.tags.get_tags_by_user_id("u1")], ["work"])
+        self.assertFalse(Tag.select().where((Tag.name == "home")).exists())
+        self.tags.delete_tag_by_tag_name_and_user_id("work", "u1")
+        self.assertEqual(self.tags.get_tags_by_user_id("u1"), [])
+        self.assertEqual(len(self.tags.get_tags_by_user_id("u2")), 1)
+
+
+class User:
+    id = "u1"
+    role = "admin"
+
+
+class ChatExportTestCase(ChatDBTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            self.chats.insert_new_chat("u1", ChatForm(chat={"title": f"t{i}", "history": make_history(3)}))
+        self.chats.insert_new_chat("u2", ChatForm(chat={"title": "other"}))
+        app = FastAPI()
+        app.include_router(router, prefix="/chats")
+        app.dependency_overrides[get_current_user] = User
+        app.dependency_overrides[get_admin_user] = User
+        self.client = TestClient(app)
+
+    def test_iter_chats(self):
+        chats = list(self.chats.iter_chats("u1", batch_size=2))
+        self.assertEqual([c.id for c in chats], [c.id for c in self.chats.get_all_chats_by_user_id("u1")])
+        self.assertEqual(len(list(self.chats.iter_chats(batch_size=5))), 6)
+
+    def test_json(self):
+        r = self.client.get("/chats/all")
+        self.assertEqual(r.status_code, 200)
+        expected = [
+            {**c.model_dump(), "chat": json.loads(c.chat)} for c in self.chats.get_all_chats_by_user_id("u1")
+        ]
+        self.assertEqual(r.json(), expected)
+        self.assertEqual(len(self.client.get("/chats/all/db").json()), 6)
+
+    def test_ndjson_gzip(self):
+        r = self.client.get("/chats/all/db", params={"format": "ndjson", "gzip": True})
+        self.assertEqual(r.headers["content-encoding"], "gzip")
+        lines = r.text.splitlines()  # decompressed by the client
+        self.assertEqual(len(lines), 6)
+        self.assertIn({"title": "other"}, [json.loads(line)["chat"] for line in lines])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+
+sys.path.append('..')
+from chatpilot.apps.embedding_cache import CachedEmbeddingFunction, EmbeddingCache
+
+
+class CountingEmbeddingFunction(EmbeddingFunction):
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, input):
+        self.texts.extend(input)
+        return [[float(len(text)), 1.0] for text in input]
+
+
+class EmbeddingCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "embeddings.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cached(self):
+        inner = CountingEmbeddingFunction()
+        ef = CachedEmbeddingFunction(inner, "m", EmbeddingCache(self.path))
+        first = ef(["a", "bb", "a"])
+        self.assertEqual(inner.texts, ["a", "bb"])
+        self.assertEqual([list(v) for v in first], [[1, 1], [2, 1], [1, 1]])
+
+        # Persistent, and another model does not share vectors
+        ef = CachedEmbeddingFunction(inner, "m", EmbeddingCache(self.path))
+        np.testing.assert_array_equal(ef(["bb", "ccc"]), [[2, 1], [3, 1]])
+        self.assertEqual(inner.texts, ["a", "bb", "ccc"])
+        CachedEmbeddingFunction(inner, "other", EmbeddingCache(self.path))(["a"])
+        self.assertEqual(inner.texts, ["a", "bb", "ccc", "a"])
+
+    def test_eviction(self):
+        inner = CountingEmbeddingFunction()
+        cache = EmbeddingCache(self.path, max_size=10)
+        ef = CachedEmbeddingFunction(inner, "m", cache)
+        ef([f"t{i}" for i in range(10)])
+        cache.touch_interval = 0
+        ef(["t0"])  # recently used, kept
+        ef(["new"])
+        self.assertEqual(cache._size, 9)
+        inner.texts.clear()
+        ef(["t0", "new"])
+        self.assertEqual(inner.texts, [])
+        ef([f"t{i}" for i in range(1, 10)])
+        self.assertEqual(len(inner.texts), 2)  # the two least recently used were evicted
+
+    def test_disabled(self):
+        inner = CountingEmbeddingFunction()
+        ef = CachedEmbeddingFunction(inner, "m", None)
+        ef(["a"])
+        ef(["a"])
+        self.assertEqual(inner.texts, ["a", "a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append('..')
+from chatpilot.apps.job_queue import JobQueue
+
+
+def wait_for(queue, job_id, status):
+    for _ in range(200):
+        job = queue.get(job_id)
+        if job["status"] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job is {job['status']}, not {status}")
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "jobs.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_run(self):
+        queue = JobQueue(self.path)
+
+        def count(payload, progress):
+            for i in range(payload["n"]):
+                progress(i + 1, payload["n"])
+            return {"counted": payload["n"]}
+
+        def fail(payload, progress):
+            raise ValueError("bad file")
+
+        queue.register("count", count)
+        queue.register("fail", fail)
+        job = queue.submit("count", {"n": 3}, "u1")
+        self.assertEqual(job["user_id"], "u1")
+        job = wait_for(queue, job["id"], "done")
+        self.assertEqual((job["done"], job["total"], job["result"]), (3, 3, {"counted": 3}))
+
+        job = wait_for(queue, queue.submit("fail", {})["id"], "failed")
+        self.assertEqual(job["error"], "bad file")
+        with self.assertRaises(ValueError):
+            queue.submit("unknown", {})
+        self.assertIsNone(queue.get("missing"))
+
+    def test_events(self):
+        queue = JobQueue(self.path)
+        step = threading.Event()
+
+        def slow(payload, progress):
+            for i in range(2):
+                step.wait(5)
+                step.clear()
+                progress(i + 1, 2)
+
+        queue.register("slow", slow)
+        job = queue.submit("slow", {})
+
+        async def collect():
+            events = []
+            async for event in queue.events(job["id"], interval=0.01):
+                events.append(event)
+                step.set()
+            return events
+
+        events = asyncio.run(collect())
+        self.assertEqual(events[-1]["status"], "done")
+        self.assertIn(2, [event["done"] for event in events])
+
+    def test_resume(self):
+        queue = JobQueue(self.path, stale_after=0)
+        # Left by a stopped process
+        queue._conn().execute(
+            "INSERT INTO job (id, kind, status, payload, created_at, updated_at) VALUES "
+            "('a', 'noop', 'queued', '{}', 0, 0), ('b', 'noop', 'running', '{}', 0, 0), "
+            "('c', 'noop', 'done', '{}', 0, 0)"
+        )
+        queue = JobQueue(self.path, stale_after=0)
+        queue.register("noop", lambda payload, progress: None)
+        self.assertEqual(queue.resume(), 2)
+        self.assertEqual(wait_for(queue, "a", "done")["status"], "done")
+        self.assertEqual(wait_for(queue, "b", "done")["status"], "done")
+
+    def test_heartbeat(self):
+        queue = JobQueue(self.path, stale_after=0.2)
+        release = threading.Event()
+        runs = []
+
+        def parse(payload, progress):
+            # A long step that reports no progress
+            runs.append(1)
+            release.wait(5)
+
+        queue.register("parse", parse)
+        job = queue.submit("parse", {})
+        time.sleep(0.5)
+        # Still running in this process, not taken as dead by another one
+        other = JobQueue(self.path, stale_after=0.2)
+        other.register("parse", parse)
+        self.assertEqual(other.resume(), 0)
+        self.assertEqual(queue.get(job["id"])["status"], "running")
+        release.set()
+        wait_for(queue, job["id"], "done")
+        self.assertEqual(runs, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
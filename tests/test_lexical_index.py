@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+from chatpilot.apps.lexical_index import LexicalIndex, get_tokens
+
+
+class LexicalIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index = LexicalIndex(os.path.join(self.tmp_dir.name, "lexical.db"))
+        self.index.add(
+            "docs",
+            ["1", "2", "3"],
+            ["北京今天的天气晴朗", "订单 ORD-2024-0042 已发货", "上海明天有雨"],
+            [{"source": "a"}, {"source": "b"}, {"source": "c"}],
+        )
+        self.index.add("docs-2", ["4"], ["北京的天气预报"], [{"source": "d"}])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_tokens(self):
+        self.assertIn("天气", get_tokens("北京天气怎么样？"))
+        self.assertNotIn("？", get_tokens("北京天气怎么样？"))
+        self.assertEqual(get_tokens("ORD-2024"), ["ord", "2024"])
+
+    def test_query(self):
+        result = self.index.query(["docs"], "北京天气", 5)
+        self.assertEqual(result["ids"][0][0], "1")
+        self.assertEqual(result["metadatas"][0][0], {"source": "a"})
+        self.assertEqual(result["documents"][0][0], "北京今天的天气晴朗")
+        self.assertEqual(self.index.query(["docs"], "ord-2024-0042 到哪了", 1)["ids"], [["2"]])
+        self.assertEqual(sorted(self.index.query(["docs", "docs-2"], "天气", 5)["ids"][0]), ["1", "4"])
+        self.assertEqual(self.index.query(["docs"], "！？", 5)["ids"], [[]])
+
+    def test_delete(self):
+        # `docs` also matches `docs-2` as a phrase, only the exact collection is deleted
+        self.index.delete_collection("docs")
+        self.assertEqual(self.index.query(["docs"], "天气", 5)["ids"], [[]])
+        self.assertEqual(self.index.query(["docs-2"], "天气", 5)["ids"], [["4"]])
+        self.index.clear()
+        self.assertEqual(self.index.query(["docs-2"], "天气", 5)["ids"], [[]])
+
+    def test_index_collection(self):
+        self.assertEqual(sorted(self.index.list_collection_names()), ["docs", "docs-2"])
+        batches = [(["5"], ["杭州的天气"], [{"source": "e"}])]
+        self.assertTrue(self.index.index_collection("docs-3", iter(batches)))
+        self.assertEqual(self.index.query(["docs-3"], "天气", 5)["ids"], [["5"]])
+        # Already indexed collections are left alone
+        self.assertFalse(self.index.index_collection("docs-2", iter(batches)))
+        self.assertEqual(self.index.query(["docs-2"], "天气", 5)["ids"], [["4"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
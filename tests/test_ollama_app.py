@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import asyncio
+import sys
+import unittest
+
+import anyio
+
+sys.path.append('..')
+from chatpilot.apps import ollama_app
+from chatpilot.apps.balancer import LoadBalancer
+
+
+class Content:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def at_eof(self):
+        return not self.chunks
+
+    async def iter_chunked(self, size):
+        while self.chunks:
+            yield self.chunks.pop(0)
+
+
+class UpstreamResponse:
+    """The part of an aiohttp response the stream proxy uses."""
+
+    def __init__(self, chunks):
+        self.content = Content(chunks)
+        self.status = 200
+        self.headers = {"Content-Type": "application/x-ndjson"}
+        self.released = False
+        self.closed = False
+
+    def release(self):
+        self.released = True
+
+    def close(self):
+        self.closed = True
+
+
+class StreamResponseTestCase(unittest.TestCase):
+    def setUp(self):
+        ollama_app.app.state.BALANCER = LoadBalancer()
+        ollama_app.REQUEST_POOL.clear()
+
+    def stream(self, r):
+        ollama_app.app.state.BALANCER.acquire(0)
+        return ollama_app.stream_response(r, 0, 0.0, send_request_id=True)
+
+    def test_done(self):
+        r = UpstreamResponse([b'{"done": true}\n'])
+        response = self.stream(r)
+        sent = []
+
+        async def receive():
+            await anyio.sleep_forever()
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(response({"type": "http"}, receive, send))
+        self.assertEqual(sent[-2]["body"], b'{"done": true}\n')
+        self.assertTrue(r.released)
+        self.assertEqual(ollama_app.REQUEST_POOL, {})
+        self.assertEqual(ollama_app.app.state.BALANCER.node(0).in_flight, 0)
+
+    def test_closed_before_iterated(self):
+        r = UpstreamResponse([b'{"done": false}\n'])
+        response = self.stream(r)
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            # The client is gone before the headers are sent, the body is never iterated
+            await anyio.sleep_forever()
+
+        asyncio.run(response({"type": "http"}, receive, send))
+        self.assertTrue(r.closed)
+        self.assertEqual(ollama_app.REQUEST_POOL, {})
+        self.assertEqual(ollama_app.app.state.BALANCER.node(0).in_flight, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import asyncio
+import sys
+import unittest
+from unittest.mock import patch
+
+import anyio
+
+sys.path.append('..')
+from chatpilot.apps import openai_app
+
+
+class UpstreamResponse:
+    """The part of an aiohttp response the SSE proxy uses."""
+
+    def __init__(self):
+        self.status = 200
+        self.headers = {"Content-Type": "text/event-stream"}
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class HttpClient:
+    def __init__(self, r):
+        self.r = r
+
+    async def request_stream(self, method, url, **kwargs):
+        return self.r
+
+
+class ProxyOtherRequestTestCase(unittest.TestCase):
+    def test_closed_before_iterated(self):
+        r = UpstreamResponse()
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            # The client is gone before the headers are sent, the body is never iterated
+            await anyio.sleep_forever()
+
+        async def run():
+            response = await openai_app.proxy_other_request("key", "http://upstream", "completions", b"", "POST")
+            await response({"type": "http"}, receive, send)
+
+        with patch.object(openai_app.app.state, "HTTP_CLIENT", HttpClient(r)):
+            asyncio.run(run())
+        self.assertTrue(r.released)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import peewee as pw
+from langchain_core.documents import Document
+
+sys.path.append('..')
+from chatpilot.apps import rag_app, rag_utils
+from chatpilot.apps.misc import sanitize_filename
+from chatpilot.apps.vector_store import LocalVectorStore
+from chatpilot.apps.web.models import documents
+
+
+class Loader:
+    """Pages loaded one at a time, like a PDF loader."""
+
+    def __init__(self, pages: int, fail: bool = False):
+        self.pages = pages
+        self.fail = fail
+        self.loaded = 0
+
+    def lazy_load(self):
+        for i in range(self.pages):
+            self.loaded += 1
+            yield Document(page_content=f"page {i} " + "word " * 40, metadata={"source": "a.pdf", "page": i})
+        if self.fail:
+            raise ValueError("broken page")
+
+
+class StoreDocJobTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = LocalVectorStore(self.tmp_dir.name)
+        self.patches = [
+            patch.object(rag_app, "VECTOR_STORE", self.store),
+            patch.object(rag_utils, "VECTOR_STORE", self.store),
+            patch.object(rag_app, "LEXICAL_INDEX", None),
+            patch.object(rag_utils, "LEXICAL_INDEX", None),
+            patch.object(rag_app.app.state, "sentence_transformer_ef", lambda input: [[1.0, 0.0] for _ in input]),
+            patch.object(rag_app.app.state, "EMBEDDING_BATCH_SIZE", 4),
+            patch.object(rag_app.app.state, "EMBEDDING_CONCURRENCY", 1),
+            patch.object(rag_app.app.state, "CHUNK_SIZE", 1000),
+            patch.object(rag_app.app.state, "CHUNK_UNIT", "char"),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        self.tmp_dir.cleanup()
+
+    def run_job(self, loader):
+        updates = []
+
+        def progress(done, total):
+            updates.append((done, total, loader.loaded))
+
+        payload = {
+            "filename": "a.pdf", "content_type": "application/pdf", "file_path": "a.pdf", "collection_name": "docs"
+        }
+        with patch.object(rag_app, "get_loader", lambda *args: (loader, True)):
+            return rag_app.store_doc_job(payload, progress), updates
+
+    def test_streamed(self):
+        loader = Loader(20)
+        result, updates = self.run_job(loader)
+        self.assertEqual(result, {"collection_name": "docs", "chunks": 20})
+        self.assertEqual(self.store.get_collection("docs").count(), 20)
+        # A running count of the stored chunks, the first ones are stored before the last pages are read
+        self.assertEqual([(done, total) for done, total, _ in updates], [(i, 0) for i in range(4, 21, 4)])
+        self.assertLess(updates[0][2], 20)
+
+    def test_parse_error(self):
+        with self.assertRaisesRegex(ValueError, "broken page"):
+            self.run_job(Loader(3, fail=True))
+        self.assertEqual(self.store.list_collection_names(), [])
+
+
+class ScanDocsJobTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.docs_dir = os.path.join(self.tmp_dir.name, "docs")
+        os.makedirs(self.docs_dir)
+        self.store = LocalVectorStore(os.path.join(self.tmp_dir.name, "vector_db"))
+        self.db = pw.SqliteDatabase(os.path.join(self.tmp_dir.name, "web.db"))
+        self.ctx = self.db.bind_ctx([documents.Document, documents.DocFile])
+        self.ctx.__enter__()
+        self.documents = documents.DocumentsTable(self.db)
+        self.doc_files = documents.DocFilesTable(self.db)
+        self.patches = [
+            patch.object(rag_app, "DOCS_DIR", self.docs_dir),
+            patch.object(rag_app, "Documents", self.documents),
+            patch.object(rag_app, "DocFiles", self.doc_files),
+            patch.object(rag_app, "VECTOR_STORE", self.store),
+            patch.object(rag_utils, "VECTOR_STORE", self.store),
+            patch.object(rag_app, "LEXICAL_INDEX", None),
+            patch.object(rag_utils, "LEXICAL_INDEX", None),
+            patch.object(rag_app.app.state, "sentence_transformer_ef", lambda input: [[1.0, 0.0] for _ in input]),
+            patch.object(rag_app.app.state, "SCAN_PROCESSES", 1),
+            patch.object(rag_app.app.state, "CHUNK_UNIT", "char"),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        self.ctx.__exit__(None, None, None)
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.docs_dir, name), "w") as f:
+            f.write(text)
+
+    def scan(self):
+        return rag_app.scan_docs_job({"user_id": "u1"}, lambda done, total: None)
+
+    def test_changed_file_of_shared_collection(self):
+        self.write("a.txt", "same content")
+        self.assertEqual(self.scan()["failed"], [])
+        old = self.documents.get_doc_by_name(sanitize_filename("a.txt")).collection_name
+        self.write("b.txt", "same content")
+        self.assertEqual(self.scan()["failed"], [])
+
+        self.write("a.txt", "changed content")  # another size, the manifest takes the file as changed
+        self.assertEqual(self.scan()["failed"], [])
+        # b.txt still has the old content, its collection is kept, a.txt points at its new one
+        new = self.documents.get_doc_by_name(sanitize_filename("a.txt")).collection_name
+        self.assertNotEqual(new, old)
+        self.assertEqual(self.doc_files.get_doc_files()["a.txt"].collection_name, new)
+        self.assertEqual(set(self.store.list_collection_names()), {old, new})
+
+    def test_failed_collection(self):
+        self.write("a.txt", "same content")
+        self.write("b.txt", "same content")
+        self.write("c.txt", "other content")
+
+        def load_and_split(filename, *args):
+            if filename != "c.txt":
+                raise ValueError("broken file")
+            return ["other content"], [{"source": filename}], True
+
+        with patch.object(rag_app, "load_and_split", load_and_split):
+            result = self.scan()
+        # Neither file of the failed content is recorded, so the next scan tries them again
+        self.assertEqual(sorted(result["failed"]), ["a.txt", "b.txt"])
+        self.assertEqual(list(self.doc_files.get_doc_files()), ["c.txt"])
+        self.assertEqual([doc.filename for doc in self.documents.get_docs()], ["c.txt"])
+
+        result = self.scan()
+        self.assertEqual((result["failed"], result["stored"]), ([], 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.append('..')
+from chatpilot.apps import rag_utils
+from chatpilot.apps.rag_utils import (
+    add_texts_in_batches,
+    backfill_lexical_index,
+    count_tokens,
+    get_context,
+    merge_and_sort_query_results,
+    query_collection,
+    rag_messages,
+    reciprocal_rank_fusion,
+)
+from chatpilot.apps.lexical_index import LexicalIndex
+from chatpilot.apps.vector_store import ChromaVectorStore, LocalVectorStore
+
+
+class Collection:
+    def __init__(self):
+        self.added = []
+
+    def add(self, ids, embeddings, documents, metadatas):
+        assert len(ids) == len(embeddings) == len(documents) == len(metadatas)
+        self.added.extend(zip(documents, embeddings, metadatas))
+
+
+class SlowEmbeddingFunction:
+    def __init__(self):
+        self.batches = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, input):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.batches.append(len(input))
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        return [[float(text)] for text in input]
+
+
+class AddTextsInBatchesTestCase(unittest.TestCase):
+    def test_batches(self):
+        texts = [str(i) for i in range(103)]
+        collection, ef = Collection(), SlowEmbeddingFunction()
+        count = add_texts_in_batches(
+            collection, texts, [{"i": i} for i in range(103)], ef, batch_size=10, concurrency=3
+        )
+        self.assertEqual(count, 103)
+        self.assertEqual(sorted(ef.batches), [3] + [10] * 10)
+        self.assertLessEqual(ef.max_running, 3)
+        # Each text keeps its own embedding and metadata, whatever order the batches finish in
+        self.assertEqual(sorted(collection.added, key=lambda x: x[2]["i"]),
+                         [(str(i), [float(i)], {"i": i}) for i in range(103)])
+
+    def test_iterators(self):
+        taken = []
+
+        def get_texts():
+            for i in range(100):
+                taken.append(i)
+                yield str(i)
+
+        def ef(input):
+            seen.append(len(taken))
+            return [[float(text)] for text in input]
+
+        seen = []
+        collection = Collection()
+        count = add_texts_in_batches(
+            collection, get_texts(), ({"i": i} for i in range(100)), ef, batch_size=10, concurrency=1
+        )
+        self.assertEqual(count, 100)
+        self.assertEqual(collection.added, [(str(i), [float(i)], {"i": i}) for i in range(100)])
+        # A batch is taken from the texts when it is submitted, not all of them first
+        self.assertEqual(seen[0], 10)
+
+    def test_error(self):
+        def ef(input):
+            if "5" in input:
+                raise ValueError("provider error")
+            return [[0.0] for _ in input]
+
+        with self.assertRaises(ValueError):
+            add_texts_in_batches(Collection(), [str(i) for i in range(100)], [{}] * 100, ef, batch_size=1)
+
+
+def make_result(rows):
+    return {
+        "distances": [[d for d, _ in rows]],
+        "ids": [[i for _, i in rows]],
+        "metadatas": [[{"id": i} for _, i in rows]],
+        "documents": [[f"doc {i}" for _, i in rows]],
+        "scores": [[1 - d for d, _ in rows]],
+    }
+
+
+class QueryCollectionTestCase(unittest.TestCase):
+    def test_merge(self):
+        merged = merge_and_sort_query_results(
+            [make_result([(0.1, "a"), (0.5, "b")]), make_result([(0.3, "c")]), make_result([])], 2
+        )
+        self.assertEqual(merged["ids"], [["a", "c"]])
+        self.assertEqual(merged["distances"], [[0.1, 0.3]])
+        self.assertEqual(merged["documents"], [["doc a", "doc c"]])
+        self.assertEqual(merged["scores"], [[0.9, 0.7]])
+        self.assertEqual(merge_and_sort_query_results([], 3)["ids"], [[]])
+
+    def test_reciprocal_rank_fusion(self):
+        vector = make_result([(0.1, "a"), (0.2, "b"), (0.3, "c")])
+        lexical = make_result([(-9.0, "c"), (-5.0, "d")])
+        fused = reciprocal_rank_fusion([vector, lexical], 4)
+        # c is found by both, d only by keywords and ranks with b
+        self.assertEqual(fused["ids"][0][:2], ["c", "a"])
+        self.assertEqual(set(fused["ids"][0][2:]), {"b", "d"})
+        self.assertEqual(fused["documents"][0][:2], ["doc c", "doc a"])
+        self.assertLess(fused["distances"][0][0], fused["distances"][0][1])
+        self.assertEqual(fused["scores"][0], [-d for d in fused["distances"][0]])
+
+    def test_embed_once(self):
+        ef = SlowEmbeddingFunction()
+        result = query_collection(["missing-1", "missing-2", "missing-1"], "1", 3, ef)
+        self.assertEqual(ef.batches, [1])
+        self.assertEqual(result["ids"], [[]])
+
+    def test_rag_messages(self):
+        ef = SlowEmbeddingFunction()
+        docs = [
+            {"type": "doc", "collection_name": "missing-1"},
+            {"type": "collection", "collection_names": ["missing-1", "missing-2"]},
+        ]
+        messages = [{"role": "user", "content": "1"}]
+        messages = rag_messages(docs, messages, "[context] [query]", 3, ef, max_tokens=100)
+        self.assertEqual(ef.batches, [1])
+        self.assertEqual(messages[-1]["content"], " 1")
+
+    def test_chroma_scores(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ChromaVectorStore(tmp_dir)
+            # Not unit length, squared L2 distances would be far from 0..2
+            store.create_collection("docs").add(
+                ids=["near", "close", "far"],
+                embeddings=[[3.0, 0.0], [9.0, 1.0], [0.0, 5.0]],
+                documents=["near doc", "close doc", "far doc"],
+                metadatas=[{"source": "a"}, {"source": "b"}, {"source": "c"}],
+            )
+
+            def ef(input):
+                return [[2.0, 0.0] for _ in input]
+
+            messages = [{"role": "user", "content": "q"}]
+            with patch.object(rag_utils, "VECTOR_STORE", store), patch.object(rag_utils, "LEXICAL_INDEX", None):
+                result = query_collection(["docs"], "q", 3, ef)
+                self.assertEqual(result["ids"], [["near", "close", "far"]])
+                self.assertAlmostEqual(result["scores"][0][0], 1.0, places=5)
+                self.assertAlmostEqual(result["scores"][0][2], 0.0, places=5)
+                # Hybrid without the keyword index falls back to the vector scores, the far chunk is dropped
+                messages = rag_messages(
+                    [{"type": "doc", "collection_name": "docs"}], messages, "[context]", 3, ef,
+                    mode="hybrid", min_score_ratio=0.4,
+                )
+            self.assertEqual(messages[-1]["content"], "near doc\nclose doc")
+
+    def test_hybrid_drops_low_scores(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = LocalVectorStore(tmp_dir)
+            index = LexicalIndex(os.path.join(tmp_dir, "lexical.db"))
+            ids = ["hotel", "museum", "sushi"]
+            documents = ["paris hotel", "paris museum", "tokyo sushi"]
+            metadatas = [{"source": id} for id in ids]
+            store.create_collection("docs").add(
+                ids=ids, embeddings=[[1.0, 0.0], [0.9, 0.4], [0.0, 1.0]], documents=documents, metadatas=metadatas
+            )
+            index.add("docs", ids, documents, metadatas)
+
+            def ef(input):
+                return [[1.0, 0.0] for _ in input]
+
+            messages = [{"role": "user", "content": "hotel"}]
+            with patch.object(rag_utils, "VECTOR_STORE", store), patch.object(rag_utils, "LEXICAL_INDEX", index):
+                # The fused score of the 3rd chunk is about half of the best one, over the ratio
+                fused = query_collection(["docs"], "hotel", 3, ef, mode="hybrid")
+                self.assertEqual(fused["ids"][0][0], "hotel")
+                self.assertGreater(fused["scores"][0][2] / fused["scores"][0][0], 0.4)
+                # The unrelated chunk is dropped by its cosine similarity, before the fusion
+                messages = rag_messages(
+                    [{"type": "doc", "collection_name": "docs"}], messages, "[context]", 3, ef,
+                    mode="hybrid", min_score_ratio=0.4,
+                )
+            self.assertEqual(messages[-1]["content"], "paris hotel\nparis museum")
+
+    def test_hybrid_concurrent(self):
+        started = threading.Event()
+
+        class Index:
+            def query(self, collection_names, query, k):
+                started.set()
+                return make_result([(-1.0, "b")])
+
+        def ef(input):
+            # Only returns if the keyword search runs meanwhile
+            self.assertTrue(started.wait(5))
+            return [[1.0, 0.0] for _ in input]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = LocalVectorStore(tmp_dir)
+            store.create_collection("docs").add(
+                ids=["a"], embeddings=[[1.0, 0.0]], documents=["doc a"], metadatas=[{}]
+            )
+            with patch.object(rag_utils, "VECTOR_STORE", store), patch.object(rag_utils, "LEXICAL_INDEX", Index()):
+                result = query_collection(["docs"], "q", 2, ef, mode="hybrid")
+        self.assertEqual(sorted(result["ids"][0]), ["a", "b"])
+
+    def test_backfill_lexical_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = LocalVectorStore(tmp_dir)
+            index = LexicalIndex(os.path.join(tmp_dir, "lexical.db"))
+            for name in ["docs", "docs-2"]:
+                store.create_collection(name).add(
+                    ids=[f"{name}-{i}" for i in range(5)], embeddings=[[1.0, float(i)] for i in range(5)],
+                    documents=[f"{name} chunk {i}" for i in range(5)], metadatas=[{"source": name}] * 5,
+                )
+            index.add("docs-2", ["docs-2-0"], ["docs-2 chunk 0"], [{"source": "docs-2"}])
+            with patch.object(rag_utils, "VECTOR_STORE", store), patch.object(rag_utils, "LEXICAL_INDEX", index):
+                self.assertEqual(backfill_lexical_index(batch_size=2), 1)
+                self.assertEqual(backfill_lexical_index(batch_size=2), 0)
+            self.assertEqual(len(index.query(["docs"], "chunk", 10)["ids"][0]), 5)
+            # Indexed collections are left as they were
+            self.assertEqual(index.query(["docs-2"], "chunk", 10)["ids"], [["docs-2-0"]])
+
+    def test_context_budget(self):
+        self.assertGreater(count_tokens("检索增强生成"), 0)
+        documents = ["a " * 50, "b " * 50, "c " * 50]
+        self.assertEqual(get_context(documents), "\n".join(documents))
+        budget = count_tokens(documents[0]) + count_tokens(documents[1])
+        self.assertEqual(get_context(documents, budget), "\n".join(documents[:2]))
+        self.assertEqual(get_context(documents, 1), "")
+        # A shorter chunk after one that does not fit is packed
+        budget = count_tokens(documents[0]) + count_tokens("d d")
+        self.assertEqual(get_context(documents + ["d d"], budget), documents[0] + "\nd d")
+
+    def test_pack_context(self):
+        first = "检索增强生成先检索相关的文档片段。再把这些片段放进提示词里，让模型根据它们回答问题。"
+        # The next chunk of the document, starting with the end of the first one as the overlap
+        second = "再把这些片段放进提示词里，让模型根据它们回答问题。重叠的部分只保留一次。"
+        other = "Hybrid search fuses the ranks of the keyword and vector results."
+        self.assertEqual(
+            get_context([first, second, first[:20], other]),
+            "\n".join([first, "重叠的部分只保留一次。", other]),
+        )
+        # The end of a chunk shared with the start of one packed before
+        self.assertEqual(get_context([second, first]), "\n".join([second, "检索增强生成先检索相关的文档片段。"]))
+        # Scores, higher is better, the tail under half of the best is dropped
+        self.assertEqual(get_context([first, other, "low"], scores=[0.8, 0.5, 0.3], min_score_ratio=0.5),
+                         "\n".join([first, other]))
+        # No ratio of a best score that is not positive
+        self.assertEqual(get_context([first, other], scores=[-0.1, -0.5], min_score_ratio=0.5),
+                         "\n".join([first, other]))
+        # A chunk without a score, as of an L2 collection, is kept
+        self.assertEqual(get_context([first, other], scores=[0.8, None], min_score_ratio=0.5),
+                         "\n".join([first, other]))
+
+
+if __name__ == '__main__':
+    unittest.main()
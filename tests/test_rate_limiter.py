@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+from chatpilot.apps.rate_limit import (
+    MemoryRateLimitBackend,
+    SQLiteRateLimitBackend,
+    RedisRateLimitBackend,
+    RateLimiter,
+)
+
+
+class RateLimitBackendTestCase(unittest.TestCase):
+    def check_backend(self, backend):
+        limits = [(60, 3)]
+        now = 6000.0  # start of a minute window
+        self.assertEqual([backend.acquire("u1", limits, now) for _ in range(4)], [None, None, None, 0])
+        # Other users have their own counters
+        self.assertIsNone(backend.acquire("u2", limits, now))
+        # Half way in the next window, half of the previous window still counts: 3 * 0.5 + 2 > 3
+        self.assertEqual([backend.acquire("u1", limits, now + 90) for _ in range(3)], [None, None, 0])
+        # Two windows later the counters are empty
+        self.assertIsNone(backend.acquire("u1", limits, now + 180))
+
+    def check_rejected_not_counted(self, backend):
+        limits = [(86400, 100), (60, 1)]
+        now = 86400.0 * 100
+        self.assertIsNone(backend.acquire("u1", limits, now))
+        for _ in range(5):
+            self.assertEqual(backend.acquire("u1", limits, now + 1), 1)
+        # Only the allowed request counts against the daily limit
+        self.assertIsNone(backend.acquire("u1", [(86400, 2)], now + 120))
+        self.assertEqual(backend.acquire("u1", [(86400, 2)], now + 120), 0)
+
+    def test_memory(self):
+        self.check_backend(MemoryRateLimitBackend())
+        self.check_rejected_not_counted(MemoryRateLimitBackend())
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.check_backend(SQLiteRateLimitBackend(os.path.join(tmp_dir, "a.db")))
+            self.check_rejected_not_counted(SQLiteRateLimitBackend(os.path.join(tmp_dir, "b.db")))
+
+    def test_redis(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest("fakeredis is not installed")
+        self.check_backend(RedisRateLimitBackend(client=fakeredis.FakeRedis()))
+        self.check_rejected_not_counted(RedisRateLimitBackend(client=fakeredis.FakeRedis()))
+
+    def test_limiter(self):
+        limiter = RateLimiter()
+        self.assertIsNone(limiter.acquire("u1", -1, -1))
+        self.assertIsNone(limiter.acquire("u1", 1, -1))
+        self.assertEqual(limiter.acquire("u1", 1, -1), "RPD")
+        self.assertIsNone(limiter.acquire("u2", -1, 1))
+        self.assertEqual(limiter.acquire("u2", -1, 1), "RPM")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import sys
+import unittest
+
+from langchain_core.documents import Document
+
+sys.path.append('..')
+from chatpilot.apps.text_splitter import ChineseRecursiveTextSplitter, count_tokens
+
+text = (
+    "机器学习是人工智能的一个分支。它研究计算机怎样模拟人类的学习行为，以获取新的知识！\n\n"
+    "Deep learning is a subset. It uses neural networks; they have many layers, which learn features.\n\n\n\n"
+    "深度学习很强大？是的。"
+)
+
+
+class TextSplitterTestCase(unittest.TestCase):
+    def test_split_text(self):
+        # The chunks of the previous, string based splitter
+        splitter = ChineseRecursiveTextSplitter(chunk_size=30, chunk_overlap=10)
+        self.assertEqual(splitter.split_text(text), [
+            "机器学习是人工智能的一个分支。",
+            "它研究计算机怎样模拟人类的学习行为，以获取新的知识！",
+            "Deep learning is a subset.",
+            "It uses neural networks;",
+            "they have many layers,",
+            "which learn features.",
+            "深度学习很强大？是的。",
+        ])
+        splitter = ChineseRecursiveTextSplitter(chunk_size=60, chunk_overlap=0)
+        self.assertEqual(splitter.split_text(text), [
+            "机器学习是人工智能的一个分支。它研究计算机怎样模拟人类的学习行为，以获取新的知识！",
+            "Deep learning is a subset.",
+            "It uses neural networks;",
+            "they have many layers, which learn features.",
+            "深度学习很强大？是的。",
+        ])
+
+    def test_overlap(self):
+        splitter = ChineseRecursiveTextSplitter(chunk_size=12, chunk_overlap=6)
+        chunks = splitter.split_text("一二三。四五六。七八九。十一二。十三四。")
+        self.assertEqual(chunks, ["一二三。四五六。七八九。", "七八九。十一二。十三四。"])
+
+    def test_token_length(self):
+        splitter = ChineseRecursiveTextSplitter(chunk_size=20, chunk_overlap=5, length_function=count_tokens)
+        chunks = splitter.split_text(text * 5)
+        self.assertGreater(len(chunks), 5)
+        self.assertTrue(all(count_tokens(chunk) <= 20 for chunk in chunks))
+        # Sized in tokens, not chars
+        self.assertNotEqual(chunks, ChineseRecursiveTextSplitter(chunk_size=20, chunk_overlap=5).split_text(text * 5))
+
+    def test_spans(self):
+        splitter = ChineseRecursiveTextSplitter(chunk_size=200, chunk_overlap=0)
+        spans = list(splitter.iter_spans(text))
+        self.assertEqual(len(spans), 1)
+        start, end = spans[0]
+        self.assertEqual((start, end), (0, len(text)))
+        # Blank lines are collapsed in the chunk, not in the offsets
+        self.assertEqual(splitter.split_text(text), [text.replace("\n\n\n\n", "\n").replace("\n\n", "\n")])
+        self.assertEqual(list(splitter.iter_spans(" \n ")), [])
+
+    def test_split_documents(self):
+        metadata = {"source": "a.txt"}
+        documents = [Document(page_content=text, metadata=metadata), Document(page_content="第二页。", metadata={})]
+        splitter = ChineseRecursiveTextSplitter(chunk_size=30, chunk_overlap=10)
+        chunks = list(splitter.iter_split_documents(documents))
+        self.assertEqual(len(chunks), 8)
+        # The chunks of a document share its metadata
+        self.assertTrue(all(m is metadata for _, m in chunks[:7]))
+        self.assertEqual(chunks[-1], ("第二页。", {}))
+        self.assertEqual(
+            [(doc.page_content, doc.metadata) for doc in splitter.split_documents(documents)], chunks
+        )
+
+        splitter = ChineseRecursiveTextSplitter(chunk_size=30, chunk_overlap=10, add_start_index=True)
+        chunk, chunk_metadata = list(splitter.iter_split_documents(documents))[2]
+        self.assertEqual(chunk_metadata, {"source": "a.txt", "start_index": text.index(chunk)})
+        self.assertEqual(metadata, {"source": "a.txt"})
+
+        # The text after the limit is dropped
+        splitter = ChineseRecursiveTextSplitter(chunk_size=30, chunk_overlap=10, doc_text_length_limit=20)
+        self.assertEqual(list(splitter.iter_split_documents(documents)), [(text[:20], metadata)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description:
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append('..')
+from chatpilot.apps.vector_store import (
+    CollectionExistsError,
+    CollectionNotFoundError,
+    LocalVectorStore,
+    VectorStore,
+)
+
+
+class LocalVectorStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(300, 16)).astype(np.float32)
+        self.queries = rng.normal(size=(5, 16)).astype(np.float32)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def add(self, collection):
+        for start in range(0, len(self.vectors), 64):
+            end = min(start + 64, len(self.vectors))
+            collection.add(
+                ids=[f"id{i}" for i in range(start, end)],
+                embeddings=self.vectors[start:end].tolist(),
+                documents=[f"doc {i}" for i in range(start, end)],
+                metadatas=[{"source": f"文档{i}"} for i in range(start, end)],
+            )
+
+    def exact(self, k):
+        vectors = self.vectors / np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        queries = self.queries / np.linalg.norm(self.queries, axis=1, keepdims=True)
+        return np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+
+    def test_query(self):
+        store = LocalVectorStore(self.tmp_dir.name)
+        self.add(store.create_collection("docs"))
+        # Reopened from disk
+        collection = LocalVectorStore(self.tmp_dir.name).get_collection("docs")
+        self.assertEqual(collection.count(), 300)
+        result = collection.query(query_embeddings=self.queries.tolist(), n_results=5)
+        expected = self.exact(5)
+        self.assertEqual(result["ids"], [[f"id{i}" for i in row] for row in expected])
+        self.assertEqual(result["documents"][0][0], f"doc {expected[0][0]}")
+        self.assertEqual(result["metadatas"][0][0], {"source": f"文档{expected[0][0]}"})
+        self.assertEqual(result["distances"][0], sorted(result["distances"][0]))
+        self.assertEqual(len(collection.query(query_embeddings=[[1.0] * 16], n_results=500)["ids"][0]), 300)
+        rows = collection.get(limit=64, offset=256)
+        self.assertEqual(rows["ids"], [f"id{i}" for i in range(256, 300)])
+        self.assertEqual(rows["documents"][0], "doc 256")
+        self.assertEqual(rows["metadatas"][0], {"source": "文档256"})
+        self.assertEqual(collection.get(offset=300)["ids"], [])
+
+    def test_quantize(self):
+        store = LocalVectorStore(self.tmp_dir.name, quantize=True)
+        collection = store.create_collection("docs")
+        self.add(collection)
+        self.assertEqual(os.path.getsize(os.path.join(store.path, "docs", "vectors.bin")), 300 * 16)
+        result = collection.query(query_embeddings=self.queries.tolist(), n_results=10)
+        expected = self.exact(10)
+        for ids, row in zip(result["ids"], expected):
+            self.assertEqual(ids[0], f"id{row[0]}")
+            self.assertGreaterEqual(len(set(ids) & {f"id{i}" for i in row}), 8)
+
+    def test_ivf(self):
+        # Clustered like real embeddings
+        rng = np.random.default_rng(1)
+        centers = rng.normal(size=(20, 16))
+        self.vectors = (centers[rng.integers(0, 20, 3000)] + rng.normal(scale=0.3, size=(3000, 16))).astype(np.float32)
+        store = LocalVectorStore(self.tmp_dir.name, ann_min_size=500, nprobe=8)
+        collection = store.create_collection("docs")
+        self.add(collection)
+        info = collection._read_info()
+        # Trained at 512 rows, again at 2048, the rows added since are in the lists
+        self.assertEqual(info["ivf"], {"trained": 2048, "nlist": 45})
+        self.assertNotIn("ivf-512.lists", os.listdir(collection.path))
+        self.assertEqual(os.path.getsize(os.path.join(collection.path, "ivf-2048.lists")), 3000 * 4)
+
+        collection = LocalVectorStore(self.tmp_dir.name, ann_min_size=500, nprobe=8).get_collection("docs")
+        expected = self.exact(10)
+        exact = collection.query(query_embeddings=self.queries.tolist(), n_results=10, nprobe=0)
+        self.assertEqual(exact["ids"], [[f"id{i}" for i in row] for row in expected])
+        result = collection.query(query_embeddings=self.queries.tolist(), n_results=10)
+        recall = np.mean([len(set(ids) & set(row)) / 10 for ids, row in zip(result["ids"], exact["ids"])])
+        self.assertGreaterEqual(recall, 0.9)
+
+    def test_retrain_during_query(self):
+        store = LocalVectorStore(self.tmp_dir.name, ann_min_size=100, nprobe=4)
+        collection = store.create_collection("docs")
+        self.add(collection)
+        self.assertEqual(collection._read_info()["ivf"]["trained"], 128)
+        # A query of another object of the collection has read the info before the retrain
+        info = store.get_collection("docs")._acquire_info()
+        collection.add(
+            ids=[f"new{i}" for i in range(212)], embeddings=np.ones((212, 16)).tolist(), documents=["new"] * 212
+        )
+        self.assertEqual(collection._read_info()["ivf"]["trained"], 512)
+        self.assertIn("ivf-128.lists", os.listdir(collection.path))
+        result = collection._query(info, self.queries.tolist(), 5, 4)
+        self.assertEqual(len(result["ids"][0]), 5)
+        collection._release_info(info)
+        self.assertNotIn("ivf-128.lists", os.listdir(collection.path))
+        self.assertNotIn("ivf-128.centroids", os.listdir(collection.path))
+        self.assertIn("ivf-512.lists", os.listdir(collection.path))
+
+    def test_interrupted_add(self):
+        store = LocalVectorStore(self.tmp_dir.name)
+        collection = store.create_collection("docs")
+        self.add(collection)
+        # Rows written past the recorded count, as by an add that was killed
+        with open(os.path.join(store.path, "docs", "vectors.bin"), "ab") as f:
+            f.write(b"\0" * 100)
+        collection.add(ids=["new"], embeddings=[self.queries[0].tolist()], documents=["new doc"])
+        result = collection.query(query_embeddings=[self.queries[0].tolist()], n_results=1)
+        self.assertEqual(result["ids"], [["new"]])
+        self.assertEqual((result["documents"], result["metadatas"]), ([["new doc"]], [[None]]))
+        self.assertAlmostEqual(result["distances"][0][0], 0, places=5)
+
+    def test_collections(self):
+        store = LocalVectorStore(self.tmp_dir.name)
+        store.create_collection("b-docs")
+        store.create_collection("a-docs")
+        with self.assertRaises(CollectionExistsError):
+            store.create_collection("a-docs")
+        with self.assertRaises(ValueError):
+            store.create_collection("../x")
+        self.assertEqual(store.list_collection_names(), ["a-docs", "b-docs"])
+        self.assertEqual(store.get_collection("a-docs").query(query_embeddings=[[1.0]], n_results=3)["ids"], [[]])
+        store.delete_collection("a-docs")
+        with self.assertRaises(CollectionNotFoundError):
+            store.get_collection("a-docs")
+        store.reset()
+        self.assertEqual(store.list_collection_names(), [])
+
+    def test_incomplete_store(self):
+        class NoSpaceVectorStore(LocalVectorStore):
+            get_space = VectorStore.get_space
+
+        # A backend missing a method fails when it is created, not on its first query
+        with self.assertRaises(TypeError):
+            NoSpaceVectorStore(self.tmp_dir.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -253,6 +253,45 @@ export const updateChatById = async (token: string, id: string, chat: object) =>
 	return res;
 };
 
+export const appendChatMessages = async (
+	token: string,
+	id: string,
+	messages: object,
+	currentId: string | null
+) => {
+	let error = null;
+
+	// Only these messages are sent and written, not the whole history of the chat
+	const res = await fetch(`${WEBUI_API_BASE_URL}/chats/${id}/messages`, {
+		method: 'POST',
+		headers: {
+			Accept: 'application/json',
+			'Content-Type': 'application/json',
+			...(token && { authorization: `Bearer ${token}` })
+		},
+		body: JSON.stringify({
+			messages: messages,
+			currentId: currentId
+		})
+	})
+		.then(async (res) => {
+			if (!res.ok) throw await res.json();
+			return res.json();
+		})
+		.catch((err) => {
+			error = err;
+
+			console.log(err);
+			return null;
+		});
+
+	if (error) {
+		throw error;
+	}
+
+	return res;
+};
+
 export const deleteChatById = async (token: string, id: string) => {
 	let error = null;
 
@@ -185,9 +185,55 @@ export const uploadDocToVectorDB = async (token: string, collection_name: string
 		throw error;
 	}
 
+	// The file is parsed and embedded by a background job, the doc is usable once it is done
+	if (res?.job_id) {
+		await waitForJob(token, res.job_id);
+	}
+
+	return res;
+};
+
+export const getJob = async (token: string, jobId: string) => {
+	let error = null;
+
+	const res = await fetch(`${RAG_API_BASE_URL}/jobs/${jobId}`, {
+		method: 'GET',
+		headers: {
+			Accept: 'application/json',
+			authorization: `Bearer ${token}`
+		}
+	})
+		.then(async (res) => {
+			if (!res.ok) throw await res.json();
+			return res.json();
+		})
+		.catch((err) => {
+			error = err.detail;
+			console.log(err);
+			return null;
+		});
+
+	if (error) {
+		throw error;
+	}
+
 	return res;
 };
 
+export const waitForJob = async (token: string, jobId: string, interval: number = 500) => {
+	// Throws the error of a failed job, such as a file that can not be parsed
+	while (true) {
+		const job = await getJob(token, jobId);
+		if (job.status === 'done') {
+			return job;
+		}
+		if (job.status === 'failed') {
+			throw job.error;
+		}
+		await new Promise((resolve) => setTimeout(resolve, interval));
+	}
+};
+
 export const uploadWebToVectorDB = async (token: string, collection_name: string, url: string) => {
 	let error = null;
 
@@ -317,6 +363,11 @@ export const scanDocs = async (token: string) => {
 		throw error;
 	}
 
+	// The docs dir is scanned by a background job, the docs are stored once it is done
+	if (res?.job_id) {
+		await waitForJob(token, res.job_id);
+	}
+
 	return res;
 };
 
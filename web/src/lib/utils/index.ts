@@ -53,6 +53,17 @@ export const convertMessagesToHistory = (messages) => {
 	return history;
 };
 
+export const getMessageWithParents = (history, messageId, depth = 2) => {
+	// A new message and the parents whose childrenIds changed when it and its prompt were added
+	const messages = {};
+	let message = history.messages[messageId];
+	for (let i = 0; message && i <= depth; i++) {
+		messages[message.id] = message;
+		message = message.parentId !== null ? history.messages[message.parentId] : null;
+	}
+	return messages;
+};
+
 export const getGravatarURL = (email) => {
 	// Trim leading and trailing whitespace from
 	// an email address and force all characters